@@ -14,13 +14,47 @@
 # GNU General Public License for more details.
 
 # TODO:
-#  - Multi-thread support. Probably a dedicated thread for each hash type.
 #  - Setting file.
-#  - More output format.
-#  - SHA3 support.
 #  - Smart file path shortening
 
-import sys, os, zlib, hashlib, shutil, re, time, struct, multiprocessing, math
+import sys, os, stat, zlib, hashlib, binascii, shutil, re, time, struct, multiprocessing, threading, mmap, json, platform, collections
+import socket, subprocess
+from multiprocessing.pool import ThreadPool
+try:
+	import queue
+except ImportError: # Python 2
+	import Queue as queue
+try:
+	import socketserver
+except ImportError: # Python 2
+	import SocketServer as socketserver
+try:
+	import sqlite3
+except ImportError: # some minimal builds don't have it
+	sqlite3 = None
+try:
+	import resource
+except ImportError: # Windows
+	resource = None
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+try:
+	import crc32c
+except ImportError:
+	crc32c = None
+try:
+	import ctypes, ctypes.util, select
+except ImportError:
+	ctypes = None
+try:
+	from os import scandir
+except ImportError: # Python < 3.5
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 programName = "Python CRC-32 Hasher"
 version = "1.10"
@@ -29,19 +63,34 @@ contributors = ["felipem775"]
 
 addcrc = False
 updatecrc = False
+dryRun = False # only show what --addcrc and --updatecrc would rename
+renameLogPath = None # undo log of the renames, see RenameStage
+renameBatchSize = 256
+renameStage = None
+renameFailures = 0 # renames that failed; the exit status is then 1
+undoRenames = False
 force = False
 recursive = False
 searchSubFolder = False
+includePatterns = []
+excludePatterns = []
 createsfv = False
 showChecksumResult = True
 waitBeforeExit = False
 showFullPath = False
 showFileInfo = False
 
+outputFormat = 'text' # of the results on stdout, see ResultOutput
+outputFormats = ['text', 'json', 'csv', 'jsonl']
+outputBufferSize = 1024 * 1024 # characters waiting for the output thread before print() waits too
+outputStage = None
+resultOutput = None
+progressInterval = 0 # ms between two reports of --progress, 0 = no progress report
+progressReport = None
+
 sfvPath = "checksums.sfv"
 sfvHeader = "; Generated by %s v%s " % (programName, version)
-sfvContent = []
-sfvPureAscii = True
+manifestWriter = None
 
 enableCrc = True
 enableMd4 = False
@@ -51,16 +100,112 @@ enableSha256 = False
 enableSha512 = False
 enableEd2k = False
 
+enabledHashes = [] # the other hashes of the registry (see registerHash)
+
+# Same order as the hashes returned by hasher_s. More hashes get registered
+# after these, see registerHash.
+hashNames = ['crc32', 'md4', 'md5', 'sha1', 'sha256', 'sha512', 'ed2k']
+hashDisplayNames = ['CRC-32', 'MD4', 'MD5', 'SHA-1', 'SHA-256', 'SHA-512', 'ED2K']
+legacyHashNames = list(hashNames)
+
 st_total = 0
 st_ok = 0
 st_notok = 0
 st_error = 0
 st_notfound = 0
 st_size = 0
+st_cached = 0
 
 pathList = []
-defaultTimer = None
+stdinName = '-'
+defaultTimer = time.time
 cpuCount = 1
+jobs = 1
+hashThreads = True
+hashQueueDepth = 4
+poolWindow = 4 # items queued per job with --jobs, see imapBounded
+readPath = 'auto'
+readPaths = ['auto', 'read', 'readinto', 'mmap', 'prefetch']
+mmapThreshold = 64 * 1024 * 1024
+readBuffers = threading.local()
+readAhead = 4 # blocks read ahead of the hashes by the prefetch read path, per file
+readAheadMemory = 256 * 1024 * 1024 # cap on all blocks read ahead, all jobs together
+dropPageCache = False
+dropPageCacheEvery = 64 * 1024 * 1024
+smallFileSize = 64 * 1024 # files up to this size are read in one go, see Hasher.hashSmallFile
+smallBatchSize = 64 # small files handed to a worker at once, with --jobs
+splitJobs = 1 # workers hashing parts of the same file, when all hashes can be combined
+splitThreshold = 256 * 1024 * 1024
+
+useCache = False
+cachePath = None
+cacheMaxSize = 64 * 1024 * 1024
+clearCache = False
+hashCache = None
+serveAddress = None # (host, port) of --serve, see distributeInputs
+workerAddress = None # (host, port) of the coordinator, for --worker
+localWorkers = 0 # worker processes --serve starts on this machine
+protocolVersion = 2
+workerTimeout = 60 # seconds without word from a worker before its job goes to another one
+maxPendingFiles = 1024 # files handed out by the coordinator but not reported yet
+rangeJobSize = 64 * 9728000 # parts of big files given to different workers, in whole ED2K chunks
+resume = False # keep a journal of the run, and continue from it, see RunJournal
+journalPath = None
+runJournal = None
+journalSyncInterval = 5.0 # seconds between two fsyncs of the journal
+resumeCheckpointSize = 64 * 9728000 # bytes between two checkpoints of a big file, in whole ED2K chunks
+timingsPath = None # per-file timings, JSON Lines
+metricsPath = None # counters and histograms, JSON or Prometheus text
+hashStats = None
+watch = False
+findDupes = False
+dupeSampleSize = 64 * 1024 # bytes read at the head and at the tail of each file of --dupes
+chunkIndex = False # write a chunk index next to each file hashed, see ChunkIndexHash
+chunkIndexSize = 9728000 # same chunks as ED2K
+chunkIndexHash = 'sha256'
+chunkIndexExt = '.chunks'
+verifyChunks = False
+verifyRanges = None # [(start, end)] byte ranges --verifychunks reads, end None for the end of the file
+diffChunks = False
+watchInterval = 2.0 # seconds between polls, when there's no inotify
+watchSettle = 0.5 # seconds without events before a burst of them is handled
+preciseTimer = getattr(time, 'perf_counter', time.time)
+cliHasher = None
+
+checkManifests = False
+# Hash type of each checksum file extension. Anything else is guessed from
+# the length of the digests (md4 and ed2k can't be told apart from md5).
+manifestTypes = {'.sfv': 'crc32', '.md4': 'md4', '.md5': 'md5', '.sha1': 'sha1',
+	'.sha256': 'sha256', '.sha512': 'sha512', '.ed2k': 'ed2k', '.b2': 'blake2b',
+	'.blake2b': 'blake2b', '.blake2s': 'blake2s', '.sha3-256': 'sha3_256', '.sha3-512': 'sha3_512'}
+digestLengths = {8: 'crc32', 32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+bsdHashNames = {'CRC32': 'crc32', 'MD4': 'md4', 'MD5': 'md5', 'SHA1': 'sha1', 'SHA256': 'sha256',
+	'SHA512': 'sha512', 'ED2K': 'ed2k', 'BLAKE2B': 'blake2b', 'BLAKE2S': 'blake2s', 'BLAKE2B512': 'blake2b',
+	'BLAKE2S256': 'blake2s', 'SHA3256': 'sha3_256', 'SHA3512': 'sha3_512'} # upper case, without hyphens
+reBsdLine = re.compile(r'^([A-Za-z0-9-]+) ?\((.*)\) = ([0-9A-Fa-f]+)$')
+hexDigits = frozenset('0123456789abcdefABCDEF')
+
+benchmark = False
+benchmarkLarge = False
+benchmarkDir = None
+# (name, file sizes). Files of the same set are hashed together, so the
+# sets with several files also show how --jobs scales.
+benchmarkFileSets = [
+	('tiny', [4 * 1024] * 512),
+	('medium', [32 * 1024 * 1024] * 4),
+	('ed2k', [9728000, 2 * 9728000]),
+]
+benchmarkHashSets = [
+	['crc32'],
+	['crc32', 'md5'],
+	['crc32', 'sha1'],
+	['crc32', 'sha256'],
+	['crc32', 'md5', 'sha1', 'sha256', 'sha512', 'ed2k'],
+	['crc32', 'blake2b', 'blake2s', 'sha3_256', 'sha3_512'],
+	hashNames,
+]
+benchmarkBlockSizes = [256 * 1024, 1024 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024]
+benchmarkReadPaths = ['read', 'readinto', 'mmap', 'prefetch']
 
 debug = False
 fag = []
@@ -78,224 +223,1989 @@ terminalSupportUnicode = False
 # slower (56.497 MiB/s). PyPy gives less but still bad results (85.958 MiB/s).
 # Maybe they implenebted zlib in pure Python?
 # Changed to 2 MiB cache. Slightly better on fast disks.
+# As the best size depends on the disk, the OS cache and the interpreter,
+# --blocksize auto measures the candidates on each device and remembers the winner.
+blockSize = 2 * 1024 * 1024
+autoBlockSize = False
+blockSizeCandidates = [128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024]
+tuneBytes = 16 * 1024 * 1024
+blockSizeTuners = {}
+blockSizeTunersLock = threading.Lock()
+tunedBlockSizes = None
 
 # For ED2K, see http://wiki.anidb.info/w/Ed2k-hash
 # ED2K checked agains rHash (red) and RapidCRC (blue - alternative reference)
 # This program uses red method because it's more common
-def hasher(fileName):
-	fileSize = os.path.getsize(fileName)
-	blockSize = 2 * 1024 * 1024
+# Same interface as hashlib objects, so it can be fed like any other hash.
+class Ed2kHash(object):
+	chunkSize = 9728000
 
-	crc = 0
-	md4 = hashlib.new('md4')
-	md5 = hashlib.md5()
-	sha1 = hashlib.sha1()
-	sha256 = hashlib.sha256()
-	sha512 = hashlib.sha512()
+	def __init__(self):
+		self.chunkHashes = bytearray()
+		self.chunkHash = hashlib.new('md4')
+		self.chunkRemain = self.chunkSize
+		self.size = 0
 
-	ed2kHash = bytearray()
-	ed2kChunkSize = 9728000
-	ed2kChunkHash = hashlib.new('md4')
-	ed2kChunkRemain = ed2kChunkSize
+	def update(self, buffer):
+		buffer = memoryview(buffer) # slices without copying
+		dataLen = len(buffer)
+		self.size += dataLen
+		pos = 0
+		# Finish the current chunk and any whole chunk in this buffer
+		while dataLen - pos >= self.chunkRemain:
+			self.chunkHash.update(hashableBlock(buffer[pos:pos + self.chunkRemain]))
+			self.chunkHashes += self.chunkHash.digest()
+			self.chunkHash = hashlib.new('md4')
+			pos += self.chunkRemain
+			self.chunkRemain = self.chunkSize
+		if pos < dataLen:
+			self.chunkHash.update(hashableBlock(buffer[pos:]))
+			self.chunkRemain -= dataLen - pos
+
+	# Appends the hash of the data that follows. The data hashed so far must
+	# be a whole number of chunks.
+	def combine(self, other):
+		self.chunkHashes += other.chunkHashes
+		self.chunkHash = other.chunkHash
+		self.chunkRemain = other.chunkRemain
+		self.size += other.size
+
+	# What's needed to go on later, as JSON. Only after whole chunks, since
+	# the MD4 of the current chunk can't be saved.
+	def getState(self):
+		return {'chunks': binascii.hexlify(bytes(self.chunkHashes)).decode('ascii'), 'size': self.size}
+
+	def setState(self, state):
+		self.chunkHashes = bytearray(binascii.unhexlify(state['chunks']))
+		self.chunkHash = hashlib.new('md4')
+		self.chunkRemain = self.chunkSize
+		self.size = state['size']
+
+	def hexdigest(self):
+		chunkHashes = bytearray(self.chunkHashes)
+		if self.chunkRemain < self.chunkSize:
+			chunkHashes += self.chunkHash.digest()
+		endHash = hashlib.new('md4')
+		if self.size % self.chunkSize == 0:
+			chunkHashes += endHash.digest()
+		if self.size >= self.chunkSize:
+			endHash.update(chunkHashes)
+			return endHash.hexdigest()
+		elif self.size > 0:
+			return self.chunkHash.hexdigest()
+		else:
+			return endHash.hexdigest()
+
+# zlib.crc32 wrapped in the hashlib interface
+class Crc32Hash(object):
+	def __init__(self):
+		self.crc = 0
+		self.size = 0
+
+	def update(self, buffer):
+		self.crc = zlib.crc32(buffer, self.crc)
+		self.size += len(buffer)
+
+	# Appends the CRC of the data that follows
+	def combine(self, other):
+		self.crc = crc32Combine(self.crc & 0xffffffff, other.crc & 0xffffffff, other.size)
+		self.size += other.size
+
+	def getState(self):
+		return {'crc': self.crc & 0xffffffff, 'size': self.size}
+
+	def setState(self, state):
+		self.crc = state['crc']
+		self.size = state['size']
+
+	# From version 2.6, the return value is in the range [-2**31, 2**31-1],
+	# and from ver 3.0, the return value is unsigned and in the range [0, 2**32-1]
+	# This works on both versions, confirmed by checking over 33 different files
+	def hexdigest(self):
+		crc = self.crc
+		if sys.version_info[0] < 3 and crc < 0:
+			crc += 2 ** 32
+		return '%08X' % crc
+
+# crc32_combine() of zlib, which Python doesn't expose: the CRC-32 of A + B
+# from the CRCs of A and B and the length of B. Appending len2 zero bytes to
+# A is a linear operation on its CRC, done by squaring a 32x32 matrix over
+# GF(2) once per bit of len2.
+def crc32Combine(crc1, crc2, len2):
+	if len2 <= 0:
+		return crc1
+
+	def times(matrix, vector):
+		result = 0
+		i = 0
+		while vector:
+			if vector & 1:
+				result ^= matrix[i]
+			vector >>= 1
+			i += 1
+		return result
+
+	def square(matrix):
+		return [times(matrix, row) for row in matrix]
+
+	odd = [0xEDB88320] + [1 << n for n in range(31)] # one zero bit
+	even = square(odd) # two zero bits
+	odd = square(even) # four zero bits
+	while True:
+		even = square(odd)
+		if len2 & 1:
+			crc1 = times(even, crc1)
+		len2 >>= 1
+		if not len2:
+			break
+		odd = square(even)
+		if len2 & 1:
+			crc1 = times(odd, crc1)
+		len2 >>= 1
+		if not len2:
+			break
+	return crc1 ^ crc2
+
+# crc32c.crc32c (from the crc32c package) wrapped in the hashlib interface
+class Crc32cHash(object):
+	def __init__(self):
+		self.crc = 0
+
+	def update(self, buffer):
+		self.crc = crc32c.crc32c(buffer, self.crc)
+
+	def getState(self):
+		return {'crc': self.crc}
+
+	def setState(self, state):
+		self.crc = state['crc']
+
+	def hexdigest(self):
+		return '%08X' % self.crc
+
+# The ED2K idea with any hashlib hash and chunk size, keeping the hash of
+# every chunk: the digest is the hash of all the chunk hashes, so two files
+# with the same root hash have the same chunks. The chunk hashes tell which
+# parts of a file are damaged or differ (see --chunkindex, --verifychunks).
+class ChunkIndexHash(object):
+	def __init__(self, chunkSize = chunkIndexSize, hashName = chunkIndexHash):
+		self.chunkSize = chunkSize
+		self.hashName = hashName
+		self.chunkHashes = []
+		self.chunkHash = hashlib.new(hashName)
+		self.chunkRemain = chunkSize
+		self.size = 0
+
+	def update(self, buffer):
+		buffer = memoryview(buffer) # slices without copying
+		dataLen = len(buffer)
+		self.size += dataLen
+		pos = 0
+		while dataLen - pos >= self.chunkRemain:
+			self.chunkHash.update(hashableBlock(buffer[pos:pos + self.chunkRemain]))
+			self.chunkHashes.append(self.chunkHash.digest())
+			self.chunkHash = hashlib.new(self.hashName)
+			pos += self.chunkRemain
+			self.chunkRemain = self.chunkSize
+		if pos < dataLen:
+			self.chunkHash.update(hashableBlock(buffer[pos:]))
+			self.chunkRemain -= dataLen - pos
+
+	# Hashes of all chunks, the last one included even if it's short
+	def getChunkHashes(self):
+		if self.chunkRemain < self.chunkSize:
+			return self.chunkHashes + [self.chunkHash.digest()]
+		return list(self.chunkHashes)
+
+	def hexdigest(self):
+		return hashlib.new(self.hashName, b''.join(self.getChunkHashes())).hexdigest()
+
+hashConstructors = {
+	'crc32': Crc32Hash,
+	'md4': lambda: hashlib.new('md4'),
+	'md5': hashlib.md5,
+	'sha1': hashlib.sha1,
+	'sha256': hashlib.sha256,
+	'sha512': hashlib.sha512,
+	'ed2k': Ed2kHash,
+}
+
+# Adds a hash type. constructor returns a new object with update(bytes-like)
+# and hexdigest(), and combine(other) if it can be computed from the hashes
+# of consecutive parts (see Hasher.hashFileSplit), and getState() and
+# setState(state) if its state can be saved as JSON (see
+# Hasher.hashFileResumable). Only the enabled hashes
+# are ever constructed, so registering more costs nothing to the others.
+# name is also the option enabling it, the column in the hash cache and the
+# key in the returned digests.
+def registerHash(name, displayName, constructor):
+	if name not in hashConstructors:
+		hashNames.append(name)
+		hashDisplayNames.append(displayName)
+	hashConstructors[name] = constructor
+
+if hasattr(hashlib, 'blake2b'): # Python 3.6+
+	registerHash('blake2b', 'BLAKE2b', hashlib.blake2b)
+	registerHash('blake2s', 'BLAKE2s', hashlib.blake2s)
+if hasattr(hashlib, 'sha3_256'):
+	registerHash('sha3_256', 'SHA3-256', hashlib.sha3_256)
+	registerHash('sha3_512', 'SHA3-512', hashlib.sha3_512)
+if xxhash is not None:
+	registerHash('xxh64', 'XXH64', xxhash.xxh64)
+	if hasattr(xxhash, 'xxh3_128'):
+		registerHash('xxh3_128', 'XXH3-128', xxhash.xxh3_128)
+if crc32c is not None:
+	registerHash('crc32c', 'CRC-32C', Crc32cHash)
+
+def getErrorText(e):
+	if sys.version_info[0] < 3:
+		return unicode(e)
+	return str(e)
+
+# Python 2's zlib.crc32 doesn't take memoryviews, only str and buffers
+def hashableBlock(block):
+	if sys.version_info[0] < 3 and isinstance(block, memoryview):
+		return block.tobytes()
+	return block
+
+# (fileName, size, digests, error, fromCache) of a file hashed by a HashJob.
+# digests maps hash names to upper case hex digests.
+HashResult = collections.namedtuple('HashResult', 'fileName size digests error fromCache')
+
+# The hashing engine, usable without the command line:
+#
+#   hasher = Hasher(['crc32', 'sha256'], jobs=4)
+#   hasher.hashFile('ep01.mkv')   # {'crc32': 'A3A1001B', 'sha256': '...'}
+#   hasher.hashBuffer(data)
+#   hasher.hashIterable(chunks)
+#
+# All settings are per instance and nothing here reads the command line
+# globals, so any number of hashers can be used in the same process.
+class Hasher(object):
+	def __init__(self, hashes = ('crc32',), blockSize = blockSize, autoBlockSize = False, readPath = 'auto',
+			hashThreads = True, jobs = 1, cache = None, force = False, debug = False, cpuCount = None,
+			readAhead = readAhead, readAheadMemory = readAheadMemory, dropPageCache = False,
+			splitJobs = 1, splitThreshold = splitThreshold, stats = None, chunkIndex = False, chunkIndexSize = chunkIndexSize,
+			journal = None):
+		for name in hashes:
+			if name not in hashConstructors:
+				raise ValueError('Unsupported hash type: %s' % name)
+		if readPath not in readPaths:
+			raise ValueError('Unsupported read path: %s' % readPath)
+		self.hashes = [name for name in hashNames if name in hashes]
+		self.blockSize = blockSize
+		self.autoBlockSize = autoBlockSize
+		self.readPath = readPath
+		self.hashThreads = hashThreads
+		self.jobs = jobs
+		self.cache = cache
+		self.force = force
+		self.debug = debug
+		self.cpuCount = cpuCount or multiprocessing.cpu_count()
+		self.readAhead = max(1, readAhead)
+		self.readAheadBudget = ReadAheadBudget(readAheadMemory)
+		self.dropPageCache = dropPageCache
+		self.splitJobs = splitJobs
+		self.splitThreshold = max(splitThreshold, Ed2kHash.chunkSize)
+		self.stats = stats
+		self.chunkIndex = chunkIndex # also write the file's chunk index, see writeChunkIndex
+		self.chunkIndexSize = chunkIndexSize
+		self.journal = journal # a RunJournal
+
+	# With a timing dict, each hash adds the time it spends to timing[name]
+	def newHashObjects(self, timing = None):
+		if timing is not None:
+			return [(name, TimedHash(name, hashConstructors[name](), timing)) for name in self.hashes]
+		return [(name, hashConstructors[name]()) for name in self.hashes]
+
+	def update(self, blocks, hashObjects, threaded):
+		if threaded:
+			updateThreaded(blocks, [hashObject for name, hashObject in hashObjects])
+		else:
+			updateSequential(blocks, [hashObject for name, hashObject in hashObjects])
+		return dict((name, hashObject.hexdigest().upper()) for name, hashObject in hashObjects)
+
+	def useThreads(self, hashObjects, dataSize, blockSize):
+		return self.hashThreads and self.cpuCount > 1 and len(hashObjects) > 1 and dataSize > blockSize
+
+	# Returns the digests of the file. Raises EnvironmentError if it can't be read.
+	# st is the file's stat result, if the caller already has it.
+	def hashFile(self, fileName, st = None):
+		if st is None:
+			st = os.stat(fileName)
+		if self.stats is None:
+			if st.st_size <= smallFileSize and self.readPath == 'auto' and not self.dropPageCache and not self.chunkIndex:
+				digests = self.hashSmallFile(fileName)
+				if digests is not None:
+					return digests
+			return self.readAndHash(fileName, st, None)
+
+		timing = {}
+		start = preciseTimer()
+		digests = self.readAndHash(fileName, st, timing)
+		self.stats.record(fileName, st, preciseTimer() - start, timing)
+		return digests
+
+	# hashFile, adding the time spent reading and in each hash to timing,
+	# unless it's None. With mmap, reading happens in the hashes.
+	def readAndHash(self, fileName, st, timing):
+		hashObjects = self.newHashObjects(timing)
+		fileSize = st.st_size
+		if self.useSplit(fileSize):
+			if timing is not None:
+				timing['readPath'] = 'split'
+			return self.hashFileSplit(fileName, fileSize, timing)
+		if self.useResume(fileSize):
+			if timing is not None:
+				timing['readPath'] = 'resume'
+			return self.hashFileResumable(fileName, st)
+		chunks = None
+		if self.chunkIndex:
+			chunks = ChunkIndexHash(self.chunkIndexSize)
+			hashObjects.append(('chunks', chunks))
+		size, tuner = self.getBlockSize(fileName, st)
+		try:
+			threaded = self.useThreads(hashObjects, fileSize, size)
+			fd = open(fileName, 'rb')
+			mm = None
+			try:
+				fadvise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+				path = chooseReadPath(self.readPath, fileSize, size, threaded)
+				if path == 'readinto':
+					threaded = False
+				elif path == 'mmap':
+					try:
+						mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+					except (EnvironmentError, ValueError, OverflowError):
+						path = 'read'
+				if tuner is not None and threaded: # it would time handing blocks to the hash threads, not hashing them
+					tuner.lock.release()
+					size, tuner = self.blockSize, None
+				if self.debug:
+					print('Read path: %s%s, block size: %s%s (%s)' % (path, ', threaded' if threaded else '',
+						byteToHumanSize(size), ', tuning' if tuner else '', fileName))
+
+				if path == 'prefetch':
+					# Reused buffers are memoryviews, which Python 2's zlib.crc32 doesn't take
+					reuse = not threaded and sys.version_info[0] >= 3
+					blocks = prefetchBlocks(fd, size, self.readAhead, self.readAheadBudget, reuse)
+				else:
+					blocks = readBlocks(fd, mm, size, path, tuner)
+				if self.dropPageCache:
+					blocks = dropPageCacheBehind(blocks, fd)
+				if timing is not None:
+					timing['readPath'] = path
+					blocks = timeBlocks(blocks, timing)
+				digests = self.update(blocks, hashObjects, threaded)
+			finally:
+				if mm is not None:
+					try:
+						mm.close()
+					except BufferError: # a traceback still holds a block; GC will close it
+						pass
+				fd.close()
+		finally:
+			if tuner is not None:
+				if self.debug and tuner.best:
+					tuner.printResults()
+				tuner.lock.release()
+		if chunks is not None:
+			del digests['chunks']
+			writeChunkIndex(fileName, st, chunks)
+		return digests
+
+	# Fast path for small files: one unbuffered read into the thread's
+	# buffer, then each hash over the whole content, with none of the
+	# machinery of big files (block generator, hash threads, tuner, hints).
+	# Returns None if the file turned out to be bigger than smallFileSize.
+	def hashSmallFile(self, fileName):
+		view = memoryview(getReadBuffer(smallFileSize + 1))[:smallFileSize + 1]
+		length = 0
+		fd = open(fileName, 'rb', 0)
+		try:
+			while length < len(view):
+				dataLen = fd.readinto(view[length:])
+				if not dataLen:
+					break
+				length += dataLen
+		finally:
+			fd.close()
+		if length > smallFileSize: # it grew
+			return None
+
+		data = hashableBlock(view[:length])
+		digests = {}
+		for name in self.hashes:
+			hashObject = hashConstructors[name]()
+			hashObject.update(data)
+			digests[name] = hashObject.hexdigest().upper()
+		return digests
+
+	# Whether a file is big enough to be checkpointed in the journal, and the
+	# state of all enabled hashes can be saved. --split comes first: a file
+	# hashed in parts isn't checkpointed, and is read again from the start
+	# after an interruption.
+	def useResume(self, fileSize):
+		return (self.journal is not None and fileSize > resumeCheckpointSize and not self.chunkIndex and not self.useSplit(fileSize)
+			and all(hasattr(hashConstructors[name], 'getState') for name in self.hashes))
+
+	# hashFile for big files with only hashes whose state can be saved (CRC-32,
+	# ED2K): the file is read resumeCheckpointSize bytes at a time, and the
+	# state of the hashes is saved in the journal after each of them, so that
+	# a run that gets killed goes on from the last checkpoint.
+	def hashFileResumable(self, fileName, st):
+		path = os.path.abspath(fileName)
+		hashObjects = self.newHashObjects()
+		offset = 0
+		partial = self.journal.getPartial(path, st)
+		if partial is not None and all(name in partial[1] for name, hashObject in hashObjects):
+			offset, states = partial
+			for name, hashObject in hashObjects:
+				hashObject.setState(states[name])
+			self.journal.noteResumed(path, offset)
+			if self.debug:
+				print('Resuming at %s (%s)' % (byteToHumanSize(offset), fileName))
 
-	try:
 		fd = open(fileName, 'rb')
-		while True:
-			buffer = fd.read(blockSize)
-			if len(buffer) == 0: # EOF or file empty. return hashes
+		try:
+			fd.seek(offset)
+			fadvise(fd, offset, 0, 'POSIX_FADV_SEQUENTIAL')
+			while offset < st.st_size:
+				length = min(resumeCheckpointSize, st.st_size - offset)
+				blocks = readRangeBlocks(fd, length, self.blockSize)
+				if self.dropPageCache:
+					blocks = dropPageCacheBehind(blocks, fd, offset)
+				updateSequential(blocks, [hashObject for name, hashObject in hashObjects])
+				offset += length
+				if offset < st.st_size:
+					self.journal.checkpoint(path, st, offset, dict((name, hashObject.getState()) for name, hashObject in hashObjects))
+		finally:
+			fd.close()
+		return dict((name, hashObject.hexdigest().upper()) for name, hashObject in hashObjects)
+
+	# Whether a file is big enough to be split between workers, and all
+	# enabled hashes can be combined from the hashes of its parts
+	def useSplit(self, fileSize):
+		return (self.splitJobs > 1 and fileSize >= self.splitThreshold and not self.chunkIndex
+			and all(hasattr(hashConstructors[name], 'combine') for name in self.hashes))
+
+	# hashFile for big files with only combinable hashes (CRC-32, ED2K): the
+	# file is cut in parts of whole ED2K chunks, hashed in splitJobs threads,
+	# each one reading its own parts, then the hashes of the parts are
+	# combined in order. Same digests as hashing the file in one go.
+	def hashFileSplit(self, fileName, fileSize, timing = None):
+		chunkSize = Ed2kHash.chunkSize
+		chunks = (fileSize + chunkSize - 1) // chunkSize
+		partChunks = max(1, (chunks + self.splitJobs * 4 - 1) // (self.splitJobs * 4)) # a few parts per worker, for balance
+		partSize = partChunks * chunkSize
+		parts = [(start, min(partSize, fileSize - start)) for start in range(0, fileSize, partSize)]
+		if self.debug:
+			print('Read path: split in %d parts, %d workers, block size: %s (%s)' % (len(parts), self.splitJobs,
+				byteToHumanSize(self.blockSize), fileName))
+
+		def hashPart(part):
+			start, length = part
+			partTiming = {} if timing is not None else None
+			hashObjects = self.newHashObjects(partTiming)
+			fd = open(fileName, 'rb')
+			try:
+				fd.seek(start)
+				fadvise(fd, start, length, 'POSIX_FADV_SEQUENTIAL')
+				blocks = readRangeBlocks(fd, length, self.blockSize)
+				if self.dropPageCache:
+					blocks = dropPageCacheBehind(blocks, fd, start)
+				if partTiming is not None:
+					blocks = timeBlocks(blocks, partTiming)
+				updateSequential(blocks, [hashObject for name, hashObject in hashObjects])
+			finally:
 				fd.close()
+			return hashObjects, partTiming
+
+		pool = ThreadPool(min(self.splitJobs, len(parts)))
+		try:
+			results = pool.map(hashPart, parts)
+		finally:
+			pool.terminate()
+			pool.join()
+
+		if timing is not None: # total over all parts, so more than the wall time
+			for partObjects, partTiming in results:
+				for phase, seconds in partTiming.items():
+					timing[phase] = timing.get(phase, 0.0) + seconds
+		results = [partObjects for partObjects, partTiming in results]
+		hashObjects = results[0]
+		for partObjects in results[1:]:
+			for (name, hashObject), (partName, partObject) in zip(hashObjects, partObjects):
+				hashObject.combine(partObject)
+		return dict((name, hashObject.hexdigest().upper()) for name, hashObject in hashObjects)
+
+	# Digests of a bytes-like object, read in place
+	def hashBuffer(self, data):
+		hashObjects = self.newHashObjects()
+		view = memoryview(data)
+		if hasattr(view, 'cast') and (view.ndim != 1 or view.itemsize != 1):
+			view = view.cast('B')
+		size = self.blockSize
+		blocks = (hashableBlock(view[pos:pos + size]) for pos in range(0, len(view), size))
+		return self.update(blocks, hashObjects, self.useThreads(hashObjects, len(view), size))
+
+	# Digests of the concatenation of chunks, of any size. Chunks are hashed
+	# as they come, in this thread (the producer might reuse its buffers).
+	def hashIterable(self, chunks):
+		return self.update((chunk for chunk in chunks if len(chunk)), self.newHashObjects(), False)
+
+	# Digests of everything read from a binary file-like object (a pipe,
+	# sys.stdin.buffer, an HTTP response...) until EOF, in bounded memory: one
+	# reused buffer if it has readinto(), else one block at a time.
+	def hashStream(self, fileObject):
+		return self.hashStreamCounted(fileObject)[0]
+
+	# hashStream, also returning the number of bytes read
+	def hashStreamCounted(self, fileObject):
+		counter = [0]
+		digests = self.update(readStreamBlocks(fileObject, self.blockSize, counter), self.newHashObjects(), False)
+		return digests, counter[0]
+
+	# hashFile going through the hash cache, if there is one. With force,
+	# files are always read, but the cache is still updated.
+	# Returns (digests, fromCache).
+	def hashFileCached(self, fileName, st = None):
+		if st is None:
+			st = os.stat(fileName)
+		if self.cache is None and self.journal is None:
+			return self.hashFile(fileName, st), False
+
+		digests = self.lookupDigests(fileName, st)
+		if digests is not None:
+			return digests, True
+		digests = self.hashFile(fileName, st)
+		self.storeDigests(fileName, st, digests)
+		return digests, False
+
+	# The digests of the file from the journal or the hash cache, or None if
+	# it has to be read
+	def lookupDigests(self, fileName, st):
+		path = os.path.abspath(fileName)
+		if self.journal is not None: # hashed before the run was interrupted
+			digests = self.journal.lookup(path, st, self.hashes)
+			if digests is not None:
+				return digests
+		if self.cache is not None and not self.force and not (self.chunkIndex and not isChunkIndexCurrent(fileName, st, self.chunkIndexSize)):
+			try:
+				return self.cache.lookup(path, st, self.hashes)
+			except Exception as e:
+				if self.debug:
+					print('Cache lookup failed: %s' % e)
+		return None
+
+	# Records the digests of a file just read in the journal and the cache
+	def storeDigests(self, fileName, st, digests):
+		path = os.path.abspath(fileName)
+		if self.journal is not None:
+			self.journal.store(path, st, digests)
+		if self.cache is not None:
+			try:
+				self.cache.store(path, st, digests)
+			except Exception as e:
+				if self.debug:
+					print('Cache update failed: %s' % e)
+
+	# Hashing stage for (fileName, fromFolder) items, safe to run in a worker
+	# thread. Items from walkInputs also carry the DirEntry the walker found
+	# the file with, (fileName, fromFolder, entry), whose stat result is
+	# cached, so the file is stat'ed once from listing to hashing.
+	# Never raises: returns (fileName, fromFolder, digests, error, fromCache,
+	# size), with digests = None if the file doesn't exist so that the caller
+	# can report it.
+	def hashJob(self, item):
+		fileName, fromFolder = item[0], item[1]
+		entry = item[2] if len(item) > 2 else None
+		if fileName == stdinName and not fromFolder:
+			return fileName, fromFolder, None, None, False, 0
+		st = statItem(fileName, entry)
+		if st is None:
+			return fileName, fromFolder, None, None, False, 0
+
+		# In Python 2, decode the path to unicode string
+		if sys.version_info[0] < 3 and hasattr(fileName, 'decode'):
+			fileName = fileName.decode(sys.getfilesystemencoding())
+
+		try:
+			digests, fromCache = self.hashFileCached(fileName, st)
+			return fileName, fromFolder, digests, None, fromCache, st.st_size
+		except Exception as e:
+			return fileName, fromFolder, {}, getErrorText(e), False, st.st_size
+
+	# Runs hashJob over items and yields the results in input order.
+	# With more than one job, files are hashed in a pool of threads. zlib and
+	# hashlib release the GIL on large buffers, so threads are enough and they
+	# share the settings for free. imap returns results in input order, so
+	# whoever consumes them sees the same order as with a single job.
+	# With a single job and the prefetch read path, the OS is asked to start
+	# reading the next file while the current one is hashed.
+	def hashItems(self, items):
+		if self.jobs <= 1:
+			if self.readPath != 'prefetch':
+				for item in items:
+					yield self.hashJob(item)
+				return
+			items = iter(items)
+			item = next(items, None)
+			while item is not None:
+				nextItem = next(items, None)
+				if nextItem is not None:
+					self.prefetchHint(nextItem[0])
+				yield self.hashJob(item)
+				item = nextItem
+			return
+
+		pool = ThreadPool(self.jobs)
+		try:
+			for results in imapBounded(pool, self.hashBatch, batchSmallItems(items), self.jobs * poolWindow):
+				for result in results:
+					yield result
+		finally:
+			pool.terminate()
+			pool.join()
+
+	# hashJob for a list of items, in one worker
+	def hashBatch(self, items):
+		return [self.hashJob(item) for item in items]
+
+	# Tells the OS we'll soon read the first blocks of fileName
+	def prefetchHint(self, fileName):
+		if fileName == stdinName:
+			return
+		try:
+			fd = open(fileName, 'rb')
+		except EnvironmentError:
+			return
+		try:
+			fadvise(fd, 0, self.readAhead * self.blockSize, 'POSIX_FADV_WILLNEED')
+		finally:
+			fd.close()
+
+	# Yields function(item) for each item, in order, in jobs threads
+	def mapFiles(self, function, items):
+		if self.jobs <= 1:
+			for item in items:
+				yield function(item)
+			return
+		pool = ThreadPool(self.jobs)
+		try:
+			for result in imapBounded(pool, function, items, self.jobs * poolWindow):
+				yield result
+		finally:
+			pool.terminate()
+			pool.join()
+
+	# Yields (fileName, digests, error) for each file, in order
+	def hashFiles(self, fileNames):
+		for fileName, fromFolder, digests, error, fromCache, size in self.hashItems((fileName, False) for fileName in fileNames):
+			if digests is None:
+				digests, error = {}, 'Not found or invalid!'
+			yield fileName, digests, error
+
+	# The tuple of the original hasher(): CRC-32 as an int, the other digests
+	# ('' if not enabled), then the error or False
+	def hasher(self, fileName):
+		try:
+			digests = self.hashFile(fileName)
+		except Exception as e:
+			return 0, '', '', '', '', '', '', getErrorText(e)
+		return (int(digests.get('crc32', '0'), 16),) + tuple(digests.get(name, '') for name in legacyHashNames[1:]) + (False,)
+
+	# Returns the block size for this file, and the tuner if this file is used
+	# to measure the candidates (then the caller must release tuner.lock).
+	# Only one file per device is measured at a time, and only files big enough
+	# for the largest candidate; the others use the current default meanwhile.
+	def getBlockSize(self, fileName, st):
+		if not self.autoBlockSize:
+			return self.blockSize, None
+		tuner = getBlockSizeTuner(fileName, st.st_dev)
+		if tuner.best:
+			return tuner.best, None
+		largest = blockSizeCandidates[-1]
+		if st.st_size > largest and tuner.lock.acquire(False):
+			if not tuner.best:
+				return largest, tuner
+			tuner.lock.release()
+			return tuner.best, None
+		return self.blockSize, None
 
-				if ed2kChunkRemain < ed2kChunkSize:
-					ed2kHash += ed2kChunkHash.digest()
-				ed2kEndHash = hashlib.new('md4')
-				if (fileSize % ed2kChunkSize == 0):
-					ed2kHash += ed2kEndHash.digest()
-				if fileSize >= ed2kChunkSize:
-					ed2kEndHash.update(ed2kHash)
-					ed2kHash = ed2kEndHash.hexdigest()
-				elif fileSize > 0:
-					ed2kHash = ed2kChunkHash.hexdigest()
+# A batch of inputs (files, folders, patterns) hashed by a Hasher, with its
+# own results and stats:
+#
+#   job = HashJob(['/srv/upload', '/srv/new/*.mkv'], Hasher(['crc32', 'md5'], jobs=4), recursive=True)
+#   for result in job:   # HashResult, as soon as each file is done
+#       ...
+#   job.total, job.ok, job.errors, job.notFound, job.cached, job.size
+#
+# run() does the same and returns the list of results.
+class HashJob(object):
+	def __init__(self, inputs, hasher = None, recursive = False, searchSubFolder = False, include = (), exclude = ()):
+		self.inputs = list(inputs)
+		self.hasher = hasher or Hasher()
+		self.recursive = recursive
+		self.searchSubFolder = searchSubFolder
+		self.nameFilter = NameFilter(include, exclude) if include or exclude else None
+		self.results = []
+		self.total = 0
+		self.ok = 0
+		self.errors = 0
+		self.notFound = 0
+		self.cached = 0
+		self.size = 0
+		self.elapsed = 0.0
+
+	def __iter__(self):
+		startTime = defaultTimer()
+		try:
+			items = walkInputs(self.inputs, self.recursive, self.searchSubFolder, self.nameFilter)
+			for fileName, fromFolder, digests, error, fromCache, size in self.hasher.hashItems(items):
+				self.total += 1
+				if digests is None:
+					digests, error = {}, 'Not found or invalid!'
+					self.notFound += 1
+				elif error:
+					self.errors += 1
 				else:
-					ed2kHash = ed2kEndHash.hexdigest()
-
-				if sys.version_info[0] < 3 and crc < 0:
-					crc += 2 ** 32
-				return crc, md4.hexdigest().upper(), md5.hexdigest().upper(), sha1.hexdigest().upper(), sha256.hexdigest().upper(), sha512.hexdigest().upper(), ed2kHash.upper(), False
-
-			if enableCrc: crc = zlib.crc32(buffer, crc)
-			if enableMd4: md4.update(buffer)
-			if enableMd5: md5.update(buffer)
-			if enableSha1: sha1.update(buffer)
-			if enableSha256: sha256.update(buffer)
-			if enableSha512: sha512.update(buffer)
-
-			if enableEd2k:
-				dataLen = len(buffer)
-				if dataLen < ed2kChunkRemain:
-					ed2kChunkHash.update(buffer)
-					ed2kChunkRemain -= dataLen
-				elif dataLen == ed2kChunkRemain:
-					ed2kChunkHash.update(buffer)
-					ed2kHash += ed2kChunkHash.digest()
-					ed2kChunkRemain = ed2kChunkSize
-					ed2kChunkHash = hashlib.new('md4')
+					self.ok += 1
+					if fromCache:
+						self.cached += 1
+					else:
+						self.size += size
+				result = HashResult(fileName, size, digests, error, fromCache)
+				self.results.append(result)
+				yield result
+		finally:
+			self.elapsed += defaultTimer() - startTime
+
+	def run(self):
+		for result in self:
+			pass
+		return self.results
+
+# Measures the throughput (read + hash) of each candidate block size on the
+# first tuneBytes bytes read from a device, then settles on the fastest one
+class BlockSizeTuner(object):
+	def __init__(self, device, best = None):
+		self.device = device
+		self.best = best
+		self.lock = threading.Lock()
+		self.results = {}
+		self.candidate = 0
+
+	def nextSize(self):
+		if self.best:
+			return self.best
+		return blockSizeCandidates[self.candidate]
+
+	def record(self, size, dataLen, seconds):
+		if self.best:
+			return
+		result = self.results.setdefault(size, [0, 0.0])
+		result[0] += dataLen
+		result[1] += seconds
+		if result[0] >= tuneBytes:
+			self.candidate += 1
+			if self.candidate == len(blockSizeCandidates):
+				self.best = max(self.results, key=lambda size: self.results[size][0] / max(self.results[size][1], 1e-9))
+				saveTunedBlockSize(self.device, self.best)
+
+	def printResults(self):
+		for size in sorted(self.results):
+			nbytes, seconds = self.results[size]
+			print('Block size %s: %s/s' % (byteToHumanSize(size), byteToHumanSize(nbytes / max(seconds, 1e-9))))
+		print('Using %s blocks on %s' % (byteToHumanSize(self.best), self.device))
+
+# Tuners are per device (st_dev) for this run; the tuned sizes are saved per
+# mount point, which unlike st_dev stays the same from one boot to the next
+def getBlockSizeTuner(fileName, device):
+	global tunedBlockSizes
+	with blockSizeTunersLock:
+		tuner = blockSizeTuners.get(device)
+		if tuner is None:
+			if tunedBlockSizes is None:
+				tunedBlockSizes = loadTunedBlockSizes()
+			mountPoint = getMountPoint(fileName)
+			tuner = BlockSizeTuner(mountPoint, tunedBlockSizes.get(mountPoint))
+			blockSizeTuners[device] = tuner
+		return tuner
+
+def getMountPoint(path):
+	path = os.path.realpath(path)
+	while not os.path.ismount(path):
+		parent = os.path.dirname(path)
+		if parent == path:
+			break
+		path = parent
+	return path
+
+def getBlockSizesPath():
+	return os.path.join(getCacheDir(), 'blocksizes.json')
+
+def loadTunedBlockSizes():
+	try:
+		fd = open(getBlockSizesPath(), 'r')
+		try:
+			sizes = json.load(fd)
+		finally:
+			fd.close()
+		return dict((mountPoint, int(size)) for mountPoint, size in sizes.items()
+			if int(size) in blockSizeCandidates)
+	except (EnvironmentError, ValueError, AttributeError):
+		return {}
+
+def saveTunedBlockSize(mountPoint, size):
+	with blockSizeTunersLock:
+		tunedBlockSizes[mountPoint] = size
+		try:
+			folder = getCacheDir()
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			fd = open(getBlockSizesPath(), 'w')
+			try:
+				json.dump(tunedBlockSizes, fd, indent=1, sort_keys=True)
+			finally:
+				fd.close()
+		except EnvironmentError as e:
+			if debug:
+				print("Couldn't save tuned block size: %s" % e)
+
+# Picks how hasher() reads a file:
+#  - read: plain fd.read(). A single allocation for files that fit in one block.
+#  - readinto: one reused buffer per thread, blocks are memoryview slices of it.
+#    No allocation nor copy per block, but a block is only valid until the next one
+#    is read, so it can't be used when blocks are shared with hash threads.
+#  - mmap: blocks are memoryview slices of the mapped file. No copy to user space
+#    at all, and blocks stay valid until the map is closed.
+# 32-bit builds don't have the address space to map big files. Python 2's
+# zlib.crc32 doesn't take memoryviews, so there blocks would be copied anyway.
+def chooseReadPath(readPath, fileSize, blockSize, threaded):
+	if readPath == 'prefetch' and fileSize <= blockSize:
+		return 'read' # nothing to read ahead
+	if readPath != 'auto':
+		return readPath
+	if fileSize <= blockSize or sys.version_info[0] < 3:
+		return 'read'
+	canMmap = sys.maxsize > 2 ** 32 or fileSize < 256 * 1024 * 1024
+	if threaded:
+		return 'mmap' if canMmap else 'read'
+	if fileSize >= mmapThreshold and canMmap:
+		return 'mmap'
+	return 'readinto'
+
+# Yields the content of the file as blocks of blockSize bytes, or of the
+# sizes the tuner asks for while it is measuring them. The tuner times each
+# block until the next one is asked for, so it's only used when the blocks
+# are hashed in this thread.
+def readBlocks(fd, mm, blockSize, path, tuner = None):
+	if path == 'mmap':
+		view = memoryview(mm)
+		pos = 0
+	elif path == 'readinto':
+		view = memoryview(getReadBuffer(blockSize))
+		blockView = view[:blockSize]
+
+	size = blockSize
+	while True:
+		if tuner is not None:
+			size = tuner.nextSize()
+			start = defaultTimer()
+
+		if path == 'mmap':
+			block = view[pos:pos + size]
+			pos += len(block)
+		elif path == 'readinto':
+			if len(blockView) != size:
+				blockView = view[:size]
+			dataLen = fd.readinto(blockView)
+			block = blockView if dataLen == size else blockView[:dataLen]
+		else:
+			block = fd.read(size)
+		if len(block) == 0: # EOF or file empty
+			break
+
+		yield hashableBlock(block)
+
+		if tuner is not None: # block has been hashed by now (updateSequential)
+			tuner.record(size, len(block), defaultTimer() - start)
+
+	if path == 'mmap':
+		view.release()
+
+# Limits the memory held by blocks read ahead, across all the files being
+# hashed at the same time. A reader always gets at least one block, even if
+# it's bigger than the limit, so that it can't get stuck.
+class ReadAheadBudget(object):
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.used = 0
+		self.condition = threading.Condition()
+
+	# Waits for size bytes of room. Returns False if stop got set meanwhile.
+	def acquire(self, size, stop):
+		with self.condition:
+			while self.used and self.used + size > self.maxBytes:
+				if stop.is_set():
+					return False
+				self.condition.wait(0.1)
+			self.used += size
+			return True
+
+	def release(self, size):
+		with self.condition:
+			self.used -= size
+			self.condition.notify_all()
+
+# Blocks of the file, read by another thread up to depth blocks ahead of
+# the hashes, so that the disk works while the CPU hashes and the other way
+# around. Each block is counted in the budget from the moment it's read
+# until it has been handed to the hashes. With reuse, blocks are views of
+# buffers that are read into again once hashed, so the hashes must be done
+# with a block when they ask for the next one (not so with updateThreaded,
+# where blocks are new bytes objects).
+def prefetchBlocks(fd, blockSize, depth, budget, reuse = False):
+	blockQueue = queue.Queue(depth)
+	stop = threading.Event()
+	freeBuffers = collections.deque() # hashed, ready to be read into again
+
+	def readBlock():
+		if not reuse:
+			return fd.read(blockSize)
+		buffer = freeBuffers.pop() if freeBuffers else bytearray(blockSize)
+		return memoryview(buffer)[:fd.readinto(buffer)]
+
+	def read():
+		try:
+			while not stop.is_set():
+				if not budget.acquire(blockSize, stop):
+					return
+				try:
+					block = readBlock()
+				except Exception:
+					budget.release(blockSize)
+					raise
+				if not len(block):
+					budget.release(blockSize)
+					blockQueue.put(None)
+					return
+				while not stop.is_set():
+					try:
+						blockQueue.put(block, timeout=0.1)
+						break
+					except queue.Full:
+						pass
 				else:
-					ed2kChunkHash.update(buffer[0:ed2kChunkRemain])
-					ed2kHash += ed2kChunkHash.digest()
-					ed2kChunkHash = hashlib.new('md4')
-					dataRemain = dataLen - ed2kChunkRemain
-					chunkHashRepeat = int(math.floor(dataRemain / ed2kChunkSize))
-					for i in range(chunkHashRepeat):
-						ed2kChunkHash.update(buffer[ed2kChunkRemain + i * ed2kChunkSize : ed2kChunkRemain + i * ed2kChunkSize + ed2kChunkSize])
-						ed2kHash += ed2kChunkHash.digest()
-						ed2kChunkHash = hashlib.new('md4')
-						hashCount += 1
-					dataRemain = dataRemain - chunkHashRepeat * ed2kChunkSize
-					ed2kChunkHash.update(buffer[-dataRemain:])
-					ed2kChunkRemain = ed2kChunkSize - dataRemain
+					budget.release(blockSize)
+		except Exception as e:
+			blockQueue.put(e)
 
-	except Exception as e:
-		if sys.version_info[0] < 3:
-			error = unicode(e)
+	thread = threading.Thread(target=read)
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			block = blockQueue.get()
+			if block is None:
+				break
+			if isinstance(block, Exception):
+				raise block
+			try:
+				yield block
+			finally:
+				if reuse:
+					freeBuffers.append(block.obj)
+				block = None
+				budget.release(blockSize)
+	finally:
+		stop.set()
+		while True: # release the blocks nobody will hash
+			try:
+				block = blockQueue.get_nowait()
+			except queue.Empty:
+				if not thread.is_alive():
+					break
+				thread.join(0.1)
+				continue
+			if block is not None and not isinstance(block, Exception):
+				budget.release(blockSize)
+		thread.join()
+
+# Tells the OS to drop the file's pages from its cache once hashed, every
+# dropPageCacheEvery bytes, so that a run over terabytes doesn't push
+# everything else out of the page cache
+def dropPageCacheBehind(blocks, fd, start = 0):
+	done = start
+	dropped = start
+	for block in blocks:
+		done += len(block)
+		yield block
+		if done - dropped >= dropPageCacheEvery:
+			fadvise(fd, dropped, done - dropped, 'POSIX_FADV_DONTNEED')
+			dropped = done
+	if done > dropped:
+		fadvise(fd, dropped, done - dropped, 'POSIX_FADV_DONTNEED')
+
+# A hash object that adds the time spent in update() to timing[name]
+class TimedHash(object):
+	def __init__(self, name, hashObject, timing):
+		self.name = name
+		self.hashObject = hashObject
+		self.timing = timing
+		timing.setdefault(name, 0.0)
+
+	def update(self, buffer):
+		start = preciseTimer()
+		self.hashObject.update(buffer)
+		self.timing[self.name] += preciseTimer() - start
+
+	def hexdigest(self):
+		return self.hashObject.hexdigest()
+
+	def combine(self, other):
+		self.hashObject.combine(other.hashObject)
+
+# Passes blocks through, adding the time spent getting each to timing['read']
+def timeBlocks(blocks, timing):
+	timing.setdefault('read', 0.0)
+	iterator = iter(blocks)
+	try:
+		while True:
+			start = preciseTimer()
+			block = next(iterator, None)
+			timing['read'] += preciseTimer() - start
+			if block is None:
+				break
+			yield block
+	finally:
+		if hasattr(iterator, 'close'):
+			iterator.close()
+
+# Instrumentation of a run: counters, histograms of file sizes and times,
+# totals per mount point, and optionally one JSON line per file hashed with
+# its size, wall time, time spent reading and in each hash, read path and
+# worker thread. Shared by all workers, hence the lock.
+class HashStats(object):
+	secondsBuckets = [0.001, 0.01, 0.1, 1, 10, 60, 600]
+	sizeBuckets = [4096, 65536, 1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2, 4 * 1024 ** 3, 64 * 1024 ** 3]
+
+	def __init__(self, timingsPath = None):
+		self.lock = threading.Lock()
+		self.files = 0
+		self.bytes = 0
+		self.wall = 0.0
+		self.phases = {}
+		self.fileSeconds = [0] * (len(self.secondsBuckets) + 1)
+		self.fileSizes = [0] * (len(self.sizeBuckets) + 1)
+		self.mounts = {}
+		self.mountPoints = {}
+		self.timingsFile = open(timingsPath, 'wb') if timingsPath else None
+
+	def record(self, fileName, st, wall, timing):
+		mountPoint = self.mountPoints.get(st.st_dev)
+		if mountPoint is None:
+			mountPoint = self.mountPoints[st.st_dev] = getMountPoint(fileName)
+		readPath = timing.pop('readPath', None)
+		with self.lock:
+			self.files += 1
+			self.bytes += st.st_size
+			self.wall += wall
+			for phase, seconds in timing.items():
+				self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+			self.fileSeconds[bucketIndex(self.secondsBuckets, wall)] += 1
+			self.fileSizes[bucketIndex(self.sizeBuckets, st.st_size)] += 1
+			mount = self.mounts.setdefault(mountPoint, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+			mount['files'] += 1
+			mount['bytes'] += st.st_size
+			mount['seconds'] += wall
+			if self.timingsFile is not None:
+				entry = collections.OrderedDict([('file', fileName), ('bytes', st.st_size), ('wall', round(wall, 6)),
+					('readPath', readPath), ('worker', threading.current_thread().name), ('mount', mountPoint)])
+				for phase in ['read'] + hashNames:
+					if phase in timing:
+						entry[phase] = round(timing[phase], 6)
+				self.timingsFile.write(encodeUtf8(json.dumps(entry, ensure_ascii=False) + '\n'))
+
+	def toDict(self):
+		with self.lock:
+			return {
+				'files': self.files,
+				'bytes': self.bytes,
+				'seconds': round(self.wall, 6),
+				'phaseSeconds': dict((phase, round(seconds, 6)) for phase, seconds in self.phases.items()),
+				'fileSeconds': {'buckets': self.secondsBuckets, 'counts': list(self.fileSeconds)},
+				'fileBytes': {'buckets': self.sizeBuckets, 'counts': list(self.fileSizes)},
+				'mounts': dict((path, {'files': mount['files'], 'bytes': mount['bytes'], 'seconds': round(mount['seconds'], 6)})
+					for path, mount in self.mounts.items()),
+			}
+
+	# Prometheus text exposition format
+	def toPrometheus(self):
+		stats = self.toDict()
+		prefix = 'crc32_hasher_'
+		lines = []
+
+		def metric(name, kind, help, samples):
+			lines.append('# HELP %s%s %s' % (prefix, name, help))
+			lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+			for labels, value in samples:
+				lines.append('%s%s%s %s' % (prefix, name, labels, value))
+
+		def histogram(name, help, buckets, counts, total):
+			samples = []
+			cumulative = 0
+			for bound, count in zip(buckets + ['+Inf'], counts):
+				cumulative += count
+				samples.append(('_bucket{le="%s"}' % bound, cumulative))
+			samples.append(('_sum', total))
+			samples.append(('_count', cumulative))
+			lines.append('# HELP %s%s %s' % (prefix, name, help))
+			lines.append('# TYPE %s%s histogram' % (prefix, name))
+			for suffix, value in samples:
+				lines.append('%s%s%s %s' % (prefix, name, suffix, value))
+
+		def label(value):
+			return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+		metric('files_total', 'counter', 'Files hashed.', [('', stats['files'])])
+		metric('bytes_total', 'counter', 'Bytes hashed.', [('', stats['bytes'])])
+		metric('phase_seconds_total', 'counter', 'Time spent reading and in each hash.',
+			[('{phase="%s"}' % phase, seconds) for phase, seconds in sorted(stats['phaseSeconds'].items())])
+		metric('mount_bytes_total', 'counter', 'Bytes hashed per mount point.',
+			[('{mount="%s"}' % label(path), mount['bytes']) for path, mount in sorted(stats['mounts'].items())])
+		metric('mount_seconds_total', 'counter', 'Time spent hashing files per mount point.',
+			[('{mount="%s"}' % label(path), mount['seconds']) for path, mount in sorted(stats['mounts'].items())])
+		histogram('file_seconds', 'Time to hash a file.', stats['fileSeconds']['buckets'],
+			stats['fileSeconds']['counts'], stats['seconds'])
+		histogram('file_bytes', 'Size of the files hashed.', stats['fileBytes']['buckets'],
+			stats['fileBytes']['counts'], stats['bytes'])
+		return '\n'.join(lines) + '\n'
+
+	# Writes the counters to path, as JSON if it ends with .json, else in
+	# the Prometheus text format (e.g. for node_exporter's textfile collector)
+	def export(self, path):
+		if path.lower().endswith('.json'):
+			text = json.dumps(self.toDict(), indent=2, sort_keys=True) + '\n'
 		else:
-			error = str(e)
-		return 0, '', '', '', '', '', '', error
+			text = self.toPrometheus()
+		fd = open(path, 'wb')
+		try:
+			fd.write(encodeUtf8(text))
+		finally:
+			fd.close()
+
+	def close(self):
+		if self.timingsFile is not None:
+			self.timingsFile.close()
+			self.timingsFile = None
+
+# Index of the histogram bucket of value (the last one is +Inf)
+def bucketIndex(buckets, value):
+	for i, bound in enumerate(buckets):
+		if value <= bound:
+			return i
+	return len(buckets)
+
+# posix_fadvise(), where there is one. It's only a hint, so errors are ignored.
+def fadvise(fd, offset, length, advice):
+	if not hasattr(os, 'posix_fadvise'):
+		return
+	try:
+		os.posix_fadvise(fd.fileno(), offset, length, getattr(os, advice))
+	except (EnvironmentError, AttributeError):
+		pass
+
+# The next length bytes of the file, in blocks read into the thread's buffer
+def readRangeBlocks(fd, length, blockSize):
+	view = memoryview(getReadBuffer(blockSize))[:blockSize]
+	while length > 0:
+		blockView = view if length >= blockSize else view[:length]
+		dataLen = fd.readinto(blockView)
+		if not dataLen: # file got shorter
+			break
+		length -= dataLen
+		yield hashableBlock(blockView if dataLen == len(blockView) else blockView[:dataLen])
+
+# Blocks of a stream, in whatever sizes it returns them (pipes often return
+# less than asked). counter[0] is the number of bytes read so far.
+def readStreamBlocks(fileObject, blockSize, counter):
+	if hasattr(fileObject, 'readinto'):
+		view = memoryview(getReadBuffer(blockSize))[:blockSize]
+		while True:
+			dataLen = fileObject.readinto(view)
+			if not dataLen: # EOF
+				break
+			counter[0] += dataLen
+			yield hashableBlock(view if dataLen == blockSize else view[:dataLen])
+	else:
+		while True:
+			block = fileObject.read(blockSize)
+			if not block:
+				break
+			counter[0] += len(block)
+			yield block
+
+# The readinto buffer of the current thread, grown when needed
+def getReadBuffer(size):
+	buffer = getattr(readBuffers, 'buffer', None)
+	if buffer is None or len(buffer) < size:
+		buffer = bytearray(size)
+		readBuffers.buffer = buffer
+	return buffer
+
+def updateSequential(blocks, hashObjects):
+	updates = [hashObject.update for hashObject in hashObjects]
+	if len(updates) == 1:
+		update = updates[0]
+		for buffer in blocks:
+			update(buffer)
+		return
+	for buffer in blocks:
+		for update in updates:
+			update(buffer)
+
+# One thread per hash type, fed by the calling thread which only reads.
+# zlib and hashlib release the GIL on large buffers, so a file takes about as
+# long as its slowest hash instead of the sum of all of them.
+# Blocks are never modified once read (no readinto here), so all hash threads
+# share the same object; the queues are bounded so a slow hash can't make us
+# buffer the whole file.
+def updateThreaded(blocks, hashObjects):
+	errors = []
+
+	def consume(hashObject, blockQueue):
+		while True:
+			buffer = blockQueue.get()
+			if buffer is None:
+				return
+			if not errors:
+				try:
+					hashObject.update(buffer)
+				except Exception as e:
+					errors.append(e)
+
+	queues = []
+	threads = []
+	for hashObject in hashObjects:
+		blockQueue = queue.Queue(hashQueueDepth)
+		thread = threading.Thread(target=consume, args=(hashObject, blockQueue))
+		thread.daemon = True
+		thread.start()
+		queues.append(blockQueue)
+		threads.append(thread)
+
+	try:
+		for buffer in blocks:
+			if errors:
+				break
+			for blockQueue in queues:
+				blockQueue.put(buffer)
+	finally:
+		for blockQueue in queues:
+			blockQueue.put(None)
+		for thread in threads:
+			thread.join()
+
+	if errors:
+		raise errors[0]
+
+# hasher() and hasher_s() of the old script, with the command line settings
+def hasher(fileName):
+	return getCliHasher().hasher(fileName)
 
-# From version 2.6, the return value is in the range [-2**31, 2**31-1],
-# and from ver 3.0, the return value is unsigned and in the range [0, 2**32-1]
-# This works on both versions, confirmed by checking over 33 different files
 def hasher_s(fileName):
 	iHash, md4, md5, sha1, sha256, sha512, ed2k, error = hasher(fileName)
-	if sys.version_info[0] < 3 and iHash < 0:
-		iHash += 2 ** 32
 	sHash = '%08X' % iHash
 	return sHash, md4, md5, sha1, sha256, sha512, ed2k, error
 
-# In-used CRC-32 pattern: 8 characters of hexadecimal, separated from the rest
-# by some certain "special" characters. It's usually at the end of file name,
-# so just take the last one; there shouldn't more than one anyway.
-def detectCRC(fileName):
-	crc = ""
-	found = False
-	reCRC = re.compile(r'[A-Fa-f0-9]{8}')
-	separator1 = "([_. "
-	separator2 = ")]_. "
-	for match in reCRC.finditer(fileName):
-		start = match.start()
-		end = match.end()
-		if ((start == 0 or fileName[start - 1] in separator1)
-			and (end == len(fileName) or fileName[end + 1] in separator2)):
-			crc = fileName[start:end]
-			found = True
-	return found, crc
-
-def processFile(fileName, fromFolder = False):
-	# Not gonna trust the caller completely
-	if not os.path.isfile(fileName):
+# A Hasher with the settings from the command line
+def makeHasher():
+	names = getEnabledHashes()
+	return Hasher(names, blockSize=blockSize, autoBlockSize=autoBlockSize, readPath=readPath, hashThreads=hashThreads,
+		jobs=jobs, cache=hashCache, force=force, debug=debug, cpuCount=cpuCount,
+		readAhead=readAhead, readAheadMemory=readAheadMemory, dropPageCache=dropPageCache, splitJobs=splitJobs,
+		stats=hashStats, chunkIndex=chunkIndex, chunkIndexSize=chunkIndexSize, journal=runJournal)
+
+def getCliHasher():
+	if cliHasher is None:
+		return makeHasher()
+	return cliHasher
+
+# Where the hash cache and other persistent data are kept
+def getCacheDir():
+	if sys.platform == 'win32':
+		base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+	else:
+		base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'python_crc32_hasher')
+
+# On-disk cache of hashes, so unchanged files don't have to be read again.
+# Entries are keyed by absolute path and only used while the file's size,
+# mtime and inode are the same as when it was hashed. Digests of hash types
+# that weren't enabled at that time are NULL, and get filled in later.
+# Shared by all worker threads, hence the lock.
+class HashCache(object):
+	columns = hashNames
+	commitEvery = 256
+
+	def __init__(self, path):
+		folder = os.path.dirname(path)
+		if folder and not os.path.isdir(folder):
+			os.makedirs(folder)
+		self.path = path
+		self.lock = threading.Lock()
+		self.pending = 0
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+			'inode INTEGER, %s, used REAL)' % ', '.join('%s TEXT' % c for c in self.columns))
+		# hashes registered since the cache was created
+		existing = set(row[1] for row in self.db.execute('PRAGMA table_info(hashes)'))
+		for column in self.columns:
+			if column not in existing:
+				self.db.execute('ALTER TABLE hashes ADD COLUMN %s TEXT' % column)
+		self.db.commit()
+
+	@staticmethod
+	def signature(st):
+		mtime = getattr(st, 'st_mtime_ns', None)
+		if mtime is None:
+			mtime = int(st.st_mtime * 1000000000)
+		return st.st_size, mtime, st.st_ino
+
+	def read(self, path):
+		with self.lock:
+			return self.db.execute('SELECT size, mtime, inode, %s FROM hashes WHERE path = ?' % ', '.join(self.columns), (path,)).fetchone()
+
+	def write(self, sql, params):
+		with self.lock:
+			self.db.execute(sql, params)
+			self.pending += 1
+			if self.pending >= self.commitEvery:
+				self.db.commit()
+				self.pending = 0
+
+	# Returns {hashName: digest} for the hashes asked for, or None if any is missing
+	def lookup(self, path, st, hashes):
+		row = self.read(path)
+		if row is None or tuple(row[:3]) != self.signature(st):
+			return None
+		cached = dict(zip(self.columns, row[3:]))
+		digests = {}
+		for name in hashes:
+			if not cached.get(name):
+				return None
+			digests[name] = cached[name]
+		self.write('UPDATE hashes SET used = ? WHERE path = ?', (time.time(), path))
+		return digests
+
+	def store(self, path, st, digests):
+		signature = self.signature(st)
+		values = [digests.get(name) for name in self.columns]
+		row = self.read(path)
+		if row is not None and tuple(row[:3]) == signature:
+			values = [new or old for new, old in zip(values, row[3:])]
+		self.write('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, %s, ?)' % ', '.join('?' * len(self.columns)),
+			(path,) + signature + tuple(values) + (time.time(),))
+
+	def clear(self):
+		with self.lock:
+			self.db.execute('DELETE FROM hashes')
+			self.db.commit()
+			self.pending = 0
+			self.db.execute('VACUUM')
+
+	# Drops the least recently used entries until the file fits in maxSize
+	def evict(self, maxSize):
+		with self.lock:
+			self.db.commit()
+			pageCount = self.db.execute('PRAGMA page_count').fetchone()[0]
+			pageSize = self.db.execute('PRAGMA page_size').fetchone()[0]
+			size = pageCount * pageSize
+			if size <= maxSize:
+				return
+			rows = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+			keep = int(rows * 0.9 * maxSize / size)
+			self.db.execute('DELETE FROM hashes WHERE path NOT IN (SELECT path FROM hashes ORDER BY used DESC LIMIT ?)', (keep,))
+			self.db.commit()
+			self.db.execute('VACUUM')
+
+	def commit(self):
+		with self.lock:
+			self.db.commit()
+			self.pending = 0
+
+	def close(self):
+		with self.lock:
+			self.db.commit()
+			self.db.close()
+
+def getEnabledFlags():
+	return enableCrc, enableMd4, enableMd5, enableSha1, enableSha256, enableSha512, enableEd2k
+
+def getEnabledHashes():
+	return [name for name, on in zip(legacyHashNames, getEnabledFlags()) if on] + [name for name in hashNames if name in enabledHashes]
+
+# Enables a hash by name, from the command line or because a checksum file needs it
+def enableHash(name):
+	global enableCrc, enableMd4, enableMd5, enableSha1, enableSha256, enableSha512, enableEd2k
+	if name == 'crc32':
+		enableCrc = True
+	elif name == 'md4':
+		enableMd4 = True
+	elif name == 'md5':
+		enableMd5 = True
+	elif name == 'sha1':
+		enableSha1 = True
+	elif name == 'sha256':
+		enableSha256 = True
+	elif name == 'sha512':
+		enableSha512 = True
+	elif name == 'ed2k':
+		enableEd2k = True
+	elif name in hashConstructors and name not in enabledHashes:
+		enabledHashes.append(name)
+
+# The registered hash an option names, e.g. sha3-256 or sha3_256, None if none
+def getHashOption(arg):
+	name = arg.replace('-', '_')
+	if name in hashConstructors:
+		return name
+	return None
+
+def openCache():
+	global hashCache, cachePath
+	if not (useCache or clearCache):
+		return
+	if sqlite3 is None:
+		print("Hash cache isn't available: this Python has no sqlite3 module.")
+		return
+	if cachePath is None:
+		cachePath = os.path.join(getCacheDir(), 'hashes.sqlite')
+	try:
+		hashCache = HashCache(cachePath)
+		if clearCache:
+			hashCache.clear()
+			print('Hash cache cleared.')
+	except Exception as e:
+		print("Couldn't open hash cache \"%s\": %s" % (cachePath, e))
+		hashCache = None
+		return
+	if not useCache:
+		closeCache()
+
+def openStats():
+	global hashStats
+	if not (timingsPath or metricsPath):
+		return
+	try:
+		hashStats = HashStats(timingsPath)
+	except EnvironmentError as e:
+		print("Couldn't open \"%s\" for writing: %s" % (timingsPath, e))
+		hashStats = HashStats()
+
+def closeStats():
+	global hashStats
+	if hashStats is None:
+		return
+	try:
+		hashStats.close()
+		if metricsPath:
+			hashStats.export(metricsPath)
+	except EnvironmentError as e:
+		print("Couldn't write timings: %s" % e)
+	hashStats = None
+
+def closeCache():
+	global hashCache
+	if hashCache is None:
+		return
+	try:
+		hashCache.evict(cacheMaxSize)
+		hashCache.close()
+	except Exception as e:
+		print("Couldn't save hash cache \"%s\": %s" % (cachePath, e))
+	hashCache = None
+
+# Journal of a run of --resume, JSON Lines: a header with the inputs and
+# options of the run, then a line for each file hashed, with its digests,
+# and for big files a line at each checkpoint, with the state of the hashes
+# (see Hasher.hashFileResumable). Lines are flushed as they're written and
+# synced every journalSyncInterval seconds, so a killed run loses little.
+# When the journal of the same run is found, files it has are taken from it
+# as long as their size, mtime and inode are the same, and big files go on
+# from their last checkpoint. The journal is deleted once the run completes.
+# Shared by all worker threads, hence the lock.
+class RunJournal(object):
+	def __init__(self, path, run):
+		folder = os.path.dirname(path)
+		if folder and not os.path.isdir(folder):
+			os.makedirs(folder)
+		self.path = path
+		self.lock = threading.Lock()
+		self.done = {}
+		self.partial = {}
+		self.resumed = {} # path: bytes not read again thanks to a checkpoint, until reported
+		self.lastSync = time.time()
+		self.failed = False
+		header = {'journal': 1, 'run': run}
+		if os.path.exists(path):
+			self.load(header)
+
+		# Rewritten without what's outdated or cut in the middle
+		tempPath = path + '.tmp'
+		with open(tempPath, 'wb') as fd:
+			fd.write(encodeUtf8(json.dumps(header) + '\n'))
+			for filePath, (signature, digests) in self.done.items():
+				fd.write(encodeUtf8(json.dumps({'path': filePath, 'signature': signature, 'digests': digests}) + '\n'))
+			for filePath, (signature, offset, states) in self.partial.items():
+				fd.write(encodeUtf8(json.dumps({'path': filePath, 'signature': signature, 'offset': offset, 'states': states}) + '\n'))
+		getattr(os, 'replace', os.rename)(tempPath, path)
+		self.file = open(path, 'ab')
+
+	# Reads a journal left by the same run. Anything else is started over.
+	def load(self, header):
+		with open(self.path, 'rb') as fd:
+			lines = fd.read().decode('utf-8', 'replace').split('\n')
+		try:
+			if json.loads(lines[0]) != header:
+				return
+		except ValueError:
+			return
+		for line in lines[1:]:
+			try:
+				entry = json.loads(line)
+			except ValueError: # the line being written when the run was killed
+				break
+			if 'digests' in entry:
+				self.done[entry['path']] = (entry['signature'], entry['digests'])
+				self.partial.pop(entry['path'], None)
+			else:
+				self.partial[entry['path']] = (entry['signature'], entry['offset'], entry['states'])
+
+	def write(self, entry):
+		with self.lock:
+			if self.failed:
+				return
+			try:
+				self.file.write(encodeUtf8(json.dumps(entry) + '\n'))
+				self.file.flush()
+				if 'offset' in entry or time.time() - self.lastSync >= journalSyncInterval:
+					os.fsync(self.file.fileno())
+					self.lastSync = time.time()
+			except EnvironmentError as e:
+				print("Couldn't write the journal \"%s\": %s" % (self.path, e))
+				self.failed = True
+
+	# Returns {hashName: digest} for the hashes asked for, or None if any is missing
+	def lookup(self, path, st, hashes):
+		done = self.done.get(path)
+		if done is None or tuple(done[0]) != HashCache.signature(st):
+			return None
+		digests = {}
+		for name in hashes:
+			if name not in done[1]:
+				return None
+			digests[name] = done[1][name]
+		return digests
+
+	def store(self, path, st, digests):
+		self.write({'path': path, 'signature': HashCache.signature(st), 'digests': digests})
+
+	# (offset, {hashName: state}) of the last checkpoint of the file, or None
+	def getPartial(self, path, st):
+		partial = self.partial.get(path)
+		if partial is None or tuple(partial[0]) != HashCache.signature(st):
+			return None
+		return partial[1], partial[2]
+
+	def checkpoint(self, path, st, offset, states):
+		self.write({'path': path, 'signature': HashCache.signature(st), 'offset': offset, 'states': states})
+
+	def noteResumed(self, path, offset):
+		with self.lock:
+			self.resumed[path] = offset
+
+	# Bytes of the file that were read before the run was interrupted
+	def takeResumed(self, path):
+		with self.lock:
+			return self.resumed.pop(path, 0)
+
+	# Deletes the journal if the run completed, else keeps it for --resume
+	def close(self, completed):
+		self.file.close()
+		if completed:
+			os.remove(self.path)
+
+# The inputs and options that make a run the same run, for --resume
+def getRunSignature():
+	return {'inputs': [os.path.abspath(path) for path in pathList], 'recursive': recursive,
+		'searchSubFolder': searchSubFolder, 'include': includePatterns, 'exclude': excludePatterns}
+
+def openJournal():
+	global runJournal, journalPath
+	if not resume:
+		return
+	run = getRunSignature()
+	if journalPath is None:
+		key = hashlib.sha1(encodeUtf8(json.dumps(run, sort_keys=True))).hexdigest()[:16]
+		journalPath = os.path.join(getCacheDir(), 'journal-%s.jsonl' % key)
+	try:
+		runJournal = RunJournal(journalPath, run)
+	except (EnvironmentError, ValueError) as e:
+		print("Couldn't open journal \"%s\": %s" % (journalPath, e))
+		runJournal = None
+		return
+	if runJournal.done or runJournal.partial:
+		print('Resuming: %d file(s) done, %d partly.\n' % (len(runJournal.done), len(runJournal.partial)))
+
+def closeJournal(completed):
+	global runJournal
+	if runJournal is None:
+		return
+	if cliHasher is not None:
+		cliHasher.journal = None
+	try:
+		runJournal.close(completed)
+	except EnvironmentError as e:
+		print("Couldn't close journal \"%s\": %s" % (journalPath, e))
+	runJournal = None
+
+# A CRC-32 in a filename: 8 hex digits, starting the name or after one of
+# "([_. ", and ending the name or followed by one of ")]_. ".
+reCRC = re.compile(r'(?:^|(?<=[(\[_. ]))[A-Fa-f0-9]{8}(?=[)\]_. ]|$)')
+
+# Looks for a CRC-32 in name, which should be a basename, not a path.
+# Returns (found, crc, position); if there are several, the last one.
+def detectCRC(name):
+	found, crc, position = False, '', -1
+	for match in reCRC.finditer(name):
+		found, crc, position = True, match.group(), match.start()
+	return found, crc, position
+
+# Bytes read to hash a file, without those a resumed run read before it was
+# interrupted
+def getReadSize(fileName, fileSize):
+	if runJournal is None:
+		return fileSize
+	return fileSize - runJournal.takeResumed(os.path.abspath(fileName))
+
+# If digests are given (from Hasher.hashJob), the file isn't read again here
+def processFile(fileName, fromFolder = False, digests = None, error = None, fromCache = False, fileSize = 0):
+	if fileName == stdinName and not fromFolder:
+		processStdin()
+		return
+
+	# Not hashed yet. hashJob also decodes the path to unicode in Python 2
+	if digests is None:
+		fileName, fromFolder, digests, error, fromCache, fileSize = getCliHasher().hashJob((fileName, fromFolder))
+
+	if digests is None:
 		if not fromFolder:
-			print('%s    Not found or invalid!' % path)
+			print('%s    Not found or invalid!' % fileName)
 		fag.append(fileName)
 		return
 
-	# In Python 2, decode the path to unicode string
-	# In python 3, it's already unicode, so don't
-	if sys.version_info[0] < 3 and hasattr(fileName, 'decode'):
-		fileName = fileName.decode(sys.getfilesystemencoding())
-
-	sHash, md4, md5, sha1, sha256, sha512, ed2k, error = hasher_s(fileName)
+	sHash = digests.get('crc32', '%08X' % 0)
 	newName = fileName
 
-	fileSize = os.path.getsize(fileName)
-
-	global st_total, st_ok, st_notok, st_notfound, st_size, st_error
-	if not error:
+	global st_total, st_ok, st_notok, st_notfound, st_size, st_error, st_cached
+	readSize = 0 if fromCache or error else getReadSize(fileName, fileSize)
+	if fromCache:
+		st_cached += 1
+	elif not error:
 		try:
-			st_size += fileSize
+			st_size += readSize
 		except:
 			doNothing = 1
 	st_total += 1
 
-	found, crc = detectCRC(fileName)
+	folder, name = os.path.split(fileName)
+	found, crc, position = detectCRC(name)
 
 	if error:
 		result = error
 		st_error += 1
-	elif sHash in fileName.upper():
+	elif sHash in name.upper():
 		result = "File OK!"
 		st_ok += 1
 	elif found and not updatecrc:
 		result = "File not OK! %s found in filename." % crc
 		st_notok += 1
 	else:
-		if addcrc:
-			namae, ext = os.path.splitext(fileName)
-			newName = namae + "[%s]" % sHash + ext
-			try:
-				shutil.move(fileName, newName)
-				result = "CRC added!"
-			except:
-				result = "Renaming failed!"
-				newName = fileName
-		elif updatecrc:
+		if addcrc and not found:
 			namae, ext = os.path.splitext(fileName)
-			newName = namae.replace(crc,sHash) + ext
-			try:
-				shutil.move(fileName, newName)
-				result = "CRC updated!"
-			except Exception as e:
-				result = "Renaming failed!"
-				newName = fileName
+			result, newName = planRename(fileName, namae + "[%s]" % sHash + ext, "CRC added!")
+		elif updatecrc and found:
+			result, newName = planRename(fileName, os.path.join(folder, name[:position] + sHash + name[position + len(crc):]), "CRC updated!")
 		else:
 			result = "CRC not found!"
-		st_notfound += 1
+		if result.startswith('Renaming failed!'):
+			st_error += 1
+		else:
+			st_notfound += 1
 
-	# deal with terminal encoding mess
-	global terminalSupportUnicode
-	if not terminalSupportUnicode:
-		fileName = removeNonAscii(fileName)
+	if progressReport is not None:
+		progressReport.add(readSize)
 
-	name2Show = fileName
-	if not showFullPath:
-		path, name2Show = os.path.split(fileName)
+	# The rest once the file has the name it keeps: renames are done in
+	# batches, and one that fails leaves the old name
+	def report(renameError):
+		global st_notfound, st_error
+		reportName, reportResult = newName, result
+		if renameError:
+			reportName, reportResult = fileName, 'Renaming failed! %s' % renameError
+			st_notfound -= 1
+			st_error += 1
+		if resultOutput is not None:
+			resultOutput.add(reportName, fileSize, reportResult, digests, error)
 
-	if showChecksumResult:
-		if not showFileInfo:
-			print('%s    %s    %s' % (name2Show, sHash, result))
-		else:
-			print('Filename: %s' % name2Show)
-			print('Size: %d bytes (%s)' % (fileSize, byteToHumanSize(fileSize)))
-			print('CRC-32: %s' % sHash)
-		if not error:
-			if enableMd4: print('MD4: %s' % md4)
-			if enableMd5: print('MD5: %s' % md5)
-			if enableSha1: print('SHA-1: %s' % sha1)
-			if enableSha256: print('SHA-256: %s' % sha256)
-			if enableSha512: print('SHA-512: %s' % sha512)
-			if enableEd2k: print('ED2K: %s' % ed2k)
-		if showFileInfo: print(' ')
-
-	# Append this file info to sfvContent. Yes, use newName as it's up-to-date
-	# Remember to use "global" to access external variable!!
-	path, name = os.path.split(newName)
+		# deal with terminal encoding mess
+		name2Show = fileName if terminalSupportUnicode else removeNonAscii(fileName)
+		if not showFullPath:
+			path, name2Show = os.path.split(name2Show)
+
+		if showChecksumResult and resultOutput is None:
+			printResult(name2Show, fileSize, sHash, reportResult, digests, error)
+
+		# Add this file to the checksum file, under the name it has now
+		if not error and manifestWriter is not None:
+			manifestWriter.add(getManifestName(reportName), digests, fileSize)
+
+	if renameStage is not None:
+		renameStage.defer(fileName, report)
+	else:
+		report(None)
+
+# Name of a file in the checksum file: its path from the checksum file's
+# folder, so that -k finds it again, or just its name if it's elsewhere
+def getManifestName(fileName):
+	folder = os.path.dirname(os.path.abspath(sfvPath))
+	path = os.path.abspath(fileName)
+	if not path.startswith(os.path.join(folder, '')):
+		return os.path.basename(path)
+	return os.path.relpath(path, folder)
+
+def printResult(name2Show, fileSize, sHash, result, digests, error):
+	if not showFileInfo:
+		print('%s    %s    %s' % (name2Show, sHash, result))
+	else:
+		print('Filename: %s' % name2Show)
+		print('Size: %d bytes (%s)' % (fileSize, byteToHumanSize(fileSize)))
+		print('CRC-32: %s' % sHash)
 	if not error:
-		global sfvContent
-		sfvContent.append('\n')
-		sfvContent.append(name)
-		sfvContent.append(' ')
-		sfvContent.append(sHash)
+		for name, displayName in zip(hashNames[1:], hashDisplayNames[1:]):
+			if name in digests:
+				print('%s: %s' % (displayName, digests[name]))
+	if showFileInfo: print(' ')
+
+# Input "-": hashes whatever comes from stdin. There's no filename to check
+# or rename and nothing to put in a SFV, just the hashes.
+def processStdin():
+	global st_total, st_notfound, st_size, st_error
+	st_total += 1
+	try:
+		digests, fileSize = getCliHasher().hashStreamCounted(getBinaryStdin())
+		error = None
+		st_size += fileSize
+		st_notfound += 1
+	except Exception as e:
+		digests, fileSize, error = {}, 0, getErrorText(e)
+		st_error += 1
+	if progressReport is not None:
+		progressReport.add(fileSize)
+	if resultOutput is not None:
+		resultOutput.add(stdinName, fileSize, error or 'CRC not found!', digests, error)
+	elif showChecksumResult:
+		printResult(stdinName, fileSize, digests.get('crc32', '%08X' % 0), error or 'CRC not found!', digests, error)
 
-		global sfvPureAscii
-		if sfvPureAscii:
-			sfvPureAscii = isPureAscii(name)
+def getBinaryStdin():
+	if sys.platform == 'win32':
+		import msvcrt
+		msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+	return getattr(sys.stdin, 'buffer', sys.stdin)
 
 def processFolderv2(path):
+	items = walkFolderv2(path, recursive, searchSubFolder, getNameFilter())
+	for fileName, fromFolder, digests, error, fromCache, fileSize in getCliHasher().hashItems(items):
+		processFile(fileName, fromFolder, digests, error, fromCache, fileSize)
+
+# Hands a rename of --addcrc or --updatecrc to the rename stage. Returns
+# the result to show, and the name the file will have.
+def planRename(fileName, newName, result):
+	error = renameStage.plan(fileName, newName)
+	if error:
+		return 'Renaming failed! %s' % error, fileName
+	if dryRun:
+		return '%s (dry run)' % result, fileName
+	return result, newName
+
+# The renames of --addcrc and --updatecrc. They're collected as files are
+# hashed, and done renameBatchSize at a time with os.replace (files stay in
+# their folder, so it never copies). Before each batch, the renames are
+# appended to the undo log and synced, so whatever happens, --undo with the
+# log can put the names back. A rename is refused when the new name already
+# exists, or another file is to be renamed to it.
+class RenameStage(object):
+	def __init__(self, logPath, dryRun = False):
+		self.logPath = logPath
+		self.dryRun = dryRun
+		self.log = None
+		self.pending = []
+		self.targets = set()
+		self.renamed = 0
+		self.failed = 0
+		self.errors = {} # fileName: why its rename failed, until reported
+		self.reports = [] # (fileName, report) waiting for the renames, see defer
+
+	# Returns why the file can't be renamed, or None
+	def plan(self, fileName, newName):
+		if newName in self.targets or os.path.lexists(newName):
+			self.failed += 1
+			return 'File exists!'
+		self.targets.add(newName)
+		if not self.dryRun:
+			self.pending.append((fileName, newName))
+			if len(self.pending) >= renameBatchSize:
+				self.commit()
+		return None
+
+	# Calls report(error) once the renames planned so far are done, with why
+	# the file's rename failed or None, so that results are shown and listed
+	# in the checksum file under the name the file really has, in order
+	def defer(self, fileName, report):
+		if self.dryRun or not (self.pending or self.reports):
+			report(None)
+			return
+		self.reports.append((fileName, report))
+		if len(self.reports) >= renameBatchSize:
+			self.commit()
+
+	def commit(self):
+		try:
+			self.rename()
+		finally:
+			reports, self.reports = self.reports, []
+			for fileName, report in reports:
+				report(self.errors.pop(fileName, None))
+
+	def rename(self):
+		if not self.pending:
+			return
+		try:
+			if self.log is None:
+				folder = os.path.dirname(self.logPath)
+				if folder and not os.path.isdir(folder):
+					os.makedirs(folder)
+				self.log = open(self.logPath, 'ab')
+			for fileName, newName in self.pending:
+				self.log.write(encodeUtf8(json.dumps({'from': os.path.abspath(fileName), 'to': os.path.abspath(newName)}) + '\n'))
+			self.log.flush()
+			os.fsync(self.log.fileno())
+		except EnvironmentError as e: # no renames that couldn't be undone
+			print("Couldn't write the undo log \"%s\", %d file(s) not renamed: %s" % (self.logPath, len(self.pending), e))
+			self.failed += len(self.pending)
+			for fileName, newName in self.pending:
+				self.errors[fileName] = "Couldn't write the undo log."
+			self.pending = []
+			self.targets.clear()
+			return
+
+		for fileName, newName in self.pending:
+			try:
+				if os.path.lexists(newName): # appeared since it was planned
+					raise EnvironmentError('File exists')
+				getattr(os, 'replace', os.rename)(fileName, newName)
+				self.renamed += 1
+			except EnvironmentError as e:
+				self.failed += 1
+				self.errors[fileName] = getErrorText(e)
+		self.pending = []
+		self.targets.clear()
+
+	def close(self):
+		self.commit()
+		if self.log is not None:
+			self.log.close()
+
+# --undo: renames the files listed in the undo logs given as inputs back to
+# their old names, last rename first. Files renamed again since, or whose
+# old name is taken, are left alone.
+def undoRenameLogs():
+	global st_total, st_ok, st_notfound, st_error
+	renames = []
+	for logPath in pathList:
+		try:
+			with open(logPath, 'rb') as fd:
+				lines = fd.read().decode('utf-8').split('\n')
+		except EnvironmentError as e:
+			print('%s    %s' % (logPath, getErrorText(e)))
+			st_error += 1
+			continue
+		for line in lines:
+			try:
+				entry = json.loads(line)
+			except ValueError: # cut short, or the empty last line
+				continue
+			renames.append((entry['from'], entry['to']))
+
+	for fileName, newName in reversed(renames):
+		st_total += 1
+		name2Show = newName if showFullPath else os.path.basename(newName)
+		if not os.path.lexists(newName):
+			result = 'Not found!'
+			st_notfound += 1
+		elif os.path.lexists(fileName):
+			result = 'Not renamed back, %s exists!' % os.path.basename(fileName)
+			st_error += 1
+		else:
+			try:
+				getattr(os, 'replace', os.rename)(newName, fileName)
+				result = 'Renamed back to %s' % os.path.basename(fileName)
+				st_ok += 1
+			except EnvironmentError as e:
+				result = getErrorText(e)
+				st_error += 1
+		if showChecksumResult or not result.startswith('Renamed back'):
+			print('%s    %s' % (name2Show if terminalSupportUnicode else removeNonAscii(name2Show), result))
+
+def openRenames():
+	global renameStage, renameLogPath
+	if not (addcrc or updatecrc):
+		return
+	if renameLogPath is None:
+		renameLogPath = os.path.join(getCacheDir(), 'renames-%s.jsonl' % time.strftime('%Y%m%d-%H%M%S'))
+	renameStage = RenameStage(renameLogPath, dryRun)
+
+def closeRenames():
+	global renameStage, renameFailures
+	if renameStage is None:
+		return
+	try:
+		renameStage.close()
+	except EnvironmentError as e:
+		print("Couldn't close the undo log \"%s\": %s" % (renameLogPath, e))
+	if renameStage.renamed:
+		print('\nRenamed: %d. Undo with: --undo "%s"' % (renameStage.renamed, renameLogPath))
+	if renameStage.failed:
+		print('Renaming failed: %d.' % renameStage.failed)
+		renameFailures += renameStage.failed
+	renameStage = None
+
+# Yields (fileName, fromFolder) in the order processFolderv2 processes them.
+# Invalid inputs are yielded with fromFolder = False so that processFile
+# reports them in the right place of the output.
+# nameFilter (a NameFilter) further filters the files found in folders.
+def walkFolderv2(path, recursive, searchSubFolder, nameFilter = None):
 
 	pattern = '*'
 	usePattern = False
 
 	# Check if input is an existing file
 	if os.path.isfile(path):
-		processFile(path, False)
+		yield path, False
+		return
 	# Check if input is an existing folder.
 	# If not, split the path and check if "folder" exists
 	if not os.path.isdir(path):
@@ -307,67 +2217,849 @@ def processFolderv2(path):
 			path = os.getcwd()
 			usePattern = True
 		else:
-			print('%s    Not found or invalid!' % path)
-			return
+			yield path, False
+			return
+
+	matches = compilePattern(pattern) if usePattern and ('*' in pattern or '?' in pattern) else None
+	subFolders = searchSubFolder if usePattern else recursive
+	for dirpath, entries in scanFolder(path, subFolders):
+		if usePattern:
+			if matches is None:
+				break
+			entries = [entry for entry in entries if matches(entry.name)]
+		if nameFilter is not None:
+			entries = [entry for entry in entries if nameFilter.matches(entry.name)]
+		entries.sort(key=lambda entry: entry.name)
+		for entry in entries:
+			yield entry.path, True, entry
+
+# pool.imap, but with at most window items handed to the pool and not
+# yielded yet. imap reads all of its input ahead (the whole walk, with a
+# DirEntry per file), while this reads the input as results are used.
+def imapBounded(pool, function, items, window):
+	pending = collections.deque()
+	for item in items:
+		pending.append(pool.apply_async(function, (item,)))
+		if len(pending) >= window:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+# Groups consecutive small files from a folder walk into lists of up to
+# smallBatchSize items, so that workers get them by the dozen instead of one
+# task each; other items are lists of one. The size comes from the
+# DirEntry's stat, which the worker would do anyway and then gets cached.
+def batchSmallItems(items):
+	batch = []
+	for item in items:
+		small = False
+		if len(item) > 2:
+			try:
+				small = item[2].stat().st_size <= smallFileSize
+			except (EnvironmentError, AttributeError):
+				pass
+		if small:
+			batch.append(item)
+			if len(batch) >= smallBatchSize:
+				yield batch
+				batch = []
+		else:
+			if batch:
+				yield batch
+				batch = []
+			yield [item]
+	if batch:
+		yield batch
+
+# Lists the files of path, then of its subfolders, depth-first like os.walk,
+# yielding (dirpath, [DirEntry of the files]) one folder at a time. Only one
+# folder's listing is held at once, so memory stays flat on huge trees and
+# hashing starts as soon as the first folder is listed. Symlinks to folders
+# aren't followed, and unreadable folders are skipped, like os.walk does.
+def scanFolder(path, subFolders):
+	if scandir is None:
+		for dirpath, dirnames, filenames in os.walk(path):
+			yield dirpath, [ListedFile(dirpath, fname) for fname in filenames]
+			if not subFolders:
+				break
+		return
+
+	pending = [path]
+	while pending:
+		dirpath = pending.pop()
+		files = []
+		folders = []
+		try:
+			iterator = scandir(dirpath)
+		except EnvironmentError:
+			continue
+		try:
+			for entry in iterator:
+				try:
+					isFolder = entry.is_dir()
+				except EnvironmentError:
+					isFolder = False
+				if not isFolder:
+					files.append(entry)
+				elif subFolders and not entry.is_symlink():
+					folders.append(entry.path)
+		except EnvironmentError:
+			pass
+		finally:
+			if hasattr(iterator, 'close'):
+				iterator.close()
+		yield dirpath, files
+		folders.reverse()
+		pending.extend(folders)
+
+# What scanFolder lists when there's no scandir: a DirEntry lookalike
+# without the cached stat
+class ListedFile(object):
+	def __init__(self, dirpath, name):
+		self.name = name
+		self.path = os.path.join(dirpath, name)
+
+	def stat(self):
+		return os.stat(self.path)
+
+# Stat result of a regular file (following symlinks), None if fileName is
+# anything else or doesn't exist. entry is the file's DirEntry, if any.
+def statItem(fileName, entry = None):
+	try:
+		st = entry.stat() if entry is not None else os.stat(fileName)
+	except (EnvironmentError, ValueError):
+		return None
+	if not stat.S_ISREG(st.st_mode):
+		return None
+	return st
+
+# Expands pathList into (fileName, fromFolder), same order as the inputs
+def walkInputs(pathList, recursive, searchSubFolder, nameFilter = None):
+	for path in pathList:
+		if path == stdinName:
+			yield path, False
+		elif os.path.isfile(path):
+			yield path, False # walkFolderv2 also works with file, but this saves some cpu circles
+		elif os.path.isdir(path):
+			for item in walkFolderv2(path, recursive, searchSubFolder, nameFilter):
+				yield item
+		elif (path.endswith(os.sep) or path.endswith("'") or path.endswith('"')) and os.path.isdir(path[:-1]):
+			for item in walkFolderv2(path[:-1], recursive, searchSubFolder, nameFilter):
+				yield item
+		else:
+			for item in walkFolderv2(path, recursive, searchSubFolder, nameFilter):
+				yield item
+
+# Absolute paths of the files this run writes (and their temporary files),
+# which must not be hashed when they're in a folder being hashed
+def getOutputPaths():
+	paths = set(os.path.abspath(path) for path in (sfvPath if createsfv else None, timingsPath, metricsPath) if path)
+	paths.update([os.path.join(os.path.dirname(path), '.tmp.' + os.path.basename(path)) for path in paths]
+		+ [path + '.tmp' for path in paths])
+	return paths
+
+# walkInputs of the command line, without the files the run writes
+def walkCliInputs():
+	ignored = getOutputPaths()
+	for item in walkInputs(pathList, recursive, searchSubFolder, getNameFilter()):
+		if not (item[1] and os.path.abspath(item[0]) in ignored):
+			yield item
+
+# A folder --watch looks at: files directly in it (and in its subfolders,
+# if subFolders) whose name passes matches, unless it's None
+WatchRoot = collections.namedtuple('WatchRoot', 'folder matches subFolders')
+
+# The folders to watch for the inputs, the same files walkInputs would find
+def getWatchRoots(pathList, recursive, searchSubFolder):
+	roots = []
+	for path in pathList:
+		if path == stdinName:
+			continue
+		if os.path.isfile(path):
+			folder, name = os.path.split(os.path.abspath(path))
+			roots.append(WatchRoot(folder, lambda fname, name=name: fname == name, False))
+		elif os.path.isdir(path):
+			roots.append(WatchRoot(os.path.abspath(path), None, recursive))
+		elif (path.endswith(os.sep) or path.endswith("'") or path.endswith('"')) and os.path.isdir(path[:-1]):
+			roots.append(WatchRoot(os.path.abspath(path[:-1]), None, recursive))
+		else:
+			folder, pattern = os.path.split(path)
+			if ('*' in pattern or '?' in pattern) and os.path.isdir(folder or os.curdir):
+				roots.append(WatchRoot(os.path.abspath(folder or os.curdir), compilePattern(pattern), searchSubFolder))
+	return roots
+
+# Watches the inputs, hashing files as they're added or changed, and
+# keeping the checksum file up to date, until Ctrl+C. Uses inotify where
+# there is one, else polls the folders every watchInterval seconds.
+def watchInputs():
+	roots = getWatchRoots(pathList, recursive, searchSubFolder)
+	if not roots:
+		print('Nothing to watch.')
+		return
+	nameFilter = getNameFilter()
+	ignored = getOutputPaths()
+
+	def wanted(path):
+		if path in ignored:
+			return False
+		folder, name = os.path.split(path)
+		for root in roots:
+			if folder != root.folder and not (root.subFolders and folder.startswith(os.path.join(root.folder, ''))):
+				continue
+			if root.matches is not None and not root.matches(name):
+				continue
+			if nameFilter is not None and (root.matches is None or root.subFolders) and not nameFilter.matches(name):
+				continue
+			return True
+		return False
+
+	watcher = InotifyWatcher(roots, wanted) if InotifyWatcher.available() else PollingWatcher(roots, wanted)
+	print('\nWatching %d folder(s) (%s). Press Ctrl+C to stop.\n' % (len(roots), watcher.name))
+	try:
+		for changed, deleted in watcher.batches():
+			for path in sorted(deleted):
+				if resultOutput is not None:
+					resultOutput.add(path, 0, 'Deleted!', {}, None)
+				elif showChecksumResult:
+					print('%s    Deleted!' % (path if showFullPath else os.path.basename(path)))
+				if manifestWriter is not None:
+					manifestWriter.remove(getManifestName(path))
+			items = [(path, True) for path in sorted(changed)]
+			for fileName, fromFolder, digests, error, fromCache, fileSize in cliHasher.hashItems(items):
+				processFile(fileName, fromFolder, digests, error, fromCache, fileSize)
+			if renameStage is not None:
+				renameStage.commit()
+			saveWatchState()
+	except KeyboardInterrupt:
+		print('')
+	finally:
+		watcher.close()
+
+# Writes out what a long run would otherwise only write at the end
+def saveWatchState():
+	try:
+		if manifestWriter is not None:
+			manifestWriter.save()
+		if hashCache is not None:
+			hashCache.commit()
+		if hashStats is not None and metricsPath:
+			hashStats.export(metricsPath)
+	except Exception as e:
+		print("Couldn't save: %s" % e)
+
+# Snapshot of the watched files: {path: (size, mtime)}
+def scanWatchRoots(roots, wanted):
+	files = {}
+	for root in roots:
+		for dirpath, entries in scanFolder(root.folder, root.subFolders):
+			for entry in entries:
+				if not wanted(entry.path):
+					continue
+				st = statItem(entry.path, entry)
+				if st is not None:
+					files[entry.path] = (st.st_size, st.st_mtime)
+	return files
+
+# Finds changes by rescanning the folders. A file is only hashed once it has
+# kept the same size and mtime for a whole interval, as it might still be
+# being written.
+class PollingWatcher(object):
+	def __init__(self, roots, wanted):
+		self.name = 'polling every %g s' % watchInterval
+		self.roots = roots
+		self.wanted = wanted
+		self.known = scanWatchRoots(roots, wanted) # as of the last hashing
+		self.previous = self.known
+
+	def batches(self):
+		while True:
+			time.sleep(watchInterval)
+			current = scanWatchRoots(self.roots, self.wanted)
+			changed = set(path for path, signature in current.items()
+				if self.known.get(path) != signature and self.previous.get(path) == signature)
+			deleted = set(path for path in self.known if path not in current)
+			self.previous = current
+			for path in changed:
+				self.known[path] = current[path]
+			for path in deleted:
+				del self.known[path]
+			if changed or deleted:
+				yield changed, deleted
+
+	def close(self):
+		pass
+
+# Linux inotify through ctypes: files are hashed when they're closed after
+# writing or moved in. Events are collected until there's none for
+# watchSettle seconds, so a burst of them makes a single batch. In between,
+# the process sleeps in select().
+class InotifyWatcher(object):
+	name = 'inotify'
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+	IN_Q_OVERFLOW = 0x4000
+	IN_IGNORED = 0x8000
+	IN_ISDIR = 0x40000000
+	mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	libc = None
+
+	@classmethod
+	def available(cls):
+		if ctypes is None or not sys.platform.startswith('linux'):
+			return False
+		if cls.libc is None:
+			try:
+				cls.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+				cls.libc.inotify_init
+			except (OSError, AttributeError):
+				return False
+		return True
+
+	def __init__(self, roots, wanted):
+		self.roots = roots
+		self.wanted = wanted
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init failed')
+		self.folders = {} # watch descriptor -> folder
+		for root in roots:
+			self.addFolder(root.folder, root.subFolders)
+
+	def addFolder(self, folder, subFolders):
+		path = folder.encode(sys.getfilesystemencoding()) if not isinstance(folder, bytes) else folder
+		wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+		if wd < 0:
+			print("Can't watch \"%s\": %s" % (folder, os.strerror(ctypes.get_errno())))
+			return
+		self.folders[wd] = folder
+		if subFolders:
+			try:
+				names = os.listdir(folder)
+			except EnvironmentError:
+				return
+			for name in names:
+				path = os.path.join(folder, name)
+				if os.path.isdir(path) and not os.path.islink(path):
+					self.addFolder(path, True)
+
+	def subFoldersWatched(self, folder):
+		return any(root.subFolders and (folder == root.folder or folder.startswith(os.path.join(root.folder, '')))
+			for root in self.roots)
+
+	def readEvents(self):
+		data = os.read(self.fd, 65536)
+		pos = 0
+		while pos + 16 <= len(data):
+			wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+			name = data[pos + 16:pos + 16 + length].rstrip(b'\0')
+			pos += 16 + length
+			yield wd, mask, name.decode(sys.getfilesystemencoding(), 'surrogateescape') if sys.version_info[0] >= 3 else name
+
+	def batches(self):
+		while True:
+			changed = set()
+			deleted = set()
+			timeout = None # nothing going on: sleep until something happens
+			while select.select([self.fd], [], [], timeout)[0]:
+				timeout = watchSettle
+				for wd, mask, name in self.readEvents():
+					if mask & self.IN_Q_OVERFLOW: # lost events, look at everything
+						for root in self.roots:
+							for dirpath, entries in scanFolder(root.folder, root.subFolders):
+								changed.update(entry.path for entry in entries if self.wanted(entry.path))
+						continue
+					folder = self.folders.get(wd)
+					if folder is None or mask & self.IN_IGNORED:
+						self.folders.pop(wd, None)
+						continue
+					path = os.path.join(folder, name)
+					if mask & self.IN_ISDIR:
+						if mask & (self.IN_CREATE | self.IN_MOVED_TO) and self.subFoldersWatched(folder):
+							self.addFolder(path, True)
+							for dirpath, entries in scanFolder(path, True):
+								changed.update(entry.path for entry in entries if self.wanted(entry.path))
+						continue
+					if not self.wanted(path):
+						continue
+					if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+						changed.add(path)
+						deleted.discard(path)
+					elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+						deleted.add(path)
+						changed.discard(path)
+			if changed or deleted:
+				yield changed, deleted
+
+	def close(self):
+		os.close(self.fd)
+
+# Coordinator and workers, for hashing on several machines (or processes)
+# at once. The coordinator (--serve) walks the inputs like a normal run and
+# hands out the files to the workers (--worker) that connect to it over TCP.
+# Workers hash them with their own read settings and send the digests back,
+# and the coordinator reports them in input order, to one checksum file and
+# one set of stats. Files must be at the same absolute path on all machines.
+# The hash cache and --resume journal are looked up and updated here, so only
+# files that need reading are handed out (a big file is then hashed again
+# from the start, not from its checkpoint), and workers write the chunk
+# indexes of --chunkindex next to the files.
+# Big files, when CRC-32 is the only hash, are cut in rangeJobSize parts,
+# hashed by different workers and combined (see Crc32Hash.combine). The
+# protocol is one JSON object per line:
+#
+#   worker: {"hello": 1, "name": "node2-1234"}
+#   coordinator: {"hashes": ["crc32", "md5"], "chunkIndex": null, "heartbeat": 15}
+#   coordinator: {"id": 7, "path": "/srv/a.mkv", "start": 0, "length": null}
+#   worker, every "heartbeat" seconds while it hashes: {"working": 7}
+#   worker: {"id": 7, "size": 1234, "digests": {...}} or {"id": 7, "error": "..."}
+#           or, for a part, {"id": 7, "size": 1234, "states": {"crc32": {...}}}
+#   ... until the coordinator sends {"done": true}
+#
+# A job whose worker goes away, or says nothing for workerTimeout seconds, is
+# handed to another one. If no worker is left for that long, the coordinator
+# hashes the remaining jobs itself.
+def sendMessage(stream, message):
+	stream.write((json.dumps(message) + '\n').encode('ascii'))
+	stream.flush()
+
+# None when the other side closed the connection
+def receiveMessage(stream):
+	line = stream.readline()
+	if not line:
+		return None
+	return json.loads(line.decode('ascii'))
+
+# "host:port", or just "port" for localhost. Returns None if it isn't valid.
+def parseAddress(text):
+	host, sep, port = text.rpartition(':')
+	try:
+		port = int(port)
+	except ValueError:
+		return None
+	if not 0 <= port < 65536:
+		return None
+	return host or '127.0.0.1', port
+
+# The jobs the coordinator hands out, and the results workers sent back.
+# Shared by the threads of all connections, hence the lock.
+class WorkQueue(object):
+	def __init__(self):
+		self.lock = threading.Condition()
+		self.jobs = collections.deque()
+		self.results = {}
+		self.finished = False
+		self.workers = 0 # connected
+		self.lostSince = time.time() # when the last worker went away, or serving started
+		self.counters = collections.OrderedDict() # worker name: [jobs, bytes]
+
+	def put(self, job):
+		with self.lock:
+			self.jobs.append(job)
+			self.lock.notify_all()
+
+	# The next job, or None once there will be no more
+	def take(self):
+		with self.lock:
+			while not self.jobs and not self.finished:
+				self.lock.wait()
+			return self.jobs.popleft() if self.jobs else None
+
+	# Hands the job of a worker that went away to another one
+	def putBack(self, job):
+		with self.lock:
+			self.jobs.appendleft(job)
+			self.lock.notify_all()
+
+	def complete(self, workerName, result):
+		with self.lock:
+			self.results[result['id']] = result
+			counters = self.counters.setdefault(workerName, [0, 0])
+			counters[0] += 1
+			counters[1] += result.get('size', 0)
+			self.lock.notify_all()
+
+	# The results of these jobs, once they're all in, or None after timeout
+	def waitResults(self, jobIds, timeout):
+		with self.lock:
+			if not all(jobId in self.results for jobId in jobIds):
+				self.lock.wait(timeout)
+				if not all(jobId in self.results for jobId in jobIds):
+					return None
+			return [self.results.pop(jobId) for jobId in jobIds]
+
+	# Seconds since the last worker went away (or since serving started, if
+	# none connected yet), 0 while one is connected
+	def lostFor(self):
+		with self.lock:
+			if self.workers:
+				return 0
+			return time.time() - self.lostSince
+
+	def hasResults(self, jobIds):
+		with self.lock:
+			return all(jobId in self.results for jobId in jobIds)
+
+	def finish(self):
+		with self.lock:
+			self.finished = True
+			self.lock.notify_all()
+
+# One connection of a worker, in its own thread
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		work = self.server.work
+		try:
+			hello = receiveMessage(self.rfile)
+		except (EnvironmentError, ValueError):
+			return
+		if not isinstance(hello, dict) or hello.get('hello') != protocolVersion:
+			return
+		workerName = hello.get('name') or '%s:%d' % self.client_address[:2]
+		with work.lock:
+			work.workers += 1
+		job = None
+		try:
+			self.connection.settimeout(workerTimeout)
+			sendMessage(self.wfile, {'hashes': self.server.hashes, 'heartbeat': workerTimeout / 4.0,
+				'chunkIndex': chunkIndexSize if chunkIndex else None})
+			while True:
+				job = work.take()
+				if job is None:
+					sendMessage(self.wfile, {'done': True})
+					return
+				sendMessage(self.wfile, job)
+				result = receiveMessage(self.rfile)
+				while isinstance(result, dict) and result.get('working') == job['id']:
+					result = receiveMessage(self.rfile)
+				if not isinstance(result, dict) or result.get('id') != job['id']:
+					return
+				work.complete(workerName, result)
+				job = None
+		except (EnvironmentError, ValueError):
+			pass
+		finally:
+			if job is not None:
+				work.putBack(job)
+			with work.lock:
+				work.workers -= 1
+				if not work.workers:
+					work.lostSince = time.time()
+				work.lock.notify_all()
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, work, hashes):
+		socketserver.ThreadingTCPServer.__init__(self, address, CoordinatorHandler)
+		self.work = work
+		self.hashes = hashes
+
+# Whether a file is hashed in parts by several workers
+def useRangeJobs(hashes, fileSize):
+	return (fileSize >= splitThreshold and list(hashes) == ['crc32'] # ED2K's state can't be sent mid-chunk
+		and not chunkIndex) # each chunk index is written by one worker
+
+# --serve: hashes the inputs on the workers that connect, with --localworkers
+# started here. Results are reported like those of a normal run.
+def distributeInputs():
+	global cliHasher
+	cliHasher = makeHasher()
+	work = WorkQueue()
+	server = CoordinatorServer(serveAddress, work, cliHasher.hashes)
+	serverThread = threading.Thread(target=server.serve_forever, name='coordinator')
+	serverThread.daemon = True
+	serverThread.start()
+	host, port = server.server_address[:2]
+	print('Waiting for workers on %s:%d.\n' % (host, port))
+	workers = startLocalWorkers('127.0.0.1' if host in ('', '0.0.0.0', '::') else host, port, localWorkers)
+
+	jobCount = [0]
+	def newJob(fileName, start, length):
+		jobCount[0] += 1
+		work.put({'id': jobCount[0], 'path': os.path.abspath(fileName), 'start': start, 'length': length})
+		return jobCount[0]
+
+	# (fileName, fromFolder, stat, job ids, cached digests), or (item,) for
+	# what's done here
+	def submit(item):
+		fileName, fromFolder = item[0], item[1]
+		st = None
+		if not (fileName == stdinName and not fromFolder):
+			st = statItem(fileName, item[2] if len(item) > 2 else None)
+		if st is None: # stdin, or not found
+			return (item,)
+		digests = cliHasher.lookupDigests(fileName, st)
+		if digests is not None:
+			return fileName, fromFolder, st, [], digests
+		if useRangeJobs(cliHasher.hashes, st.st_size):
+			jobIds = [newJob(fileName, start, min(rangeJobSize, st.st_size - start)) for start in range(0, st.st_size, rangeJobSize)]
+		else:
+			jobIds = [newJob(fileName, 0, None)]
+		return fileName, fromFolder, st, jobIds, None
+
+	localThread = []
+	def hashLocally():
+		hasher = makeHasher()
+		while True:
+			job = work.take()
+			if job is None:
+				return
+			work.complete(platform.node() + ' (coordinator)', runWorkerJob(hasher, job))
+
+	def report(entry):
+		if len(entry) == 1:
+			processFile(entry[0][0], entry[0][1])
+			return
+		fileName, fromFolder, st, jobIds, digests = entry
+		if digests is not None:
+			processFile(fileName, fromFolder, digests, None, True, st.st_size)
+			return
+		results = None
+		while results is None:
+			results = work.waitResults(jobIds, 1.0)
+			if results is None and not localThread and (work.lostFor() >= workerTimeout
+					or (workers and all(worker.poll() is not None for worker in workers) and not work.workers)):
+				print('No worker left, hashing the remaining files here.')
+				localThread.append(threading.Thread(target=hashLocally, name='coordinator-hasher'))
+				localThread[0].daemon = True
+				localThread[0].start()
+		digests, error = mergeResults(cliHasher.hashes, results, st.st_size)
+		if error is None:
+			cliHasher.storeDigests(fileName, st, digests)
+		processFile(fileName, fromFolder, digests, error, False, st.st_size)
+
+	pending = collections.deque()
+	try:
+		for item in walkCliInputs():
+			pending.append(submit(item))
+			while pending and (len(pending) > maxPendingFiles or len(pending[0]) == 1 or work.hasResults(pending[0][3])):
+				report(pending.popleft())
+		while pending:
+			report(pending.popleft())
+	finally:
+		work.finish()
+		for worker in workers:
+			worker.wait()
+		server.shutdown()
+		server.server_close()
+
+	print('')
+	for workerName, (count, nbytes) in work.counters.items():
+		print('Worker %s: %d job(s), %s.' % (workerName, count, byteToHumanSize(nbytes)))
+
+# (digests, error) of a file from the results of its jobs, in order. Parts
+# that don't add up to fileSize mean the file changed while being hashed.
+def mergeResults(hashes, results, fileSize):
+	for result in results:
+		if result.get('error'):
+			return {}, result['error']
+	if 'digests' in results[0]:
+		return results[0]['digests'], None
+	if sum(result['size'] for result in results) != fileSize:
+		return {}, 'File changed while being hashed!'
+	hashObjects = None
+	for result in results:
+		partObjects = [(name, hashConstructors[name]()) for name in hashes]
+		for name, hashObject in partObjects:
+			hashObject.setState(result['states'][name])
+		if hashObjects is None:
+			hashObjects = partObjects
+		else:
+			for (name, hashObject), (partName, partObject) in zip(hashObjects, partObjects):
+				hashObject.combine(partObject)
+	return dict((name, hashObject.hexdigest().upper()) for name, hashObject in hashObjects), None
 
-	for (dirpath, dirnames, filenames) in os.walk(path):
-		if usePattern:
-			filenames = patternMatching(filenames, pattern)
-		for fname in sorted(filenames):
-			processFile(os.path.join(dirpath, fname), True)
-		if (not usePattern and not recursive) or (usePattern and not searchSubFolder):
+# --localworkers: worker processes of this script, with the same read options
+def startLocalWorkers(host, port, count):
+	options = ['--blocksize', str(blockSize), '--readpath', readPath]
+	if not hashThreads:
+		options.append('--nohashthreads')
+	if dropPageCache:
+		options.append('--nopagecache')
+	devNull = open(os.devnull, 'wb')
+	try:
+		return [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', '%s:%d' % (host, port)] + options,
+			stdout=devNull) for i in range(count)]
+	finally:
+		devNull.close()
+
+# --worker: hashes what the coordinator hands out, with one connection (and
+# thread) per job of --jobs, until it says it's done
+def runWorker():
+	results = []
+	threads = [threading.Thread(target=lambda n=n: results.append(workerLoop(workerAddress, '%s-%d-%d' % (platform.node(), os.getpid(), n))))
+		for n in range(max(1, jobs))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	print('Worker done: %d job(s), %s.' % (sum(count for count, nbytes in results), byteToHumanSize(sum(nbytes for count, nbytes in results))))
+
+# One connection to the coordinator. Returns (jobs, bytes).
+def workerLoop(address, name):
+	connection = None
+	for attempt in range(50): # the coordinator might not be listening yet
+		try:
+			connection = socket.create_connection(address)
 			break
+		except EnvironmentError as e:
+			error = e
+			time.sleep(0.2)
+	if connection is None:
+		print("Couldn't connect to %s:%d: %s" % (address[0], address[1], getErrorText(error)))
+		return 0, 0
+
+	count = nbytes = 0
+	stream = connection.makefile('rwb')
+	writeLock = threading.Lock()
+	current = [None] # id of the job being hashed
+	try:
+		sendMessage(stream, {'hello': protocolVersion, 'name': name})
+		settings = receiveMessage(stream)
+		hasher = Hasher(settings['hashes'], blockSize=blockSize, autoBlockSize=autoBlockSize, readPath=readPath,
+			hashThreads=hashThreads, cpuCount=cpuCount, dropPageCache=dropPageCache,
+			chunkIndex=settings['chunkIndex'] is not None, chunkIndexSize=settings['chunkIndex'] or chunkIndexSize)
+		heartbeat = threading.Thread(target=sendHeartbeats, args=(stream, writeLock, current, settings['heartbeat']))
+		heartbeat.daemon = True
+		heartbeat.start()
+		while True:
+			job = receiveMessage(stream)
+			if job is None or job.get('done'):
+				break
+			current[0] = job['id']
+			result = runWorkerJob(hasher, job)
+			with writeLock:
+				current[0] = None
+				sendMessage(stream, result)
+			count += 1
+			nbytes += result.get('size', 0)
+			if debug:
+				print('%s    %s' % (job['path'], result.get('error') or 'done'))
+	except (EnvironmentError, ValueError) as e:
+		print('Connection to the coordinator lost: %s' % e)
+	finally:
+		with writeLock:
+			current[0] = None
+			stream.close()
+		connection.close()
+	return count, nbytes
+
+# Tells the coordinator the current job is still being hashed, so that it
+# doesn't hand it to another worker
+def sendHeartbeats(stream, writeLock, current, interval):
+	while True:
+		time.sleep(interval)
+		with writeLock:
+			if stream.closed:
+				return
+			if current[0] is not None:
+				try:
+					sendMessage(stream, {'working': current[0]})
+				except (EnvironmentError, ValueError):
+					return
+
+def runWorkerJob(hasher, job):
+	try:
+		if job['length'] is None:
+			st = os.stat(job['path'])
+			return {'id': job['id'], 'size': st.st_size, 'digests': hasher.hashFile(job['path'], st)}
+		hashObjects = hasher.newHashObjects()
+		fd = open(job['path'], 'rb')
+		try:
+			fd.seek(job['start'])
+			fadvise(fd, job['start'], job['length'], 'POSIX_FADV_SEQUENTIAL')
+			updateSequential(readRangeBlocks(fd, job['length'], hasher.blockSize), [hashObject for name, hashObject in hashObjects])
+		finally:
+			fd.close()
+		if hashObjects[0][1].size != job['length']: # it got shorter
+			return {'id': job['id'], 'error': 'File changed while being hashed!'}
+		return {'id': job['id'], 'size': hashObjects[0][1].size,
+			'states': dict((name, hashObject.getState()) for name, hashObject in hashObjects)}
+	except Exception as e:
+		return {'id': job['id'], 'error': getErrorText(e)}
 
 def patternMatching(filenames, pattern):
 
 	#pattern = 'C?*apter?.txt'
-	matchingFname = []
-
 	if not ('*' in pattern or  '?' in pattern):
 		return []
 
-	def convertPatternToRegex(pattern):
-		specialChars = '.^$*+?{}, \\[]|():=#!<'
-		regex = ''
-
-		# convert to unicode string first
-		# just assume all utf-8 -- this file is in this encoding anyway
-		if hasattr(pattern, 'decode'):
-			pattern = pattern.decode('utf-8')
-
-		# parse pattern
-		for i in range(len(pattern)):
-			char = pattern[i]
-			if char == '*' or char == '?':
-				if char == '?':
-					regex += '.'
-				elif char == '*':
-					regex += '(.*)'
-			else:
-				# escape stuff
-				if char in specialChars:
-					regex += '\\'
-				regex += char
-				if i == len(pattern) - 1: # end of pattern. Fixed a bug that made pattern blablah*.mkv match blablah.mkv.pass
-					regex += '$'
-
-		return regex
-
-	regPattern = convertPatternToRegex(pattern)
-	if debug:
-		print(regPattern)
-	regObject = re.compile(regPattern)
-
-	for fname in filenames:
-		match = regObject.match(fname)
-		if match:
-			matchingFname.append(fname)
+	matches = compilePattern(pattern)
+	matchingFname = [fname for fname in filenames if matches(fname)]
 
 	if debug:
 		print(matchingFname)
 
 	return matchingFname
 
+# Compiled patterns, by pattern. Folders are filtered with the same few
+# patterns over and over, so each is compiled only once.
+compiledPatterns = {}
+
+# Returns a function telling whether a filename matches the Unix shell-style
+# pattern (* is any string, ? is one character, everything else is literal).
+# The whole name must match. Patterns with a single * or none don't need a
+# regex: they're a prefix, a suffix, both, or the name itself.
+def compilePattern(pattern):
+	matches = compiledPatterns.get(pattern)
+	if matches is not None:
+		return matches
+
+	# convert to unicode string first
+	# just assume all utf-8 -- this file is in this encoding anyway
+	if hasattr(pattern, 'decode'):
+		text = pattern.decode('utf-8')
+	else:
+		text = pattern
+
+	if '?' in text or text.count('*') > 1:
+		regex = ''.join('.' if char == '?' else '.*' if char == '*' else re.escape(char) for char in text)
+		if debug:
+			print(regex)
+		matches = re.compile('(?s)%s\\Z' % regex).match
+	elif '*' not in text:
+		matches = lambda fname: fname == text
+	else:
+		prefix, suffix = text.split('*')
+		if not prefix and not suffix:
+			matches = lambda fname: True
+		elif not prefix:
+			matches = lambda fname: fname.endswith(suffix)
+		elif not suffix:
+			matches = lambda fname: fname.startswith(prefix)
+		else:
+			minLength = len(prefix) + len(suffix)
+			matches = lambda fname: len(fname) >= minLength and fname.startswith(prefix) and fname.endswith(suffix)
+
+	compiledPatterns[pattern] = matches
+	return matches
+
+# Filters filenames with include and exclude patterns: a name passes if it
+# matches any of the include patterns (or there are none) and none of the
+# exclude patterns.
+class NameFilter(object):
+	def __init__(self, includes = (), excludes = ()):
+		self.includes = [compilePattern(pattern) for pattern in includes]
+		self.excludes = [compilePattern(pattern) for pattern in excludes]
+
+	def matches(self, fname):
+		if self.includes and not any(matches(fname) for matches in self.includes):
+			return False
+		return not any(matches(fname) for matches in self.excludes)
+
+# NameFilter of the command line, None if there's nothing to filter
+def getNameFilter():
+	exclude = list(excludePatterns)
+	if chunkIndex or verifyChunks:
+		exclude.append('*' + chunkIndexExt) # the chunk indexes themselves
+	if not includePatterns and not exclude:
+		return None
+	return NameFilter(includePatterns, exclude)
+
 def byteToHumanSize(size):
 	if size >= 1000 * 1024 * 1024:
 		return '%0.3f GiB' % (size / (1024 ** 3))
@@ -414,37 +3106,19 @@ def checkUnicodeSupport():
 	return True
 
 def isPureAscii(text):
-	for c in text:
-		code = ord(c)
-		if code > 127:
-			return False
+	try:
+		text.encode('ascii')
+	except UnicodeError:
+		return False
 	return True
 
-# Converts text into UTF-16LE bytes
-# Nah, writing this instead of using the built-in one just for fun
+# Converts text into UTF-16LE bytes. Unpaired surrogates (undecodable bytes
+# in filenames) are written as is.
 def toUTF16leBytes(text):
-	encodedBytes = bytearray()
-	for c in text:
-		encodedBytes += toUTF16leBytesSub(c)
-	return encodedBytes
-
-# Encodes a single character
-# See RFC 2781, UTF-16, an encoding of ISO 10646 http://www.ietf.org/rfc/rfc2781.txt
-# Reference encoder: Unicode Code Converter http://rishida.net/tools/conversion/
-# Tests done with Notepad++
-def toUTF16leBytesSub(c):
-	U = ord(c)
-	if U < 0x10000:
-		return struct.pack("<H", U)
-	else:
-		U = U - 0x10000
-		W1 = 0xD800
-		W2 = 0xDC00
-		UH = U >> 10
-		UL = U - (UH << 10)
-		W1 ^= UH
-		W2 ^= UL
-		return struct.pack('<HH', W1, W2)
+	try:
+		return text.encode('utf-16-le', 'surrogatepass')
+	except LookupError: # Python 2
+		return text.encode('utf-16-le')
 
 def toAsciiBytes(text):
 	asciiText = removeNonAscii(text)
@@ -455,20 +3129,21 @@ def toAsciiBytes(text):
 
 # Kills non-ASCII characters
 def removeNonAscii(original):
-	result = ''
-	for c in original:
-		code = ord(c)
-		if code < 128:
-			result += c
-		else:
-			result += '?'
-	return result
+	try:
+		return original.encode('ascii', 'replace').decode('ascii')
+	except UnicodeError: # Python 2 byte string
+		return ''.join(c if ord(c) < 128 else '?' for c in original)
 
 # Parse paramenters
 def parseParams():
 	global pathList, addcrc, updatecrc, createsfv, sfvPath, force, recursive, searchSubFolder, showChecksumResult, showFileInfo, showFullPath
 	global enableMd5, enableSha1, enableSha256, enableSha512, enableEd2k, enableCrc, enableAll, enableMd4
-	global debug, waitBeforeExit
+	global debug, waitBeforeExit, jobs, hashThreads, readPath
+	global useCache, cachePath, cacheMaxSize, clearCache, checkManifests, blockSize, autoBlockSize
+	global benchmark, benchmarkLarge, includePatterns, excludePatterns
+	global readAhead, readAheadMemory, dropPageCache, splitJobs, timingsPath, metricsPath, watch, watchInterval, findDupes
+	global outputFormat, progressInterval, chunkIndex, chunkIndexSize, verifyChunks, verifyRanges, diffChunks
+	global resume, journalPath, dryRun, renameLogPath, undoRenames, serveAddress, workerAddress, localWorkers
 
 	pathList = []
 	treatAllAsFilenames = False
@@ -482,16 +3157,52 @@ def parseParams():
 				addcrc = True
 			elif arg == "updatecrc":
 				updatecrc = True
+			elif arg == "dryrun":
+				dryRun = True
+			elif arg == "renamelog" and i < len(sys.argv) - 1:
+				renameLogPath = sys.argv[i+1]
+				i += 1
+			elif arg == "undo":
+				undoRenames = True
 			elif arg == "createsfv" and i < len(sys.argv) - 1:
 				createsfv = True
 				sfvPath = sys.argv[i+1]
 				i += 1
 			elif arg == "force":
-				force == True
+				force = True
+			elif arg == "cache":
+				useCache = True
+			elif arg == "cachefile" and i < len(sys.argv) - 1:
+				useCache = True
+				cachePath = sys.argv[i+1]
+				i += 1
+			elif arg == "cachesize" and i < len(sys.argv) - 1:
+				try:
+					cacheMaxSize = int(float(sys.argv[i+1]) * 1024 * 1024)
+				except ValueError:
+					print('Invalid cache size: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == "clearcache":
+				clearCache = True
+			elif arg == "resume":
+				resume = True
+			elif arg == "journal" and i < len(sys.argv) - 1:
+				resume = True
+				journalPath = sys.argv[i+1]
+				i += 1
+			elif arg == "jobs" and i < len(sys.argv) - 1:
+				jobs = parseJobs(sys.argv[i+1])
+				i += 1
 			elif arg == "recursive":
 				recursive = True
 			elif arg == "searchsubfolder":
 				searchSubFolder = True
+			elif arg == "include" and i < len(sys.argv) - 1:
+				includePatterns.append(sys.argv[i+1])
+				i += 1
+			elif arg == "exclude" and i < len(sys.argv) - 1:
+				excludePatterns.append(sys.argv[i+1])
+				i += 1
 			elif arg == "quiet":
 				showChecksumResult = False
 			elif arg == 'debug':
@@ -512,13 +3223,9 @@ def parseParams():
 			elif arg == "ed2k":
 				enableEd2k = True
 			elif arg == "all":
-				enableMd4 = True
-				enableMd5 = True
-				enableSha1 = True
-				enableSha256 = True
-				enableSha512 = True
-				enableEd2k = True
-				enableCrc = True
+				for name in hashNames:
+					if isHashAvailable(name):
+						enableHash(name)
 			elif arg == "most":
 				enableCrc = True
 				enableMd5 = True
@@ -526,13 +3233,121 @@ def parseParams():
 				enableSha256 = True
 				enableSha512 = True
 				enableEd2k = True
+			elif arg == "sha3" and 'sha3_256' in hashConstructors:
+				enableHash('sha3_256')
+				enableHash('sha3_512')
+			elif getHashOption(arg):
+				enableHash(getHashOption(arg))
+			elif arg == 'nohashthreads':
+				hashThreads = False
+			elif arg == 'blocksize' and i < len(sys.argv) - 1:
+				if sys.argv[i+1].lower() == 'auto':
+					autoBlockSize = True
+				else:
+					size = parseSize(sys.argv[i+1])
+					if size:
+						blockSize = size
+						autoBlockSize = False
+					else:
+						print('Invalid block size: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'readpath' and i < len(sys.argv) - 1:
+				if sys.argv[i+1].lower() in readPaths:
+					readPath = sys.argv[i+1].lower()
+				else:
+					print('Invalid read path: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'readahead' and i < len(sys.argv) - 1:
+				try:
+					readAhead = max(1, int(sys.argv[i+1]))
+					readPath = 'prefetch'
+				except ValueError:
+					print('Invalid read-ahead: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'readaheadmem' and i < len(sys.argv) - 1:
+				try:
+					readAheadMemory = int(float(sys.argv[i+1]) * 1024 * 1024)
+				except ValueError:
+					print('Invalid read-ahead memory: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'nopagecache':
+				dropPageCache = True
+			elif arg == 'dupes':
+				findDupes = True
+			elif arg == 'chunkindex':
+				chunkIndex = True
+			elif arg == 'chunksize' and i < len(sys.argv) - 1:
+				size = parseSize(sys.argv[i+1])
+				if size:
+					chunkIndexSize = size
+				else:
+					print('Invalid chunk size: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'verifychunks':
+				verifyChunks = True
+			elif arg == 'ranges' and i < len(sys.argv) - 1:
+				verifyRanges = parseRanges(sys.argv[i+1])
+				if verifyRanges is None:
+					print('Invalid ranges: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'diffchunks':
+				diffChunks = True
+			elif arg == 'watch':
+				watch = True
+			elif arg == 'pollinterval' and i < len(sys.argv) - 1:
+				try:
+					watchInterval = max(0.1, float(sys.argv[i+1]))
+				except ValueError:
+					print('Invalid poll interval: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'format' and i < len(sys.argv) - 1:
+				if sys.argv[i+1].lower() in outputFormats:
+					outputFormat = sys.argv[i+1].lower()
+				else:
+					print('Invalid output format: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'progress' and i < len(sys.argv) - 1:
+				try:
+					progressInterval = max(1, int(sys.argv[i+1]))
+					showChecksumResult = False
+				except ValueError:
+					print('Invalid progress interval: %s' % sys.argv[i+1])
+				i += 1
+			elif arg == 'timings' and i < len(sys.argv) - 1:
+				timingsPath = sys.argv[i+1]
+				i += 1
+			elif arg == 'metrics' and i < len(sys.argv) - 1:
+				metricsPath = sys.argv[i+1]
+				i += 1
+			elif arg in ('serve', 'worker') and i < len(sys.argv) - 1:
+				address = parseAddress(sys.argv[i+1])
+				if address is None:
+					print('Invalid address: %s' % sys.argv[i+1])
+				elif arg == 'serve':
+					serveAddress = address
+				else:
+					workerAddress = address
+				i += 1
+			elif arg == 'localworkers' and i < len(sys.argv) - 1:
+				localWorkers = parseJobs(sys.argv[i+1])
+				i += 1
+			elif arg == 'split' and i < len(sys.argv) - 1:
+				splitJobs = parseJobs(sys.argv[i+1])
+				i += 1
+			elif arg == 'check':
+				checkManifests = True
+			elif arg == 'benchmark':
+				benchmark = True
+			elif arg == 'benchmarklarge':
+				benchmark = True
+				benchmarkLarge = True
 			elif arg == 'inputs':
 				treatAllAsFilenames = True
 			elif arg == 'showfileinfo':
 				showFileInfo = True
 			elif arg == 'showfullpath':
 				showFullPath = True
-		elif not treatAllAsFilenames and arg.startswith('-'):
+		elif not treatAllAsFilenames and arg.startswith('-') and arg != stdinName:
 			arg = arg[1:].lower()
 
 			if arg == "c" and i < len(sys.argv) - 1:
@@ -540,7 +3355,10 @@ def parseParams():
 				sfvPath = sys.argv[i+1]
 				i += 1
 			elif arg == "f":
-				force == True
+				force = True
+			elif arg == "j" and i < len(sys.argv) - 1:
+				jobs = parseJobs(sys.argv[i+1])
+				i += 1
 			elif arg == "r":
 				recursive = True
 			elif arg == "s":
@@ -565,13 +3383,9 @@ def parseParams():
 			elif arg == "ed2k":
 				enableEd2k = True
 			elif arg == "a":
-				enableMd4 = True
-				enableMd5 = True
-				enableSha1 = True
-				enableSha256 = True
-				enableSha512 = True
-				enableEd2k = True
-				enableCrc = True
+				for name in hashNames:
+					if isHashAvailable(name):
+						enableHash(name)
 			elif arg == "m":
 				enableMd5 = True
 				enableSha1 = True
@@ -579,6 +3393,10 @@ def parseParams():
 				enableSha512 = True
 				enableEd2k = True
 				enableCrc = True
+			elif getHashOption(arg):
+				enableHash(getHashOption(arg))
+			elif arg == 'k':
+				checkManifests = True
 			elif arg == 'i':
 				treatAllAsFilenames = True
 			elif arg == "q":
@@ -591,44 +3409,1026 @@ def parseParams():
 			pathList.append(arg)
 		i += 1
 
-def createChecksumFiles():
-	global createsfv, sfvPath, sfvPureAscii, sfvContent
+# Reads a checksum file, whatever its encoding. The SFVs we write are either
+# ASCII or UTF-16LE with a BOM.
+def readManifestText(manifestPath):
+	fd = open(manifestPath, 'rb')
+	try:
+		data = fd.read()
+	finally:
+		fd.close()
+	if data.startswith(b'\xff\xfe') or data.startswith(b'\xfe\xff'):
+		return data.decode('utf-16')
+	if data.startswith(b'\xef\xbb\xbf'):
+		return data[3:].decode('utf-8')
+	try:
+		return data.decode('utf-8')
+	except UnicodeDecodeError:
+		return data.decode('latin-1')
+
+def isHex(text):
+	return len(text) > 0 and hexDigits.issuperset(text)
+
+# Yields (name, hashName, digest) for each entry of a SFV, md5sum/sha*sum
+# (GNU "digest  name" or "digest *name") or BSD "MD5 (name) = digest" file.
+# Lines are split with plain string operations, only BSD lines use a regex.
+def parseManifest(manifestPath):
+	ext = os.path.splitext(manifestPath)[1].lower()
+	manifestType = manifestTypes.get(ext)
+	if ext == '.jsonl':
+		for entry in parseJsonManifest(manifestPath):
+			yield entry
+		return
+
+	for line in readManifestText(manifestPath).splitlines():
+		if not line.strip() or line.startswith(';') or line.startswith('#'):
+			continue
+
+		if line[0].isalpha() and ') = ' in line:
+			match = reBsdLine.match(line)
+			if match and match.group(1).upper().replace('-', '') in bsdHashNames:
+				yield toNativeSeparators(match.group(2)), bsdHashNames[match.group(1).upper().replace('-', '')], match.group(3).upper()
+				continue
+
+		if manifestType == 'crc32':
+			name, sep, digest = line.rstrip().rpartition(' ')
+			if sep and isHex(digest) and len(digest) == 8:
+				yield toNativeSeparators(name.rstrip()), 'crc32', digest.upper()
+				continue
+		else:
+			escaped = line.startswith('\\')
+			if escaped:
+				line = line[1:]
+			digest, sep, name = line.partition(' ')
+			if sep and isHex(digest) and (name.startswith(' ') or name.startswith('*')):
+				name = name[1:]
+				if escaped: # the GNU way, backslashes are part of the name
+					name = name.replace('\\n', '\n').replace('\\\\', '\\')
+				else:
+					name = toNativeSeparators(name)
+				hashName = manifestType or digestLengths.get(len(digest))
+				if hashName:
+					yield name, hashName, digest.upper()
+					continue
+			# No extension we know, maybe it's a SFV after all
+			name, sep, digest = line.rstrip().rpartition(' ')
+			if manifestType is None and sep and isHex(digest) and len(digest) == 8:
+				yield toNativeSeparators(name.rstrip()), 'crc32', digest.upper()
+				continue
+
+		if debug:
+			print('Unrecognized line in %s: %r' % (manifestPath, line))
+
+# The .jsonl checksum files ManifestWriter writes: an object per line, with
+# the name and a member per hash
+def parseJsonManifest(manifestPath):
+	for line in readManifestText(manifestPath).splitlines():
+		if not line.strip():
+			continue
+		try:
+			entry = json.loads(line)
+			name = entry['name']
+		except (ValueError, KeyError, TypeError):
+			if debug:
+				print('Unrecognized line in %s: %r' % (manifestPath, line))
+			continue
+		for hashName in hashNames:
+			if isinstance(entry.get(hashName), type(name)) and isHex(entry[hashName]):
+				yield name, hashName, entry[hashName].upper()
+
+# SFVs made on Windows use backslashes between folders
+def toNativeSeparators(name):
+	if os.sep != '\\':
+		return name.replace('\\', os.sep)
+	return name
+
+# Reads all checksum files in the inputs into a single index of
+# file path -> {hashName: [expected digests]}, in the order they are listed.
+# There's more than one digest only if checksum files disagree; then the
+# file can't be OK. The paths are relative to the checksum file's folder.
+def buildCheckIndex(inputs):
+	index = {}
+	order = []
+	for manifestPath, fromFolder in walkInputs(inputs, recursive, searchSubFolder):
+		if fromFolder and os.path.splitext(manifestPath)[1].lower() not in manifestTypes and not manifestPath.lower().endswith('.jsonl'):
+			continue
+		try:
+			entries = list(parseManifest(manifestPath))
+		except EnvironmentError as e:
+			print('%s    %s' % (manifestPath, e))
+			fag.append(manifestPath)
+			continue
+		folder = os.path.dirname(manifestPath)
+		for name, hashName, digest in entries:
+			fileName = os.path.normpath(os.path.join(folder, name))
+			if fileName not in index:
+				index[fileName] = {}
+				order.append(fileName)
+			digests = index[fileName].setdefault(hashName, [])
+			if digest not in digests:
+				digests.append(digest)
+	return [(fileName, index[fileName]) for fileName in order]
+
+# Verifies every file in the index in one pass, each file being read once
+# no matter how many checksum files list it
+def checkFiles(index):
+	global cliHasher
+	needed = set()
+	for fileName, expected in index:
+		needed.update(expected)
+	for name in needed:
+		enableHash(name)
+
+	cliHasher = makeHasher()
+
+	expectedByName = dict(index)
+	items = ((fileName, False) for fileName, expected in index)
+	for fileName, fromFolder, digests, error, fromCache, size in cliHasher.hashItems(items):
+		checkFile(fileName, expectedByName[fileName], digests, error, fromCache, size)
+
+def checkFile(fileName, expected, digests, error, fromCache, size):
+	global st_total, st_ok, st_notok, st_notfound, st_size, st_error, st_cached
+	st_total += 1
+	readSize = 0
+
+	if digests is None:
+		result = 'Not found!'
+		fag.append(fileName)
+		st_notfound += 1
+	elif error:
+		result = error
+		st_error += 1
+	else:
+		mismatches = [displayName for hashName, displayName in zip(hashNames, hashDisplayNames)
+			if hashName in expected and [digests[hashName]] != expected[hashName]]
+		if mismatches:
+			result = 'File not OK! %s mismatch.' % ', '.join(mismatches)
+			st_notok += 1
+		else:
+			result = 'File OK!'
+			st_ok += 1
+		if fromCache:
+			st_cached += 1
+		else:
+			readSize = getReadSize(fileName, size)
+			st_size += readSize
+
+	if progressReport is not None:
+		progressReport.add(readSize)
+	if resultOutput is not None:
+		resultOutput.add(fileName, size or 0, result, digests or {}, error)
+		return
+
+	if not terminalSupportUnicode:
+		fileName = removeNonAscii(fileName)
+	name2Show = fileName
+	if not showFullPath:
+		name2Show = os.path.basename(fileName)
+	if showChecksumResult or not result == 'File OK!':
+		print('%s    %s' % (name2Show, result))
+
+# Finds the files with the same content among items (as from walkInputs),
+# reading as little as possible: files are grouped by size, then files of a
+# size that isn't unique by the CRC-32 of their first and last sampleSize
+# bytes, and only files that still collide are hashed completely, with the
+# hasher's hashes (and its cache). Returns ([(size, digests, [fileNames])],
+# counters) with the groups of duplicates, biggest waste first. Empty files
+# are left out.
+def findDuplicates(items, hasher, sampleSize = dupeSampleSize):
+	counters = {'files': 0, 'sampled': 0, 'hashed': 0, 'bytesRead': 0, 'errors': 0}
+	bySize = collections.OrderedDict()
+	for item in items:
+		fileName, fromFolder = item[0], item[1]
+		if fileName == stdinName and not fromFolder:
+			continue
+		st = statItem(fileName, item[2] if len(item) > 2 else None)
+		if st is None or st.st_size == 0:
+			continue
+		counters['files'] += 1
+		bySize.setdefault(st.st_size, []).append((fileName, st))
+
+	# CRC-32 of the head and tail, for the files that share their size
+	def sample(candidate):
+		fileName, st = candidate
+		try:
+			return fileName, st, readHeadTailCrc(fileName, st.st_size, sampleSize)
+		except EnvironmentError:
+			return fileName, st, None
+
+	candidates = [candidate for files in bySize.values() if len(files) > 1 for candidate in files]
+	bySample = collections.OrderedDict()
+	for fileName, st, crc in hasher.mapFiles(sample, candidates):
+		counters['sampled'] += 1
+		if crc is None:
+			counters['errors'] += 1
+			continue
+		counters['bytesRead'] += min(st.st_size, 2 * sampleSize)
+		bySample.setdefault((st.st_size, crc), []).append((fileName, st))
+
+	# Full hashes, for the files that still collide. Files small enough to
+	# have been read whole while sampling are hashed again, which is cheap.
+	items = [(fileName, True) for files in bySample.values() if len(files) > 1 for fileName, st in files]
+	byHash = collections.OrderedDict()
+	for fileName, fromFolder, digests, error, fromCache, size in hasher.hashItems(items):
+		if digests is None or error:
+			counters['errors'] += 1
+			continue
+		counters['hashed'] += 1
+		if not fromCache:
+			counters['bytesRead'] += size
+		key = (size,) + tuple(sorted(digests.items()))
+		byHash.setdefault(key, []).append(fileName)
+
+	groups = [(key[0], dict(key[1:]), fileNames) for key, fileNames in byHash.items() if len(fileNames) > 1]
+	groups.sort(key=lambda group: group[0] * (len(group[2]) - 1), reverse=True)
+	return groups, counters
+
+# CRC-32 of the first and last sampleSize bytes of a file (or of the whole
+# file, if it's smaller than both)
+def readHeadTailCrc(fileName, fileSize, sampleSize):
+	fd = open(fileName, 'rb')
+	try:
+		if fileSize <= 2 * sampleSize:
+			return zlib.crc32(fd.read(fileSize)) & 0xffffffff
+		crc = zlib.crc32(fd.read(sampleSize))
+		fd.seek(fileSize - sampleSize)
+		return zlib.crc32(fd.read(sampleSize), crc) & 0xffffffff
+	finally:
+		fd.close()
+
+# --dupes: prints the groups of identical files among the inputs
+def printDuplicates():
+	global st_total, st_ok, st_size, st_error
+	groups, counters = findDuplicates(walkCliInputs(), cliHasher)
+	wasted = 0
+	for size, digests, fileNames in groups:
+		wasted += size * (len(fileNames) - 1)
+		hashes = ', '.join('%s: %s' % (displayName, digests[name]) for name, displayName in zip(hashNames, hashDisplayNames) if name in digests)
+		print('%d files of %s (%s):' % (len(fileNames), byteToHumanSize(size), hashes))
+		for fileName in fileNames:
+			print('    %s' % (fileName if terminalSupportUnicode else removeNonAscii(fileName)))
+		print('')
+
+	st_total = counters['files']
+	st_ok = sum(len(fileNames) - 1 for size, digests, fileNames in groups)
+	st_size = counters['bytesRead']
+	st_error = counters['errors']
+	print('Total: %d. Duplicate groups: %d. Duplicates: %d (%s wasted). Sampled: %d. Fully hashed: %d. Error: %d.' % (st_total,
+		len(groups), st_ok, byteToHumanSize(wasted), counters['sampled'], counters['hashed'], st_error))
 
-	if createsfv:
+def getChunkIndexPath(fileName):
+	return fileName + chunkIndexExt
+
+# The chunk index of a file, as written next to it: its size and mtime when
+# it was hashed, the chunk size, the hash, the root hash (the digest of the
+# ChunkIndexHash) and the hash of each chunk, in hex
+def makeChunkIndex(fileName, st, chunks):
+	return collections.OrderedDict([('name', os.path.basename(fileName)), ('size', st.st_size), ('mtime', st.st_mtime),
+		('chunkSize', chunks.chunkSize), ('hash', chunks.hashName), ('root', chunks.hexdigest()),
+		('chunks', [binascii.hexlify(chunkHash).decode('ascii') for chunkHash in chunks.getChunkHashes()])])
+
+# Replaces the file's chunk index atomically
+def writeChunkIndex(fileName, st, chunks):
+	path = getChunkIndexPath(fileName)
+	folder, base = os.path.split(path)
+	tempPath = os.path.join(folder, '.tmp.' + base)
+	with open(tempPath, 'wb') as fd:
+		fd.write(encodeUtf8(json.dumps(makeChunkIndex(fileName, st, chunks), ensure_ascii=False) + '\n'))
+	getattr(os, 'replace', os.rename)(tempPath, path)
+
+# Raises EnvironmentError if it can't be read, ValueError if it isn't one
+def loadChunkIndex(path):
+	with open(path, 'rb') as fd:
+		index = json.loads(fd.read().decode('utf-8'))
+	if not isinstance(index, dict) or any(key not in index for key in ('size', 'chunkSize', 'hash', 'chunks')):
+		raise ValueError('Not a chunk index: %s' % path)
+	try:
+		hashlib.new(index['hash'])
+	except ValueError:
+		raise ValueError('Unsupported chunk hash: %s' % index['hash'])
+	return index
+
+# Whether the file's chunk index was written from this very file
+def isChunkIndexCurrent(fileName, st, chunkSize = chunkIndexSize):
+	try:
+		index = loadChunkIndex(getChunkIndexPath(fileName))
+	except (EnvironmentError, ValueError):
+		return False
+	return index['size'] == st.st_size and index.get('mtime') == st.st_mtime and index['chunkSize'] == chunkSize
+
+# Reads the whole file to make its chunk index, without writing it
+def buildChunkIndex(fileName, chunkSize = chunkIndexSize, hashName = chunkIndexHash):
+	st = os.stat(fileName)
+	chunks = ChunkIndexHash(chunkSize, hashName)
+	fd = open(fileName, 'rb')
+	try:
+		updateSequential(readRangeBlocks(fd, st.st_size, blockSize), [chunks])
+	finally:
+		fd.close()
+	return makeChunkIndex(fileName, st, chunks)
+
+# Checks the file against its chunk index, reading only the chunks that
+# overlap ranges ([(start, end)], end None for the end of the file), or all
+# of them. Returns (bad chunk numbers, chunks checked, bytes read). Chunks
+# past the end of a file that got shorter are bad.
+def verifyChunkIndex(fileName, index, ranges = None):
+	chunkSize = index['chunkSize']
+	expected = index['chunks']
+	numbers = [number for number in range(len(expected)) if ranges is None or any(
+		number * chunkSize < (end if end is not None else index['size']) and (number + 1) * chunkSize > start
+		for start, end in ranges)]
+	bad = []
+	bytesRead = 0
+	fd = open(fileName, 'rb')
+	try:
+		for number in numbers:
+			start = number * chunkSize
+			length = min(chunkSize, index['size'] - start)
+			fd.seek(start)
+			fadvise(fd, start, length, 'POSIX_FADV_SEQUENTIAL')
+			chunkHash = hashlib.new(index['hash'])
+			dataLen = 0
+			for block in readRangeBlocks(fd, length, blockSize):
+				chunkHash.update(block)
+				dataLen += len(block)
+			bytesRead += dataLen
+			if dataLen < length or chunkHash.hexdigest() != expected[number].lower():
+				bad.append(number)
+	finally:
+		fd.close()
+	return bad, len(numbers), bytesRead
+
+# Numbers of the chunks that differ between two chunk indexes, those only
+# one of them has included
+def diffChunkIndexes(index1, index2):
+	if index1['chunkSize'] != index2['chunkSize'] or index1['hash'] != index2['hash']:
+		raise ValueError('The chunk indexes use different chunk sizes or hashes')
+	chunks1, chunks2 = index1['chunks'], index2['chunks']
+	return [number for number in range(max(len(chunks1), len(chunks2)))
+		if number >= len(chunks1) or number >= len(chunks2) or chunks1[number].lower() != chunks2[number].lower()]
+
+# "chunks 3-5 (bytes 29184000-58368000), chunk 9 (...)" for chunk numbers
+def formatChunkRuns(numbers, chunkSize, fileSize):
+	runs = []
+	for number in numbers:
+		if runs and runs[-1][1] == number - 1:
+			runs[-1][1] = number
+		else:
+			runs.append([number, number])
+	texts = []
+	for first, last in runs:
+		end = min((last + 1) * chunkSize, fileSize)
+		if first == last:
+			texts.append('chunk %d (bytes %d-%d)' % (first, first * chunkSize, end))
+		else:
+			texts.append('chunks %d-%d (bytes %d-%d)' % (first, last, first * chunkSize, end))
+	return ', '.join(texts)
+
+# Byte ranges like "100M-200M,1G-" for --ranges: [(start, end)], start 0
+# if it's left out and end None for the end of the file. Returns None if the text isn't valid.
+def parseRanges(text):
+	ranges = []
+	for part in text.split(','):
+		start, sep, end = part.strip().partition('-')
+		startSize = parseSize(start)
+		if not sep or (not startSize and start.strip() not in ('', '0')):
+			return None
+		endSize = None
+		if end.strip():
+			endSize = parseSize(end)
+			if endSize <= startSize:
+				return None
+		ranges.append((startSize, endSize))
+	return ranges
+
+# --verifychunks: checks the inputs against their chunk indexes and reports
+# the damaged parts of each file
+def verifyChunkFiles():
+	global st_total, st_ok, st_notok, st_notfound, st_size, st_error
+
+	def verifyItem(item):
+		fileName = item[0]
+		try:
+			index = loadChunkIndex(getChunkIndexPath(fileName))
+		except EnvironmentError:
+			return fileName, None, None, 'Chunk index not found!'
+		except ValueError as e:
+			return fileName, None, None, str(e)
 		try:
-			sfvFile = open(sfvPath, 'wb')
-			# encode to UTF-16LE if there is any non-ascii character
-			if sfvPureAscii:
-				for content in sfvContent:
-					sfvFile.write(toAsciiBytes(content))
+			return fileName, index, verifyChunkIndex(fileName, index, verifyRanges), None
+		except EnvironmentError as e:
+			return fileName, index, None, getErrorText(e)
+
+	items = walkCliInputs()
+	for fileName, index, verified, error in cliHasher.mapFiles(verifyItem, items):
+		st_total += 1
+		fileSize = index['size'] if index is not None else 0
+		if verified is None:
+			result = error
+			if index is None and not os.path.exists(fileName):
+				result = 'Not found!'
+			if index is None:
+				st_notfound += 1
+			else:
+				st_error += 1
+		else:
+			bad, checked, bytesRead = verified
+			st_size += bytesRead
+			try:
+				actualSize = os.path.getsize(fileName)
+			except EnvironmentError:
+				actualSize = fileSize
+			if bad:
+				result = 'File not OK! Bad %s.' % formatChunkRuns(bad, index['chunkSize'], fileSize)
+				st_notok += 1
+			elif actualSize != fileSize:
+				result = 'File not OK! Size is %d instead of %d.' % (actualSize, fileSize)
+				st_notok += 1
 			else:
-				# write BOM
-				sfvFile.write(struct.pack("<B", 255))
-				sfvFile.write(struct.pack("<B", 254))
-				for content in sfvContent:
-					sfvFile.write(toUTF16leBytes(content))
-			sfvFile.close()
+				result = 'File OK! %d of %d chunks checked.' % (checked, len(index['chunks']))
+				st_ok += 1
+
+		if progressReport is not None:
+			progressReport.add(verified[2] if verified is not None else 0)
+		if resultOutput is not None:
+			resultOutput.add(fileName, fileSize, result, {}, result if verified is None else None)
+			continue
+		name2Show = fileName if terminalSupportUnicode else removeNonAscii(fileName)
+		if not showFullPath:
+			name2Show = os.path.basename(name2Show)
+		if showChecksumResult or not result.startswith('File OK!'):
+			print('%s    %s' % (name2Show, result))
+
+# The chunk index of an input of --diffchunks: a chunk index file, the index
+# next to the file if it's current, else made from the file
+def getChunkIndexOf(path, chunkSize):
+	if path.endswith(chunkIndexExt):
+		return loadChunkIndex(path)
+	st = os.stat(path)
+	if isChunkIndexCurrent(path, st, chunkSize):
+		return loadChunkIndex(getChunkIndexPath(path))
+	return buildChunkIndex(path, chunkSize)
+
+# --diffchunks: which parts of two copies of a file differ, from their chunk
+# indexes, so that only the parts which differ need to be copied again
+def printChunkDiff():
+	global st_total, st_ok, st_notok, st_error
+	if len(pathList) != 2:
+		print('--diffchunks needs two inputs, files or chunk indexes.')
+		return
+	try:
+		# A file compared to a chunk index is cut in the same chunks
+		chunkSize = chunkIndexSize
+		for path in pathList:
+			if path.endswith(chunkIndexExt):
+				chunkSize = loadChunkIndex(path)['chunkSize']
+		index1, index2 = [getChunkIndexOf(path, chunkSize) for path in pathList]
+		differ = diffChunkIndexes(index1, index2)
+	except (EnvironmentError, ValueError) as e:
+		print(getErrorText(e) if isinstance(e, EnvironmentError) else e)
+		st_error += 1
+		return
+
+	st_total = max(len(index1['chunks']), len(index2['chunks']))
+	st_notok = len(differ)
+	st_ok = st_total - st_notok
+	if index1['size'] != index2['size']:
+		print('Sizes differ: %d and %d bytes.' % (index1['size'], index2['size']))
+	if differ:
+		print('%d of %d chunks differ: %s.' % (len(differ), st_total,
+			formatChunkRuns(differ, index1['chunkSize'], max(index1['size'], index2['size']))))
+	elif index1['size'] == index2['size']:
+		print('Same content (root hash %s).' % index1.get('root', ''))
+
+# Parses sizes like 4096, 512K or 2M (binary units)
+def parseSize(text):
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+	text = text.strip().upper().rstrip('IB')
+	multiplier = 1
+	if text and text[-1] in units:
+		multiplier = units[text[-1]]
+		text = text[:-1]
+	try:
+		size = int(float(text) * multiplier)
+	except ValueError:
+		return 0
+	return max(size, 0)
+
+# Number of worker threads. 'auto' or 0 means one per CPU
+def parseJobs(text):
+	if text.lower() == 'auto':
+		return cpuCount
+	try:
+		count = int(text)
+	except ValueError:
+		print('Invalid number of jobs: %s' % text)
+		return 1
+	if count <= 0:
+		return cpuCount
+	return count
+
+# Writes a checksum file as files get hashed, so that it never has to be
+# held in memory. The format comes from the extension:
+#  - .sfv (or anything unknown): "name CRC" lines after a comment header, in
+#    ASCII, or in UTF-16LE with a BOM if a name isn't pure ASCII. As that's
+#    only known at the first such name, what's been written so far is then
+#    converted.
+#  - .md4, .md5, .sha1, .sha256, .sha512, .ed2k: "hash  name" lines, like
+#    md5sum and sha256sum write them, in UTF-8.
+#  - .jsonl: one JSON object per line with the name, size and all hashes.
+class ManifestWriter(object):
+	def __init__(self, path):
+		self.path = path
+		self.format = getManifestFormat(path)
+		self.utf16 = False
+		self.file = open(path, 'w+b' if self.format == 'sfv' else 'wb')
+		if self.format == 'sfv':
+			self.file.write(toAsciiBytes(sfvHeader))
+
+	def add(self, name, digests, size):
+		if self.format == 'sfv':
+			line = '\n%s %s' % (name, digests.get('crc32', '%08X' % 0))
+			if not self.utf16 and not isPureAscii(line):
+				self.convertToUtf16()
+			self.file.write(toUTF16leBytes(line) if self.utf16 else line.encode('ascii'))
+		elif self.format == 'jsonl':
+			entry = collections.OrderedDict([('name', name), ('size', size)])
+			for hashName in hashNames:
+				if hashName in digests:
+					entry[hashName] = digests[hashName].lower()
+			self.file.write(encodeUtf8(json.dumps(entry, ensure_ascii=False) + '\n'))
+		else:
+			line = '%s  %s\n' % (digests[self.format].lower(), name)
+			if '\\' in name or '\n' in name: # escaped the GNU way
+				line = '\\%s  %s\n' % (digests[self.format].lower(), name.replace('\\', '\\\\').replace('\n', '\\n'))
+			self.file.write(encodeUtf8(line))
+
+	# Rewrites the ASCII written so far as UTF-16LE, a block at a time
+	def convertToUtf16(self):
+		tempPath = self.path + '.tmp'
+		converted = open(tempPath, 'w+b')
+		try:
+			converted.write(b'\xff\xfe') # BOM
+			self.file.seek(0)
+			while True:
+				data = self.file.read(1024 * 1024)
+				if not data:
+					break
+				converted.write(toUTF16leBytes(data.decode('ascii')))
+			self.file.close()
+			getattr(os, 'replace', os.rename)(tempPath, self.path)
 		except:
-			print("Couldn't open \"%s\" for writing!" % sfvPath)
+			converted.close()
+			raise
+		self.file = converted
+		self.utf16 = True
+
+	def close(self):
+		self.file.close()
+
+# 'sfv', 'jsonl', or the hash name of a md5sum-like file, from the extension
+def getManifestFormat(path):
+	ext = os.path.splitext(path)[1].lower()
+	if ext == '.jsonl':
+		return 'jsonl'
+	if ext in manifestTypes and ext != '.sfv':
+		return manifestTypes[ext]
+	return 'sfv'
+
+# The checksum file of --watch: entries are kept in memory, since files can
+# change or go away, and the file is rewritten after each batch of changes
+class ManifestTable(object):
+	def __init__(self, path):
+		self.path = path
+		self.entries = collections.OrderedDict()
+
+	def add(self, name, digests, size):
+		self.entries.pop(name, None) # moves it to the end, like a new file
+		self.entries[name] = (digests, size)
+
+	def remove(self, name):
+		self.entries.pop(name, None)
+
+	# Replaces the file atomically, so readers never see half of it
+	def save(self):
+		folder, base = os.path.split(self.path)
+		tempPath = os.path.join(folder, '.tmp.' + base)
+		writer = ManifestWriter(tempPath)
+		try:
+			for name, (digests, size) in self.entries.items():
+				writer.add(name, digests, size)
+		finally:
+			writer.close()
+		getattr(os, 'replace', os.rename)(tempPath, self.path)
+
+	def close(self):
+		self.save()
+
+def encodeUtf8(text):
+	try:
+		return text.encode('utf-8', 'surrogateescape')
+	except LookupError: # Python 2
+		return text.encode('utf-8')
+
+# Opens the checksum file of -c, enabling the hash it needs
+def openManifest():
+	global manifestWriter
+	if not createsfv:
+		return
+	try:
+		manifestWriter = ManifestTable(sfvPath) if watch else ManifestWriter(sfvPath)
+	except EnvironmentError:
+		print("Couldn't open \"%s\" for writing!" % sfvPath)
+		return
+	enableHash(getManifestFormat(sfvPath)) # sfv and jsonl aren't hashes
+
+def closeManifest():
+	global manifestWriter
+	if manifestWriter is not None:
+		try:
+			manifestWriter.close()
+		except EnvironmentError as e:
+			print("Couldn't write \"%s\": %s" % (sfvPath, e))
+		manifestWriter = None
+
+# Writes to a stream from its own thread, so that a slow terminal or pipe
+# doesn't hold up the hashing. write() only appends to a buffer; the thread
+# writes out whatever piled up at once. With more than outputBufferSize
+# characters waiting, write() waits too. Used as sys.stdout, so that every
+# print() goes through it and the output stays in order.
+class OutputStage(object):
+	def __init__(self, stream):
+		self.stream = stream
+		self.pending = []
+		self.pendingSize = 0
+		self.writing = False
+		self.closed = False
+		self.failed = False
+		self.lock = threading.Condition()
+		self.thread = threading.Thread(target=self.run, name='output')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def write(self, text):
+		with self.lock:
+			while self.pendingSize > outputBufferSize and not self.failed:
+				self.lock.wait()
+			if self.failed:
+				return
+			self.pending.append(text)
+			self.pendingSize += len(text)
+			self.lock.notify_all()
+
+	# Waits until everything written so far is out
+	def flush(self):
+		with self.lock:
+			while (self.pending or self.writing) and not self.failed:
+				self.lock.wait()
+
+	def run(self):
+		while True:
+			with self.lock:
+				while not self.pending and not self.closed:
+					self.lock.wait()
+				if not self.pending:
+					return
+				chunks, self.pending, self.pendingSize = self.pending, [], 0
+				self.writing = True
+				self.lock.notify_all()
+			try:
+				self.stream.write(''.join(chunks))
+				self.stream.flush()
+			except EnvironmentError: # e.g. the reader of the pipe went away
+				with self.lock:
+					self.failed = True
+			with self.lock:
+				self.writing = False
+				self.lock.notify_all()
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			self.lock.notify_all()
+		self.thread.join()
+
+	# encoding, isatty(), fileno()... of the real stream
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+# The results of --format json, csv or jsonl: the path, size, result and all
+# hashes of each file. json is one array, written as the files are hashed.
+# csv has a header line, with a column for each hash enabled at the first file.
+class ResultOutput(object):
+	def __init__(self, stream, format):
+		self.stream = stream
+		self.format = format
+		self.count = 0
+		self.columns = None
+
+	def add(self, path, size, result, digests, error):
+		entry = collections.OrderedDict([('path', path), ('size', size), ('result', result)])
+		if error:
+			entry['error'] = error
+		for hashName in hashNames:
+			if hashName in digests:
+				entry[hashName] = digests[hashName].lower()
+
+		if self.format == 'csv':
+			if self.columns is None:
+				self.columns = getEnabledHashes()
+				self.stream.write(','.join(['path', 'size', 'result'] + self.columns) + '\n')
+			fields = [path, str(size), result] + [entry.get(hashName, '') for hashName in self.columns]
+			self.stream.write(','.join(csvField(field) for field in fields) + '\n')
+		elif self.format == 'json':
+			self.stream.write(('[\n' if self.count == 0 else ',\n') + json.dumps(entry))
+		else:
+			self.stream.write(json.dumps(entry) + '\n')
+		self.count += 1
+
+	def close(self):
+		if self.format == 'json':
+			self.stream.write('\n]\n' if self.count else '[]\n')
+
+def csvField(text):
+	if any(c in text for c in ',"\r\n'):
+		return '"%s"' % text.replace('"', '""')
+	return text
+
+# --progress: instead of a line per file, the files done, the bytes read and
+# the speed since the previous report, at most every progressInterval ms, on
+# stderr. On a terminal the report is rewritten in place.
+class ProgressReport(object):
+	def __init__(self, interval, stream):
+		self.interval = interval / 1000.0
+		self.stream = stream
+		self.isTerminal = hasattr(stream, 'isatty') and stream.isatty()
+		self.files = 0
+		self.bytes = 0
+		self.startTime = self.lastTime = preciseTimer()
+		self.lastBytes = 0
+
+	def add(self, size):
+		self.files += 1
+		self.bytes += size
+		now = preciseTimer()
+		if now - self.lastTime >= self.interval:
+			self.report(now, self.bytes - self.lastBytes, now - self.lastTime)
+
+	def report(self, now, nbytes, seconds):
+		line = '%d files, %s read, %s/s' % (self.files, byteToHumanSize(self.bytes), byteToHumanSize(nbytes / max(seconds, 1e-9)))
+		self.stream.write('\r%s\x1b[K' % line if self.isTerminal else line + '\n')
+		self.stream.flush()
+		self.lastTime = now
+		self.lastBytes = self.bytes
+
+	# Last report, with the average speed of the whole run
+	def close(self):
+		now = preciseTimer()
+		self.report(now, self.bytes, now - self.startTime)
+		if self.isTerminal:
+			self.stream.write('\n')
+
+# Starts the output thread. With --format other than text, stdout only gets
+# the results, and everything else that's printed goes to stderr.
+def openOutput():
+	global outputStage, resultOutput, progressReport
+	outputStage = OutputStage(sys.stdout)
+	if outputFormat == 'text':
+		sys.stdout = outputStage
+	else:
+		resultOutput = ResultOutput(outputStage, outputFormat)
+		sys.stdout = sys.stderr
+	if progressInterval:
+		progressReport = ProgressReport(progressInterval, sys.stderr)
+
+def closeProgress():
+	global progressReport
+	if progressReport is not None:
+		progressReport.close()
+		progressReport = None
+
+def closeOutput():
+	global outputStage, resultOutput
+	closeProgress()
+	if resultOutput is not None:
+		resultOutput.close()
+		resultOutput = None
+	if outputStage is not None:
+		sys.stdout = outputStage.stream
+		outputStage.close()
+		outputStage = None
+
+def isHashAvailable(name):
+	if name not in hashConstructors:
+		return False
+	try:
+		hashConstructors[name]()
+	except ValueError: # no MD4 in this OpenSSL
+		return False
+	return True
+
+# Peak resident set size of this process so far, in KiB
+def getPeakRss():
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin': # bytes there, KiB everywhere else
+		peak //= 1024
+	return peak
+
+def getPhysicalMemory():
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	except (AttributeError, ValueError, OSError):
+		return None
+
+# Writes the synthetic files of a set, reusing the ones of the right size
+# from a previous run. Content doesn't matter to any of the hashes, so the
+# same random block is repeated.
+def createBenchmarkFiles(folder, name, sizes):
+	pattern = os.urandom(8 * 1024 * 1024)
+	fileNames = []
+	for i, size in enumerate(sizes):
+		fileName = os.path.join(folder, '%s_%04d.bin' % (name, i))
+		fileNames.append(fileName)
+		if os.path.isfile(fileName) and os.path.getsize(fileName) == size:
+			continue
+		fd = open(fileName, 'wb')
+		try:
+			remain = size
+			while remain > 0:
+				fd.write(pattern[:min(remain, len(pattern))])
+				remain -= len(pattern)
+		finally:
+			fd.close()
+	return fileNames
+
+def benchmarkRun(hasher, fileNames):
+	totalSize = 0
+	errors = 0
+	startTime = defaultTimer()
+	uOld, sOld, cOld, c, e = os.times()
+	for fileName, digests, error in hasher.hashFiles(fileNames):
+		if error:
+			errors += 1
+		else:
+			totalSize += os.path.getsize(fileName)
+	endTime = defaultTimer()
+	uNew, sNew, cNew, c, e = os.times()
+	# getCpuStat makes up the elapsed time when os.times() didn't move (10 ms
+	# steps), so it's only used for the CPU percentage
+	elapsed = max(endTime - startTime, 1e-9)
+	cpuTime = (uNew + sNew) - (uOld + sOld)
+	cpuPercentage = getCpuStat(uOld + sOld, uNew + sNew, startTime, endTime)[1] if cpuTime else 0.0
+	return {
+		'bytes': totalSize,
+		'seconds': round(elapsed, 6),
+		'mibPerSec': round(totalSize / 1048576.0 / elapsed, 3),
+		'cpuTime': round(cpuTime, 6),
+		'cpuPercent': round(cpuPercentage, 2),
+		'peakRssKiB': getPeakRss(),
+		'errors': errors,
+	}
+
+# Hashes synthetic files with every combination of hash types, block sizes,
+# read paths and worker counts, and prints the results as JSON.
+# The files are fresh in the OS cache, so except for the "large" set (bigger
+# than RAM, only with --benchmarklarge) this measures the hashing engine,
+# not the disk. Peak RSS is the process' peak so far, so it only grows.
+def runBenchmark():
+	import tempfile
+
+	folder = benchmarkDir
+	removeFolder = folder is None
+	if removeFolder:
+		folder = tempfile.mkdtemp(prefix='crc32_benchmark_')
+	elif not os.path.isdir(folder):
+		os.makedirs(folder)
+
+	fileSets = list(benchmarkFileSets)
+	if benchmarkLarge:
+		memory = getPhysicalMemory()
+		if memory:
+			fileSets.append(('large', [memory + memory // 10]))
+		else:
+			sys.stderr.write("Can't tell the size of the RAM, skipping the large file.\n")
+
+	workerCounts = sorted(set([1, cpuCount]))
+	hashSets = [names for names in benchmarkHashSets if all(isHashAvailable(name) for name in names)]
+	report = {
+		'program': programName,
+		'version': version,
+		'python': sys.version.split()[0],
+		'implementation': platform.python_implementation(),
+		'platform': sys.platform,
+		'cpuCount': cpuCount,
+		'hashThreads': hashThreads,
+		'skippedHashSets': [names for names in benchmarkHashSets if names not in hashSets],
+		'results': [],
+	}
+
+	try:
+		for setName, sizes in fileSets:
+			sys.stderr.write('Creating %s files...\n' % setName)
+			fileNames = createBenchmarkFiles(folder, setName, sizes)
+			for names in hashSets:
+				for size in benchmarkBlockSizes:
+					for path in benchmarkReadPaths:
+						for workerCount in workerCounts:
+							if workerCount > 1 and len(fileNames) == 1:
+								continue
+							hasher = Hasher(names, blockSize=size, readPath=path, hashThreads=hashThreads,
+								jobs=workerCount, cpuCount=cpuCount)
+							result = {'fileSet': setName, 'files': len(fileNames), 'hashes': names,
+								'blockSize': size, 'readPath': path, 'jobs': workerCount}
+							result.update(benchmarkRun(hasher, fileNames))
+							report['results'].append(result)
+							sys.stderr.write('%-7s %-45s %8s %-8s jobs=%d  %10.3f MiB/s  CPU %6.2f %%\n' % (setName,
+								'+'.join(names), byteToHumanSize(size), path, workerCount, result['mibPerSec'], result['cpuPercent']))
+	finally:
+		if removeFolder:
+			shutil.rmtree(folder, ignore_errors=True)
+
+	print(json.dumps(report, indent=1, sort_keys=True))
 
 def printReadme():
 	# Print user manual
 	print("%s v%s by %s\n" % (programName, version, author))
 	print("Syntax: python crc32.py [options] inputs\n")
-	print("Input can be individual files, and/or folders.")
+	print("Input can be individual files, and/or folders. Use - to read from stdin.")
 	print("  Use Unix shell-style wildcard (*, ?) for the filename pattern.\n")
 	print("Options:")
 	print("  --addcrc                        Add CRC-32 to filenames.")
 	print("  --updatecrc                     Update CRC-32 to filenames.")
-	print("  -c | --createsfv out.sfv        Create a SFV file.")
+	print("  --dryrun                        Only show what --addcrc and --updatecrc would rename.")
+	print("  --renamelog file                Write the undo log of the renames to this file.")
+	print("  --undo                          Treat inputs as undo logs and rename the files back.")
+	print("  -c | --createsfv out.sfv        Create a checksum file (sfv, md5, sha1, sha256, sha512, jsonl).")
 	print("  -r | --recursive                Also include sub-folder.")
 	print("  -s | --searchsubfolder          Also search sub-folder for matching filenames.")
+	print("  --include pattern               Only hash files in folders matching the pattern.")
+	print("  --exclude pattern               Skip files in folders matching the pattern.")
+	print("                                  Both can be given more than once.")
 	print("  --<hashtype>                    Enable the specified hash type.")
 	print("  -m | --most                     Enable CRC-32, MD5, SHA-1, SHA-256, SHA-512, and ED2K.")
 	print("  -a | -all                       Enable all supported hashes.")
+	print("  -j | --jobs N                   Hash N files at the same time (auto = one per CPU).")
+	print("  --nohashthreads                 Don't use a separate thread for each hash type.")
+	print("  --blocksize size|auto           Read size, e.g. 512K or 4M (default 2M). auto measures")
+	print("                                  the fastest size for each disk and remembers it.")
+	print("  --readpath auto|read|readinto|mmap|prefetch")
+	print("                                  How files are read. auto picks by file size.")
+	print("  --readahead N                   Read N blocks ahead in another thread (implies")
+	print("                                  --readpath prefetch, default 4).")
+	print("  --readaheadmem MiB              Memory for read-ahead blocks, all jobs together (default 256).")
+	print("  --nopagecache                   Drop hashed files from the OS page cache.")
+	print("  --dupes                         List the files with the same content instead. Files are")
+	print("                                  compared by size, then by their first and last 64 KiB,")
+	print("                                  and only then hashed completely.")
+	print("  --chunkindex                    Also write file.chunks next to each file, with the hash of")
+	print("                                  each chunk of the file (see --chunksize).")
+	print("  --chunksize size                Chunk size of --chunkindex (default 9500K, as ED2K).")
+	print("  --verifychunks                  Check the inputs against their .chunks files instead, and")
+	print("                                  show which parts of them are damaged.")
+	print("  --ranges list                   Only check the chunks in these byte ranges, e.g. 1G-2G,3G-")
+	print("  --diffchunks file1 file2        Show which chunks of two copies of a file differ. Either")
+	print("                                  can be a .chunks file.")
+	print("  --watch                         After hashing the inputs, keep hashing files added to or")
+	print("                                  changed in them, and keep the checksum file up to date.")
+	print("  --pollinterval seconds          How often --watch looks for changes without inotify (default 2).")
+	print("  --format text|json|csv|jsonl    Output format of the results. Other than text, stdout only")
+	print("                                  gets the path, size, result and hashes of each file, and")
+	print("                                  the rest goes to stderr.")
+	print("  --progress ms                   Instead of a line per file, show the files done and the")
+	print("                                  speed on stderr, at most every ms milliseconds.")
+	print("  --timings file.jsonl            Write the size, time reading and in each hash, read path")
+	print("                                  and worker of each file hashed.")
+	print("  --metrics file                  Write counters and histograms of the run, as JSON if the")
+	print("                                  file ends with .json, else in the Prometheus text format.")
+	print("  --serve [host:]port             Hand out the files to hash to the workers that connect to this")
+	print("                                  address (localhost if host is left out), and report them here.")
+	print("  --localworkers N                Also start N worker processes on this machine (auto = one per CPU).")
+	print("  --worker host:port              Hash files for the coordinator at this address, until it's done.")
+	print("                                  With -j N, N files at once.")
+	print("  --split N                       Hash big files in N parts at the same time (auto = one per CPU).")
+	print("                                  Only when CRC-32 and ED2K are the only hashes enabled.")
+	print("  --cache                         Remember hashes and skip files that didn't change.")
+	print("  --cachefile file                Use this hash cache file (implies --cache).")
+	print("  --cachesize MiB                 Maximum size of the hash cache (default 64).")
+	print("  --clearcache                    Empty the hash cache.")
+	print("  --resume                        Keep a journal of the run, and if it gets interrupted, go on")
+	print("                                  from where it stopped the next time it's run with --resume.")
+	print("  --journal file                  Use this journal file (implies --resume).")
+	print("  -f | --force                    Read all files even if they are in the hash cache.")
+	print("  -k | --check                    Treat inputs as checksum files (sfv, md5, sha1, sha256, sha512, jsonl)")
+	print("                                  and verify the files listed in them.")
+	print("  --benchmark [folder]            Measure the speed of all hash types, block sizes, read paths")
+	print("                                  and job counts on synthetic files. Prints JSON.")
+	print("  --benchmarklarge [folder]       Same, also with a file larger than the RAM.")
 	print("  -i | --inputs                   Treat all remaining paramenters as filenames.\n")
-	print("  Currently supported hash types: CRC-32, MD4, MD5, SHA-1, SHA-256, SHA-512, ED2K.")
-	print("  Please use lowercase and no hyphen for hash types. CRC-32 is enabled by default.\n")
+	print("  Currently supported hash types: %s." % ', '.join(hashDisplayNames))
+	print("  Please use lowercase and no hyphen for hash types (%s)." % ', '.join(hashNames))
+	print("  CRC-32 is enabled by default. --sha2 and --sha3 enable both sizes.\n")
 	print("Examples:")
 	print('  python crc32.py \"/home/yumi/Desktop/[FFF] Unbreakable Machine-Doll - 11 [A3A1001B].mkv\"')
 	print('  python crc32.py --md5 --sha1 ~/Desktop ~/Downloads/*.mkv \"/var/www/upload/Ep ??.mkv\"')
@@ -641,7 +4441,10 @@ def checkSanity():
 		print('terminalSupportUnicode = %s' % terminalSupportUnicode)
 
 	if len(pathList) < 1: # no imput
-		printReadme()
+		if clearCache:
+			openCache()
+		else:
+			printReadme()
 		sys.exit()
 
 def initStuff():
@@ -660,38 +4463,85 @@ def initStuff():
 	cpuCount = detectCPUs()
 
 def doStuff():
+	openOutput()
+	try:
+		printStuff()
+	finally:
+		closeRenames()
+		closeJournal(False)
+		closeOutput()
+
+	if waitBeforeExit:
+		print(' ')
+		if sys.version_info[0] < 3:
+			dummy = raw_input('Press Enter To Exit...')
+		else:
+			dummy = input('Press Enter To Exit...')
+
+# Hashes the inputs and prints the stats, through the output stage
+def printStuff():
+	global cliHasher
 	startTime = defaultTimer()
 	uOld, sOld, cOld, c, e = os.times()
 
-	sfvContent.append(sfvHeader)
-	sfvPureAscii = True
-
 	# Process files and folders
 	print('Processing %d input(s)...\n' % len(pathList))
 	if debug:
 		print(pathList)
+		print('jobs = %d' % jobs)
 
-	for path in pathList:
-		if os.path.isfile(path):
-			processFile(path) # processFolderv2 also works with file, but this saves some cpu circles
-		elif os.path.isdir(path):
-			processFolderv2(path)
-		elif (path.endswith(os.sep) or path.endswith("'") or path.endswith('"')) and os.path.isdir(path[:-1]):
-			processFolderv2(path[:-1])
-		elif ("*" in path) or ("?" in path): # depreciated
-		 	processFolderv2(path)
+	openCache()
+	openStats()
+
+	if checkManifests:
+		checkFiles(buildCheckIndex(pathList))
+	elif findDupes:
+		cliHasher = makeHasher()
+		printDuplicates()
+	elif verifyChunks:
+		cliHasher = makeHasher()
+		verifyChunkFiles()
+	elif diffChunks:
+		printChunkDiff()
+	elif undoRenames:
+		undoRenameLogs()
+	else:
+		openManifest()
+		openJournal()
+		openRenames()
+		if serveAddress:
+			distributeInputs()
 		else:
-			processFolderv2(path)
+			cliHasher = makeHasher()
+			for fileName, fromFolder, digests, error, fromCache, fileSize in cliHasher.hashItems(walkCliInputs()):
+				processFile(fileName, fromFolder, digests, error, fromCache, fileSize)
+		if watch:
+			if renameStage is not None:
+				renameStage.commit()
+			saveWatchState()
+			watchInputs()
+		closeRenames()
+		closeJournal(True)
 
 	endTime = defaultTimer()
 
-	createChecksumFiles()
+	closeProgress()
+	closeCache()
+	closeManifest()
+	closeStats()
 
 	# Print stats
 	uNew, sNew, cNew, c, e = os.times()
 	cpuTime, cpuPercentage, elapsed = getCpuStat(uOld + sOld, uNew + sNew, startTime, endTime)
 
-	print("\nTotal: %d. OK: %d. Not OK: %d. CRC not found: %d. Error: %d." % (st_total, st_ok, st_notok, st_notfound, st_error))
+	if checkManifests or verifyChunks or undoRenames:
+		print("\nTotal: %d. OK: %d. Not OK: %d. Missing: %d. Error: %d." % (st_total, st_ok, st_notok, st_notfound, st_error))
+	elif findDupes or diffChunks:
+		pass # printDuplicates and printChunkDiff have their own
+	else:
+		print("\nTotal: %d. OK: %d. Not OK: %d. CRC not found: %d. Error: %d." % (st_total, st_ok, st_notok, st_notfound, st_error))
+	if useCache or resume:
+		print("Cached: %d." % st_cached)
 
 	speed = st_size * 1.0 / elapsed
 	print("Speed: %s read in %0.3f sec =>  %s/s." % (byteToHumanSize(st_size), elapsed, byteToHumanSize(speed)))
@@ -701,18 +4551,25 @@ def doStuff():
 	# So many bugs
 	if debug:
 		print(' ')
-		print('Terminal supporting unicode = %s' % terminalSupportUnicode())
+		print('Terminal supporting unicode = %s' % terminalSupportUnicode)
 		print('fag = %r' % fag)
 
-	if waitBeforeExit:
-		print(' ')
-		if sys.version_info[0] < 3:
-			dummy = raw_input('Press Enter To Exit...')
-		else:
-			dummy = input('Press Enter To Exit...')
 
+def main():
+	global benchmarkDir
+	initStuff()
+	parseParams()
+	if benchmark:
+		if pathList:
+			benchmarkDir = pathList[0]
+		runBenchmark()
+	elif workerAddress:
+		runWorker()
+	else:
+		checkSanity()
+		doStuff()
+		if renameFailures:
+			sys.exit(1)
 
-initStuff()
-parseParams()
-checkSanity()
-doStuff()
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,42 @@
+import hashlib
+import os
+import zlib
+
+import python_crc32_hasher as hasher
+
+
+def makeTree(tmp_path):
+	(tmp_path / 'sub').mkdir()
+	(tmp_path / 'a.txt').write_bytes(b'a')
+	(tmp_path / 'b.bin').write_bytes(b'bb')
+	(tmp_path / 'sub' / 'c.txt').write_bytes(b'ccc')
+
+
+def test_HashJob(tmp_path):
+	makeTree(tmp_path)
+	job = hasher.HashJob([str(tmp_path)], hasher.Hasher(['crc32', 'md5']), recursive=True, include=['*.txt'])
+	results = job.run()
+	assert sorted(os.path.basename(result.fileName) for result in results) == ['a.txt', 'c.txt']
+	for result in results:
+		with open(result.fileName, 'rb') as fd:
+			data = fd.read()
+		assert result.digests == {'crc32': '%08X' % zlib.crc32(data), 'md5': hashlib.md5(data).hexdigest().upper()}
+		assert result.size == len(data)
+		assert not result.error and not result.fromCache
+	assert (job.total, job.ok, job.errors, job.notFound, job.size) == (2, 2, 0, 0, 4)
+
+
+def test_hashFiles_missing(tmp_path):
+	makeTree(tmp_path)
+	results = list(hasher.Hasher().hashFiles([str(tmp_path / 'a.txt'), str(tmp_path / 'missing')]))
+	assert results[0] == (str(tmp_path / 'a.txt'), {'crc32': '%08X' % zlib.crc32(b'a')}, None)
+	assert results[1] == (str(tmp_path / 'missing'), {}, 'Not found or invalid!')
+
+
+def test_legacy_hasher_tuple(tmp_path):
+	makeTree(tmp_path)
+	result = hasher.Hasher(['crc32', 'md5']).hasher(str(tmp_path / 'a.txt'))
+	assert result[0] == zlib.crc32(b'a')
+	assert hashlib.md5(b'a').hexdigest().upper() in result
+	assert result[-1] is False
+	assert hasher.Hasher().hasher(str(tmp_path / 'missing'))[-1]
@@ -0,0 +1,31 @@
+import os
+
+import python_crc32_hasher as hasher
+
+
+def test_benchmarkRun(tmp_path):
+	fileNames = []
+	for n in range(3):
+		path = tmp_path / ('f%d.bin' % n)
+		path.write_bytes(os.urandom(100000))
+		fileNames.append(str(path))
+	result = hasher.benchmarkRun(hasher.Hasher(), fileNames + [str(tmp_path / 'missing')])
+	assert result['bytes'] == 300000
+	assert result['errors'] == 1
+	assert result['seconds'] > 0
+	assert result['mibPerSec'] > 0
+
+
+# os.times() moves in steps of 10 ms: a short run that didn't use any CPU
+# time as far as it knows still has its real elapsed time
+def test_benchmarkRun_without_cpu_time(tmp_path, monkeypatch):
+	path = tmp_path / 'a.bin'
+	path.write_bytes(b'a' * 1000)
+	monkeypatch.setattr(os, 'times', lambda: (1.0, 1.0, 0.0, 0.0, 0.0))
+	clock = iter([10.0, 10.25])
+	monkeypatch.setattr(hasher, 'defaultTimer', lambda: next(clock))
+	result = hasher.benchmarkRun(hasher.Hasher(), [str(path)])
+	assert result['seconds'] == 0.25
+	assert result['cpuTime'] == 0
+	assert result['cpuPercent'] == 0
+	assert result['mibPerSec'] == round(1000 / 1048576.0 / 0.25, 3)
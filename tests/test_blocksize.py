@@ -0,0 +1,55 @@
+import os
+import zlib
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+@pytest.mark.parametrize('text, expected', [('4096', 4096), ('512K', 512 * 1024), ('2M', 2 * 1024 ** 2),
+	('1g', 1024 ** 3), ('2MiB', 2 * 1024 ** 2)])
+def test_parseSize(text, expected):
+	assert hasher.parseSize(text) == expected
+
+
+@pytest.mark.parametrize('blockSize', [1, 4096, 65536 + 1, 1 << 20])
+def test_block_sizes_give_the_same_digests(tmp_path, blockSize):
+	data = os.urandom(200000)
+	path = tmp_path / 'data.bin'
+	path.write_bytes(data)
+	for readPath in ('read', 'readinto'):
+		assert hasher.Hasher(blockSize=blockSize, readPath=readPath).hashFile(str(path)) == {'crc32': '%08X' % zlib.crc32(data)}
+
+
+# Each candidate is measured on tuneBytes bytes, then the fastest one is kept
+def test_BlockSizeTuner(monkeypatch):
+	monkeypatch.setattr(hasher, 'blockSizeCandidates', [1024, 2048, 4096])
+	monkeypatch.setattr(hasher, 'tuneBytes', 10000)
+	saved = []
+	monkeypatch.setattr(hasher, 'saveTunedBlockSize', lambda device, size: saved.append((device, size)))
+	tuner = hasher.BlockSizeTuner('/dev/test')
+	speeds = {1024: 1.0, 2048: 3.0, 4096: 2.0} # bytes per second, relative
+	while not tuner.best:
+		size = tuner.nextSize()
+		tuner.record(size, 5000, 5000 / speeds[size])
+	assert tuner.best == 2048
+	assert tuner.nextSize() == 2048
+	assert saved == [('/dev/test', 2048)]
+
+
+# With hash threads, reading a block doesn't wait for it to be hashed, so it
+# can't be timed; the file is hashed with the default block size instead
+@pytest.mark.parametrize('cpuCount, measured', [(1, True), (2, False)])
+def test_no_tuning_with_hash_threads(tmp_path, monkeypatch, cpuCount, measured):
+	monkeypatch.setattr(hasher, 'blockSizeCandidates', [1024, 2048, 4096])
+	monkeypatch.setattr(hasher, 'blockSizeTuners', {})
+	monkeypatch.setattr(hasher, 'tunedBlockSizes', {})
+	monkeypatch.setattr(hasher, 'saveTunedBlockSize', lambda device, size: None)
+	data = os.urandom(100000)
+	path = tmp_path / 'data.bin'
+	path.write_bytes(data)
+	job = hasher.Hasher(['crc32', 'md5'], autoBlockSize=True, readPath='read', cpuCount=cpuCount)
+	assert job.hashFile(str(path))['crc32'] == '%08X' % zlib.crc32(data)
+	tuner = hasher.getBlockSizeTuner(str(path), os.stat(str(path)).st_dev)
+	assert bool(tuner.results) == measured
+	assert not tuner.lock.locked()
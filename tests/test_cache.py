@@ -0,0 +1,51 @@
+import os
+import zlib
+
+import python_crc32_hasher as hasher
+
+
+def makeFile(tmp_path, data):
+	path = tmp_path / 'a.bin'
+	path.write_bytes(data)
+	return str(path)
+
+
+def test_lookup_after_store(tmp_path):
+	cache = hasher.HashCache(str(tmp_path / 'cache.sqlite'))
+	fileName = makeFile(tmp_path, b'abc')
+	st = os.stat(fileName)
+	cache.store(fileName, st, {'crc32': '352441C2'})
+	assert cache.lookup(fileName, st, ['crc32']) == {'crc32': '352441C2'}
+	assert cache.lookup(fileName, st, ['crc32', 'md5']) is None # md5 never stored
+
+
+def test_lookup_after_change(tmp_path):
+	cache = hasher.HashCache(str(tmp_path / 'cache.sqlite'))
+	fileName = makeFile(tmp_path, b'abc')
+	st = os.stat(fileName)
+	cache.store(fileName, st, {'crc32': '352441C2'})
+
+	os.utime(fileName, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+	assert cache.lookup(fileName, os.stat(fileName), ['crc32']) is None
+
+	with open(fileName, 'ab') as fd:
+		fd.write(b'd')
+	assert cache.lookup(fileName, os.stat(fileName), ['crc32']) is None
+
+
+def test_hashFileCached(tmp_path):
+	cache = hasher.HashCache(str(tmp_path / 'cache.sqlite'))
+	fileName = makeFile(tmp_path, b'abc')
+	cachedHasher = hasher.Hasher(cache=cache)
+	assert cachedHasher.hashFileCached(fileName) == ({'crc32': '352441C2'}, False)
+	assert cachedHasher.hashFileCached(fileName) == ({'crc32': '352441C2'}, True)
+
+	st = os.stat(fileName)
+	with open(fileName, 'wb') as fd:
+		fd.write(b'xyz')
+	os.utime(fileName, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+	assert cachedHasher.hashFileCached(fileName) == ({'crc32': '%08X' % zlib.crc32(b'xyz')}, False)
+	assert cachedHasher.hashFileCached(fileName)[1]
+
+	# force reads the file again, but still updates the cache
+	assert not hasher.Hasher(cache=cache, force=True).hashFileCached(fileName)[1]
@@ -0,0 +1,56 @@
+import os
+
+import python_crc32_hasher as hasher
+
+
+def writeManifest(tmp_path, name, data):
+	path = tmp_path / name
+	path.write_bytes(data)
+	return str(path)
+
+
+def test_sfv(tmp_path):
+	manifest = writeManifest(tmp_path, 'a.sfv', b'; comment\r\nfile one.mkv 1a2b3c4d\r\nsub\\two.mkv DEADBEEF\r\nbad line\r\n')
+	assert list(hasher.parseManifest(manifest)) == [
+		('file one.mkv', 'crc32', '1A2B3C4D'),
+		(os.path.join('sub', 'two.mkv'), 'crc32', 'DEADBEEF'),
+	]
+
+
+def test_sfv_utf16(tmp_path):
+	manifest = writeManifest(tmp_path, 'a.sfv', u'\ufeff; x\nh\xe9llo.txt 0000000A\n'.encode('utf-16-le'))
+	assert list(hasher.parseManifest(manifest)) == [(u'h\xe9llo.txt', 'crc32', '0000000A')]
+
+
+def test_gnu(tmp_path):
+	md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+	manifest = writeManifest(tmp_path, 'a.md5', (md5 + '  a b.txt\n' + md5 + ' *binary.bin\n'
+		+ '\\' + md5 + '  back\\\\slash\\nnewline.txt\n').encode('ascii'))
+	assert list(hasher.parseManifest(manifest)) == [
+		('a b.txt', 'md5', md5.upper()),
+		('binary.bin', 'md5', md5.upper()),
+		('back\\slash\nnewline.txt', 'md5', md5.upper()),
+	]
+
+
+# Without a known extension, the hash comes from the length of the digests
+def test_guessed_type(tmp_path):
+	manifest = writeManifest(tmp_path, 'sums.txt', b'ab' * 20 + b'  a\n' + b'cd' * 32 + b'  b\nc.bin 0000000A\n')
+	assert list(hasher.parseManifest(manifest)) == [('a', 'sha1', 'AB' * 20), ('b', 'sha256', 'CD' * 32), ('c.bin', 'crc32', '0000000A')]
+
+
+def test_jsonl(tmp_path):
+	manifest = writeManifest(tmp_path, 'a.jsonl', b'{"name": "a", "size": 1, "crc32": "0000000a", "md5": "' + b'ef' * 16 + b'"}\nnot json\n')
+	assert list(hasher.parseManifest(manifest)) == [('a', 'crc32', '0000000A'), ('a', 'md5', 'EF' * 16)]
+
+
+# Files listed in several checksum files are checked once, against all of
+# their digests
+def test_buildCheckIndex(tmp_path):
+	first = writeManifest(tmp_path, 'a.sfv', b'x.bin 0000000A\ny.bin 0000000B\n')
+	second = writeManifest(tmp_path, 'b.md5', b'ef' * 16 + b'  x.bin\n')
+	third = writeManifest(tmp_path, 'c.sfv', b'y.bin 0000000C\n')
+	assert hasher.buildCheckIndex([first, second, third]) == [
+		(str(tmp_path / 'x.bin'), {'crc32': ['0000000A'], 'md5': ['EF' * 16]}),
+		(str(tmp_path / 'y.bin'), {'crc32': ['0000000B', '0000000C']}),
+	]
@@ -0,0 +1,56 @@
+import os
+
+import python_crc32_hasher as hasher
+
+chunkSize = 1000
+
+
+def makeFile(tmp_path, data):
+	path = tmp_path / 'data.bin'
+	path.write_bytes(data)
+	return str(path)
+
+
+def test_written_while_hashing(tmp_path):
+	data = os.urandom(5500)
+	fileName = makeFile(tmp_path, data)
+	digests = hasher.Hasher(['crc32'], chunkIndex=True, chunkIndexSize=chunkSize).hashFile(fileName)
+	assert digests == hasher.Hasher(['crc32']).hashFile(fileName) # the chunks aren't a digest
+	index = hasher.loadChunkIndex(hasher.getChunkIndexPath(fileName))
+	assert index == hasher.buildChunkIndex(fileName, chunkSize)
+	assert len(index['chunks']) == 6
+	assert hasher.isChunkIndexCurrent(fileName, os.stat(fileName), chunkSize)
+	assert not hasher.isChunkIndexCurrent(fileName, os.stat(fileName), 2 * chunkSize)
+
+
+def test_verify_damaged_chunks(tmp_path):
+	data = bytearray(os.urandom(5500))
+	fileName = makeFile(tmp_path, bytes(data))
+	index = hasher.buildChunkIndex(fileName, chunkSize)
+	assert hasher.verifyChunkIndex(fileName, index) == ([], 6, 5500)
+
+	data[2500] ^= 1
+	data[5499] ^= 1
+	makeFile(tmp_path, bytes(data))
+	assert hasher.verifyChunkIndex(fileName, index) == ([2, 5], 6, 5500)
+	assert hasher.verifyChunkIndex(fileName, index, [(0, 2000)]) == ([], 2, 2000)
+	assert hasher.verifyChunkIndex(fileName, index, [(1999, 2001), (5000, None)]) == ([2, 5], 3, 2500)
+
+	makeFile(tmp_path, bytes(data[:3000])) # cut short
+	assert hasher.verifyChunkIndex(fileName, index)[0] == [2, 3, 4, 5]
+
+
+def test_diff(tmp_path):
+	data = bytearray(os.urandom(5500))
+	index1 = hasher.buildChunkIndex(makeFile(tmp_path, bytes(data)), chunkSize)
+	data[10] ^= 1
+	index2 = hasher.buildChunkIndex(makeFile(tmp_path, bytes(data) + b'more' * 300), chunkSize)
+	assert hasher.diffChunkIndexes(index1, index2) == [0, 5, 6]
+	assert hasher.formatChunkRuns([0, 5, 6], chunkSize, 6700) == 'chunk 0 (bytes 0-1000), chunks 5-6 (bytes 5000-6700)'
+
+
+def test_parseRanges():
+	assert hasher.parseRanges('100M-200M,1G-') == [(100 * 1024 ** 2, 200 * 1024 ** 2), (1024 ** 3, None)]
+	assert hasher.parseRanges('-4K') == [(0, 4096)]
+	assert hasher.parseRanges('2M-1M') is None
+	assert hasher.parseRanges('x') is None
@@ -0,0 +1,19 @@
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+@pytest.mark.parametrize('name, expected', [
+	('[Group] Show - 01 [1A2B3C4D].mkv', (True, '1A2B3C4D', 19)),
+	('Show_01_(1a2b3c4d).mkv', (True, '1a2b3c4d', 9)),
+	('1A2B3C4D.bin', (True, '1A2B3C4D', 0)),
+	('file 1A2B3C4D', (True, '1A2B3C4D', 5)),
+	('[00000000] [11111111].txt', (True, '11111111', 12)), # the last one
+	('file1A2B3C4D.bin', (False, '', -1)), # not separated
+	('[1A2B3C4D9].mkv', (False, '', -1)), # 9 digits
+	('[1A2B3C4G].mkv', (False, '', -1)),
+	('plain.txt', (False, '', -1)),
+])
+def test_detectCRC(name, expected):
+	assert hasher.detectCRC(name) == expected
+
@@ -0,0 +1,95 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+import python_crc32_hasher as hasher
+
+
+def runScript(args, cwd, env = None):
+	output = subprocess.check_output([sys.executable, os.path.abspath(hasher.__file__)] + args, cwd=cwd,
+		stderr=subprocess.STDOUT, env=env, timeout=120)
+	return output.decode('utf-8', 'replace')
+
+
+def resultLines(output):
+	return sorted(line for line in output.splitlines() if 'CRC not found!' in line or 'MD5:' in line)
+
+
+def test_serve_same_as_local(tmp_path):
+	(tmp_path / 'data').mkdir()
+	for n in range(20):
+		(tmp_path / 'data' / ('%02d.bin' % n)).write_bytes(os.urandom(n * 1000))
+	local = runScript(['--md5', '-r', '-c', 'local.md5', 'data'], str(tmp_path))
+	served = runScript(['--md5', '-r', '-c', 'served.md5', '--serve', '127.0.0.1:0', '--localworkers', '2', 'data'], str(tmp_path))
+	assert resultLines(served) == resultLines(local)
+	assert len(resultLines(served)) == 40
+	assert (tmp_path / 'served.md5').read_bytes() == (tmp_path / 'local.md5').read_bytes()
+
+
+def test_serve_uses_the_cache(tmp_path):
+	(tmp_path / 'data').mkdir()
+	for n in range(5):
+		(tmp_path / 'data' / ('%d.bin' % n)).write_bytes(os.urandom(1000))
+	env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path / 'cache'))
+	args = ['--cache', '--serve', '127.0.0.1:0', '--localworkers', '1', 'data']
+	assert 'Cached: 0.' in runScript(args, str(tmp_path), env)
+	assert 'Cached: 5.' in runScript(args, str(tmp_path), env)
+
+
+def test_mergeResults():
+	data = os.urandom(10000)
+	states = []
+	for start in range(0, len(data), 3000):
+		part = hasher.Crc32Hash()
+		part.update(data[start:start + 3000])
+		states.append({'size': part.size, 'states': {'crc32': part.getState()}})
+	assert hasher.mergeResults(['crc32'], states, len(data)) == ({'crc32': '%08X' % zlib.crc32(data)}, None)
+	assert hasher.mergeResults(['crc32'], [{'digests': {'crc32': '0000000A'}}], 10) == ({'crc32': '0000000A'}, None)
+	assert hasher.mergeResults(['crc32'], states[:1] + [{'error': 'gone'}], len(data)) == ({}, 'gone')
+	assert hasher.mergeResults(['crc32'], states[:-1], len(data)) == ({}, 'File changed while being hashed!')
+
+
+# A part of a file that got shorter since it was planned is an error
+def test_short_range_job(tmp_path):
+	(tmp_path / 'a.bin').write_bytes(b'a' * 1000)
+	job = {'id': 1, 'path': str(tmp_path / 'a.bin'), 'start': 500, 'length': 1000}
+	result = hasher.runWorkerJob(hasher.Hasher(['crc32']), job)
+	assert result == {'id': 1, 'error': 'File changed while being hashed!'}
+	job['length'] = 500
+	assert hasher.runWorkerJob(hasher.Hasher(['crc32']), job)['size'] == 500
+
+
+# Without any worker, the coordinator hashes the files itself after workerTimeout
+def test_no_worker_ever_connected():
+	work = hasher.WorkQueue()
+	time.sleep(0.05)
+	assert work.lostFor() > 0
+
+
+# A worker that takes a job and then says nothing loses it to the next one
+def test_silent_worker_loses_its_job(monkeypatch):
+	monkeypatch.setattr(hasher, 'workerTimeout', 0.5)
+	work = hasher.WorkQueue()
+	server = hasher.CoordinatorServer(('127.0.0.1', 0), work, ['crc32'])
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	try:
+		connection = socket.create_connection(server.server_address[:2])
+		stream = connection.makefile('rwb')
+		hasher.sendMessage(stream, {'hello': hasher.protocolVersion, 'name': 'silent'})
+		settings = hasher.receiveMessage(stream)
+		assert settings['heartbeat'] < 0.5
+		work.put({'id': 1, 'path': '/nonexistent', 'start': 0, 'length': None})
+		assert hasher.receiveMessage(stream)['id'] == 1
+		assert hasher.receiveMessage(stream) is None # dropped
+		connection.close()
+		assert work.take()['id'] == 1 # back in the queue
+	finally:
+		work.finish()
+		server.shutdown()
+		server.server_close()
@@ -0,0 +1,34 @@
+import os
+
+import python_crc32_hasher as hasher
+
+
+def test_findDuplicates(tmp_path):
+	same = os.urandom(10000)
+	files = {
+		'a.bin': same,
+		'b.bin': same,
+		os.path.join('sub', 'c.bin'): same,
+		'same head and tail.bin': same[:100] + b'x' * 9800 + same[-100:],
+		'same size.bin': os.urandom(10000),
+		'small1.txt': b'abc',
+		'small2.txt': b'abc',
+		'empty1': b'',
+		'empty2': b'',
+	}
+	for name, data in files.items():
+		path = tmp_path / name
+		path.parent.mkdir(exist_ok=True)
+		path.write_bytes(data)
+
+	items = hasher.walkInputs([str(tmp_path)], True, False)
+	groups, counters = hasher.findDuplicates(items, hasher.Hasher(['crc32', 'md5']), sampleSize=100)
+	assert [(size, sorted(os.path.basename(name) for name in names)) for size, digests, names in groups] == [
+		(10000, ['a.bin', 'b.bin', 'c.bin']),
+		(3, ['small1.txt', 'small2.txt']),
+	]
+	assert set(groups[0][1]) == set(['crc32', 'md5'])
+	assert counters['files'] == 7 # empty files left out
+	assert counters['sampled'] == 7
+	assert counters['hashed'] == 6 # same size.bin only sampled
+	assert counters['errors'] == 0
@@ -0,0 +1,37 @@
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+@pytest.mark.parametrize('pattern, name, expected', [
+	('*', 'anything', True),
+	('*.mkv', 'a.mkv', True),
+	('*.mkv', 'a.mkv.part', False),
+	('ep*', 'ep01.mkv', True),
+	('ep*.mkv', 'ep01.mkv', True),
+	('ep*.mkv', 'ep.mk', False),
+	('ep??.mkv', 'ep01.mkv', True),
+	('ep??.mkv', 'ep1.mkv', False),
+	('*ep*1*', 'the ep 01 x', True),
+	('a.b', 'a.b', True),
+	('a.b', 'axb', False), # no regular expressions
+	('[x].txt', '[x].txt', True),
+])
+def test_compilePattern(pattern, name, expected):
+	assert bool(hasher.compilePattern(pattern)(name)) == expected
+
+
+def test_NameFilter():
+	nameFilter = hasher.NameFilter(['*.mkv', '*.mp4'], ['*sample*'])
+	assert nameFilter.matches('a.mkv')
+	assert nameFilter.matches('b.mp4')
+	assert not nameFilter.matches('c.txt')
+	assert not nameFilter.matches('a sample.mkv')
+	assert hasher.NameFilter([], ['*.part']).matches('a.txt')
+
+
+def test_walk_with_filter(tmp_path):
+	for name in ['a.mkv', 'a.part', 'b.txt']:
+		(tmp_path / name).write_bytes(b'x')
+	items = hasher.walkInputs([str(tmp_path)], False, False, hasher.NameFilter([], ['*.part']))
+	assert [item[0] for item in items] == [str(tmp_path / 'a.mkv'), str(tmp_path / 'b.txt')]
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import zlib
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+try:
+	hashlib.new('md4')
+	hasMd4 = True
+except ValueError: # not in this OpenSSL
+	hasMd4 = False
+needsMd4 = pytest.mark.skipif(not hasMd4, reason='MD4 not available')
+
+
+@pytest.mark.parametrize('sizeA, sizeB', [(0, 0), (0, 5), (5, 0), (1, 1), (1000, 37), (65536, 100001)])
+def test_crc32Combine(sizeA, sizeB):
+	a = os.urandom(sizeA)
+	b = os.urandom(sizeB)
+	assert hasher.crc32Combine(zlib.crc32(a), zlib.crc32(b), len(b)) == zlib.crc32(a + b)
+
+
+def test_crc32_combine_and_state():
+	data = os.urandom(100000)
+	first = hasher.Crc32Hash()
+	first.update(data[:12345])
+	second = hasher.Crc32Hash()
+	second.setState(hasher.Crc32Hash().getState())
+	second.update(data[12345:])
+	first.combine(second)
+	assert first.hexdigest() == '%08X' % zlib.crc32(data)
+	assert first.getState() == {'crc': zlib.crc32(data), 'size': len(data)}
+
+
+# ED2K from its definition: the MD4 of the file if it's less than a chunk,
+# else the MD4 of the MD4s of its chunks, with the MD4 of an empty chunk
+# after a last whole one
+def referenceEd2k(data):
+	chunkSize = hasher.Ed2kHash.chunkSize
+	if len(data) < chunkSize:
+		return hashlib.new('md4', data).hexdigest()
+	hashes = b''.join(hashlib.new('md4', data[pos:pos + chunkSize]).digest() for pos in range(0, len(data) + 1, chunkSize))
+	return hashlib.new('md4', hashes).hexdigest()
+
+
+@needsMd4
+@pytest.mark.parametrize('data, expected', [
+	(b'', '31d6cfe0d16ae931b73c59d7e0c089c0'),
+	(b'abc', 'a448017aaf21d8525fc10ae87aa6729d'),
+])
+def test_ed2k_small(data, expected):
+	ed2k = hasher.Ed2kHash()
+	ed2k.update(data)
+	assert ed2k.hexdigest() == expected
+
+
+@needsMd4
+@pytest.mark.parametrize('size', [hasher.Ed2kHash.chunkSize, 2 * hasher.Ed2kHash.chunkSize + 1000])
+def test_ed2k_chunks(size):
+	data = os.urandom(size)
+	ed2k = hasher.Ed2kHash()
+	for pos in range(0, size, 1 << 20): # blocks across chunk boundaries
+		ed2k.update(memoryview(data)[pos:pos + (1 << 20)])
+	assert ed2k.hexdigest() == referenceEd2k(data)
+
+
+@needsMd4
+def test_ed2k_combine_and_state():
+	chunkSize = hasher.Ed2kHash.chunkSize
+	data = os.urandom(2 * chunkSize + 1000)
+	first = hasher.Ed2kHash()
+	first.update(data[:chunkSize])
+	second = hasher.Ed2kHash()
+	second.update(data[chunkSize:])
+	resumed = hasher.Ed2kHash()
+	resumed.setState(first.getState())
+	first.combine(second)
+	assert first.hexdigest() == referenceEd2k(data)
+	resumed.update(data[chunkSize:])
+	assert resumed.hexdigest() == referenceEd2k(data)
+
+
+def test_split_same_as_whole_file(tmp_path):
+	path = tmp_path / 'big.bin'
+	data = os.urandom(2 * hasher.Ed2kHash.chunkSize + 12345)
+	path.write_bytes(data)
+	splitHasher = hasher.Hasher(splitJobs=3, splitThreshold=0)
+	assert splitHasher.useSplit(len(data))
+	assert splitHasher.hashFile(str(path)) == {'crc32': '%08X' % zlib.crc32(data)}
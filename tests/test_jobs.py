@@ -0,0 +1,61 @@
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import python_crc32_hasher as hasher
+
+
+# Counts the items drawn from it, so that a test can see how far ahead the
+# pool reads its input
+class CountingItems(object):
+	def __init__(self, count):
+		self.count = count
+		self.drawn = 0
+
+	def __iter__(self):
+		for n in range(self.count):
+			self.drawn += 1
+			yield n
+
+
+def test_imapBounded_keeps_order():
+	pool = ThreadPool(3)
+	try:
+		assert list(hasher.imapBounded(pool, lambda n: n * n, range(100), 6)) == [n * n for n in range(100)]
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def test_imapBounded_reads_at_most_a_window_ahead():
+	items = CountingItems(10000)
+	pool = ThreadPool(2)
+	try:
+		results = hasher.imapBounded(pool, lambda n: n, items, 8)
+		for n in range(50):
+			assert next(results) == n
+			assert items.drawn <= n + 1 + 8
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def test_mapFiles_reads_at_most_a_window_ahead():
+	items = CountingItems(10000)
+	results = hasher.Hasher(jobs=3).mapFiles(lambda n: n, items)
+	for n in range(50):
+		assert next(results) == n
+		assert items.drawn <= n + 1 + 3 * hasher.poolWindow
+	results.close()
+
+
+def test_hashItems_with_jobs(tmp_path):
+	contents = [(b'%d' % n) * n for n in range(40)]
+	items = []
+	for n, data in enumerate(contents):
+		path = tmp_path / ('f%02d.bin' % n)
+		path.write_bytes(data)
+		items.append((str(path), False))
+	results = list(hasher.Hasher(jobs=4).hashItems(items))
+	assert [result[0] for result in results] == [item[0] for item in items]
+	assert [result[2]['crc32'] for result in results] == ['%08X' % zlib.crc32(data) for data in contents]
+	assert [result[5] for result in results] == [len(data) for data in contents]
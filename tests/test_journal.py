@@ -0,0 +1,77 @@
+import os
+import zlib
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+class Killed(Exception):
+	pass
+
+
+@pytest.fixture
+def bigFile(tmp_path, monkeypatch):
+	monkeypatch.setattr(hasher, 'resumeCheckpointSize', 100000)
+	path = tmp_path / 'big.bin'
+	path.write_bytes(os.urandom(350000))
+	return str(path)
+
+
+# A run killed right after the first checkpoint of the file
+def killedRun(journalPath, fileName, monkeypatch):
+	journal = hasher.RunJournal(journalPath, 'run')
+	checkpoint = hasher.RunJournal.checkpoint
+	def checkpointAndDie(self, *args):
+		checkpoint(self, *args)
+		raise Killed()
+	monkeypatch.setattr(hasher.RunJournal, 'checkpoint', checkpointAndDie)
+	with pytest.raises(Killed):
+		hasher.Hasher(journal=journal).hashFileCached(fileName)
+	monkeypatch.setattr(hasher.RunJournal, 'checkpoint', checkpoint)
+	journal.file.close()
+
+
+def test_resume_from_checkpoint(tmp_path, bigFile, monkeypatch):
+	journalPath = str(tmp_path / 'journal.jsonl')
+	killedRun(journalPath, bigFile, monkeypatch)
+
+	journal = hasher.RunJournal(journalPath, 'run')
+	st = os.stat(bigFile)
+	assert journal.getPartial(os.path.abspath(bigFile), st)[0] == 100000
+	with open(bigFile, 'rb') as fd:
+		expected = '%08X' % zlib.crc32(fd.read())
+	assert hasher.Hasher(journal=journal).hashFileCached(bigFile) == ({'crc32': expected}, False)
+	assert journal.takeResumed(os.path.abspath(bigFile)) == 100000 # not read again
+	journal.close(False)
+
+	# Done in the journal: not read again at all
+	journal = hasher.RunJournal(journalPath, 'run')
+	assert hasher.Hasher(journal=journal).hashFileCached(bigFile) == ({'crc32': expected}, True)
+	journal.close(True)
+	assert not os.path.exists(journalPath)
+
+
+def test_other_run_starts_over(tmp_path, bigFile, monkeypatch):
+	journalPath = str(tmp_path / 'journal.jsonl')
+	killedRun(journalPath, bigFile, monkeypatch)
+	journal = hasher.RunJournal(journalPath, 'another run')
+	assert journal.getPartial(os.path.abspath(bigFile), os.stat(bigFile)) is None
+	journal.close(True)
+
+
+def test_changed_file_starts_over(tmp_path, bigFile, monkeypatch):
+	journalPath = str(tmp_path / 'journal.jsonl')
+	killedRun(journalPath, bigFile, monkeypatch)
+	with open(bigFile, 'ab') as fd:
+		fd.write(b'more')
+	journal = hasher.RunJournal(journalPath, 'run')
+	assert journal.getPartial(os.path.abspath(bigFile), os.stat(bigFile)) is None
+	journal.close(True)
+
+
+# --split comes first
+def test_split_is_not_checkpointed(bigFile):
+	size = 2 * hasher.Ed2kHash.chunkSize
+	assert hasher.Hasher(journal=object()).useResume(size)
+	assert not hasher.Hasher(journal=object(), splitJobs=2, splitThreshold=0).useResume(size)
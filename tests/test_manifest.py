@@ -0,0 +1,61 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+files = {
+	'plain.txt': b'a',
+	'with space.txt': b'b' * 1000,
+	'h\xe9llo 日本.txt': b'c' * 5,
+	'back\\slash.txt': b'd', # escaped by md5sum & co.
+	os.path.join('sub', 'deep.bin'): os.urandom(100000),
+	'empty.bin': b'',
+}
+
+
+def runScript(args, cwd):
+	output = subprocess.check_output([sys.executable, os.path.abspath(hasher.__file__)] + args, cwd=cwd,
+		stderr=subprocess.STDOUT)
+	return output.decode('utf-8', 'replace')
+
+
+def getTotals(output):
+	match = re.search(r'Total: (\d+)\. OK: (\d+)\. Not OK: (\d+)\. Missing: (\d+)\. Error: (\d+)\.', output)
+	assert match, output
+	return tuple(int(n) for n in match.groups())
+
+
+# Written with -c, then read with -k, for each format of -c
+@pytest.mark.parametrize('ext', ['.sfv', '.md5', '.sha1', '.sha256', '.sha512', '.jsonl'])
+def test_round_trip(tmp_path, ext):
+	for name, data in files.items():
+		if ext == '.sfv' and '\\' in name: # a folder separator in SFV
+			continue
+		path = tmp_path / name
+		path.parent.mkdir(exist_ok=True)
+		path.write_bytes(data)
+	count = len(list(tmp_path.rglob('*.*')))
+
+	manifest = 'out' + ext
+	runScript(['-r', '-c', manifest, '.'], str(tmp_path))
+	with open(str(tmp_path / manifest), 'rb') as fd:
+		content = fd.read()
+	assert b'out' + ext.encode('ascii') not in content # not listing itself
+	assert getTotals(runScript(['-k', manifest], str(tmp_path))) == (count, count, 0, 0, 0)
+
+	(tmp_path / 'plain.txt').write_bytes(b'z')
+	(tmp_path / 'empty.bin').unlink()
+	assert getTotals(runScript(['-k', manifest], str(tmp_path))) == (count, count - 2, 1, 1, 0)
+
+
+def test_parseManifest_bsd(tmp_path):
+	manifest = tmp_path / 'bsd.txt'
+	manifest.write_bytes(b'MD5 (a b.txt) = 0CC175B9C0F1B6A831C399E269772661\nSHA256 (sub/c) = ' + b'ab' * 32 + b'\n')
+	assert list(hasher.parseManifest(str(manifest))) == [
+		('a b.txt', 'md5', '0CC175B9C0F1B6A831C399E269772661'),
+		(os.path.join('sub', 'c'), 'sha256', 'AB' * 32),
+	]
@@ -0,0 +1,58 @@
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import zlib
+
+import python_crc32_hasher as hasher
+
+files = {'a.txt': b'a', 'b, "quoted".txt': b'bb'}
+
+
+def runScript(args, cwd):
+	process = subprocess.run([sys.executable, os.path.abspath(hasher.__file__)] + args, cwd=cwd,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+	return process.stdout.decode('utf-8'), process.stderr.decode('utf-8')
+
+
+def makeTree(tmp_path):
+	for name, data in files.items():
+		(tmp_path / name).write_bytes(data)
+
+
+def expected(name):
+	return {'size': len(files[name]), 'crc32': '%08x' % zlib.crc32(files[name]), 'result': 'CRC not found!'}
+
+
+def test_json(tmp_path):
+	makeTree(tmp_path)
+	stdout, stderr = runScript(['--format', 'json', '.'], str(tmp_path))
+	entries = json.loads(stdout)
+	assert [dict((key, entry[key]) for key in ('size', 'crc32', 'result')) for entry in entries] == [expected(name) for name in sorted(files)]
+	assert 'Total: 2.' in stderr
+
+
+def test_jsonl(tmp_path):
+	makeTree(tmp_path)
+	stdout, stderr = runScript(['--format', 'jsonl', '--md5', '.'], str(tmp_path))
+	entries = [json.loads(line) for line in stdout.splitlines()]
+	assert [os.path.basename(entry['path']) for entry in entries] == sorted(files)
+	assert all('md5' in entry for entry in entries)
+
+
+def test_csv(tmp_path):
+	makeTree(tmp_path)
+	stdout, stderr = runScript(['--format', 'csv', '.'], str(tmp_path))
+	rows = list(csv.reader(io.StringIO(stdout)))
+	assert rows[0] == ['path', 'size', 'result', 'crc32']
+	assert [(os.path.basename(row[0]), int(row[1]), row[3]) for row in rows[1:]] == [
+		(name, len(files[name]), '%08x' % zlib.crc32(files[name])) for name in sorted(files)]
+
+
+def test_empty_json():
+	stream = io.StringIO()
+	output = hasher.ResultOutput(stream, 'json')
+	output.close()
+	assert json.loads(stream.getvalue()) == []
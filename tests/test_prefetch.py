@@ -0,0 +1,39 @@
+import threading
+
+import python_crc32_hasher as hasher
+
+
+def test_ReadAheadBudget():
+	budget = hasher.ReadAheadBudget(100)
+	stop = threading.Event()
+	assert budget.acquire(60, stop)
+	assert budget.acquire(40, stop)
+	stop.set()
+	assert not budget.acquire(1, stop) # full, and asked to stop
+	budget.release(100)
+	assert budget.acquire(500, stop) # bigger than the budget, but alone
+	assert budget.used == 500
+
+
+def test_ReadAheadBudget_waits_for_room():
+	budget = hasher.ReadAheadBudget(100)
+	stop = threading.Event()
+	budget.acquire(100, stop)
+	acquired = []
+	thread = threading.Thread(target=lambda: acquired.append(budget.acquire(50, stop)))
+	thread.start()
+	thread.join(0.3)
+	assert not acquired
+	budget.release(60)
+	thread.join(5)
+	assert acquired == [True]
+
+
+# Reading more than the budget: the reader waits for the hashes
+def test_prefetch_with_small_budget(tmp_path):
+	data = bytes(bytearray(range(256))) * 1000
+	path = tmp_path / 'data.bin'
+	path.write_bytes(data)
+	fileHasher = hasher.Hasher(['crc32', 'md5'], blockSize=4096, readPath='prefetch', readAhead=8, readAheadMemory=8192)
+	assert fileHasher.hashFile(str(path)) == hasher.Hasher(['crc32', 'md5']).hashFile(str(path))
+	assert fileHasher.readAheadBudget.used == 0
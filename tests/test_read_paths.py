@@ -0,0 +1,55 @@
+import hashlib
+import os
+import zlib
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+@pytest.fixture
+def dataFile(tmp_path):
+	data = os.urandom(3 * 65536 + 1234)
+	path = tmp_path / 'data.bin'
+	path.write_bytes(data)
+	return str(path), data
+
+
+@pytest.mark.parametrize('readPath', ['read', 'readinto', 'mmap', 'prefetch', 'auto'])
+def test_read_paths_give_the_same_digests(dataFile, readPath):
+	fileName, data = dataFile
+	fileHasher = hasher.Hasher(['crc32', 'md5', 'sha256'], blockSize=65536, readPath=readPath)
+	assert fileHasher.hashFile(fileName) == {'crc32': '%08X' % zlib.crc32(data),
+		'md5': hashlib.md5(data).hexdigest().upper(), 'sha256': hashlib.sha256(data).hexdigest().upper()}
+
+
+@pytest.mark.parametrize('reuse', [False, True])
+def test_prefetchBlocks(dataFile, reuse):
+	fileName, data = dataFile
+	budget = hasher.ReadAheadBudget(4 * 65536)
+	with open(fileName, 'rb') as fd:
+		blocks = [bytes(block) for block in hasher.prefetchBlocks(fd, 65536, 2, budget, reuse)]
+	assert b''.join(blocks) == data
+	assert len(blocks) == 4
+	assert budget.used == 0 # all given back
+
+
+def test_prefetchBlocks_stopped_early(dataFile):
+	fileName, data = dataFile
+	budget = hasher.ReadAheadBudget(4 * 65536)
+	with open(fileName, 'rb') as fd:
+		blocks = hasher.prefetchBlocks(fd, 65536, 2, budget, True)
+		assert bytes(next(blocks)) == data[:65536]
+		blocks.close()
+	assert budget.used == 0
+
+
+def test_chunk_hashes_take_memoryviews():
+	chunks = hasher.ChunkIndexHash(1000)
+	whole = hasher.ChunkIndexHash(1000)
+	data = os.urandom(5000)
+	for pos in range(0, len(data), 777):
+		chunks.update(memoryview(data)[pos:pos + 777])
+	whole.update(data)
+	assert chunks.getChunkHashes() == whole.getChunkHashes()
+	assert len(whole.getChunkHashes()) == 5
@@ -0,0 +1,53 @@
+import hashlib
+import zlib
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+# Counts its bytes, as a stand-in for a third party hash
+class LengthHash(object):
+	def __init__(self):
+		self.size = 0
+
+	def update(self, buffer):
+		self.size += len(buffer)
+
+	def hexdigest(self):
+		return '%016x' % self.size
+
+
+@pytest.fixture
+def registry(monkeypatch):
+	for name in ('hashNames', 'hashDisplayNames', 'hashConstructors'):
+		monkeypatch.setattr(hasher, name, type(getattr(hasher, name))(getattr(hasher, name)))
+
+
+def test_registerHash(tmp_path, registry):
+	hasher.registerHash('length', 'Length', LengthHash)
+	assert hasher.hashNames[-1] == 'length'
+	path = tmp_path / 'a.bin'
+	path.write_bytes(b'x' * 1234)
+	assert hasher.Hasher(['crc32', 'length']).hashFile(str(path)) == {'crc32': '%08X' % zlib.crc32(b'x' * 1234),
+		'length': '00000000000004D2'}
+	with pytest.raises(ValueError):
+		hasher.Hasher(['nosuchhash'])
+
+
+@pytest.mark.skipif('blake2b' not in hasher.hashConstructors, reason='no BLAKE2')
+def test_blake2(tmp_path):
+	path = tmp_path / 'a.bin'
+	path.write_bytes(b'abc')
+	assert hasher.Hasher(['blake2b', 'blake2s']).hashFile(str(path)) == {
+		'blake2b': hashlib.blake2b(b'abc').hexdigest().upper(), 'blake2s': hashlib.blake2s(b'abc').hexdigest().upper()}
+
+
+@pytest.mark.skipif('crc32c' not in hasher.hashConstructors, reason='no crc32c module')
+def test_crc32c():
+	crc = hasher.Crc32cHash()
+	crc.update(b'1234')
+	resumed = hasher.Crc32cHash()
+	resumed.setState(crc.getState())
+	resumed.update(b'56789')
+	assert resumed.hexdigest() == 'E3069283' # the CRC-32C check value
@@ -0,0 +1,104 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+import zlib
+
+import python_crc32_hasher as hasher
+
+
+def runScript(args, cwd):
+	output = subprocess.check_output([sys.executable, os.path.abspath(hasher.__file__)] + args, cwd=cwd,
+		stderr=subprocess.STDOUT)
+	return output.decode('utf-8', 'replace')
+
+
+def test_addcrc_then_undo(tmp_path):
+	data = dict(('file%d.txt' % n, b'x' * n) for n in range(5))
+	for name, content in data.items():
+		(tmp_path / name).write_bytes(content)
+	renamed = sorted('file%d[%08X].txt' % (n, zlib.crc32(b'x' * n)) for n in range(5))
+	logPath = str(tmp_path / 'undo' / 'renames.jsonl')
+
+	runScript(['--addcrc', '--renamelog', logPath, '.'], str(tmp_path))
+	assert sorted(os.listdir(str(tmp_path))) == sorted(renamed + ['undo'])
+
+	runScript(['--undo', logPath], str(tmp_path))
+	assert sorted(os.listdir(str(tmp_path))) == sorted(list(data) + ['undo'])
+	for name, content in data.items():
+		assert (tmp_path / name).read_bytes() == content
+
+
+def test_dryrun_renames_nothing(tmp_path):
+	(tmp_path / 'a.txt').write_bytes(b'a')
+	logPath = str(tmp_path / 'renames.jsonl')
+	runScript(['--addcrc', '--dryrun', '--renamelog', logPath, 'a.txt'], str(tmp_path))
+	assert os.listdir(str(tmp_path)) == ['a.txt']
+
+
+def test_never_renames_over_a_file(tmp_path):
+	stage = hasher.RenameStage(str(tmp_path / 'renames.jsonl'))
+	(tmp_path / 'a.txt').write_bytes(b'a')
+	(tmp_path / 'b.txt').write_bytes(b'b')
+	(tmp_path / 'c.txt').write_bytes(b'c')
+	assert stage.plan(str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')) == 'File exists!'
+	assert stage.plan(str(tmp_path / 'a.txt'), str(tmp_path / 'd.txt')) is None
+	assert stage.plan(str(tmp_path / 'c.txt'), str(tmp_path / 'd.txt')) == 'File exists!' # already planned
+	stage.close()
+	assert sorted(os.listdir(str(tmp_path))) == ['b.txt', 'c.txt', 'd.txt', 'renames.jsonl']
+	assert (tmp_path / 'd.txt').read_bytes() == b'a'
+
+
+def test_undo_skips_what_changed_since(tmp_path):
+	(tmp_path / 'a.txt').write_bytes(b'a')
+	(tmp_path / 'b.txt').write_bytes(b'b')
+	logPath = str(tmp_path / 'renames.jsonl')
+	runScript(['--addcrc', '--renamelog', logPath, 'a.txt', 'b.txt'], str(tmp_path))
+	(tmp_path / 'a.txt').write_bytes(b'new') # the old name is taken again
+	(tmp_path / ('b[%08X].txt' % zlib.crc32(b'b'))).unlink()
+
+	output = runScript(['--undo', logPath], str(tmp_path))
+	assert 'Not renamed back, a.txt exists!' in output
+	assert 'Not found!' in output
+	assert (tmp_path / ('a[%08X].txt' % zlib.crc32(b'a'))).read_bytes() == b'a'
+
+
+def test_failed_renames_keep_the_old_name(tmp_path):
+	(tmp_path / 'a.txt').write_bytes(b'a')
+	logPath = str(tmp_path / 'not a folder' / 'renames.jsonl')
+	(tmp_path / 'not a folder').write_bytes(b'') # the undo log can't be written
+	process = subprocess.run([sys.executable, os.path.abspath(hasher.__file__), '--addcrc', '--renamelog', logPath,
+		'-c', 'out.sfv', 'a.txt'], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output = process.stdout.decode('utf-8')
+	assert process.returncode == 1
+	assert 'a.txt    E8B7BE43    Renaming failed!' in output
+	assert 'Error: 1.' in output
+	assert 'a.txt' in os.listdir(str(tmp_path))
+	assert 'Total: 1. OK: 1.' in runScript(['-k', 'out.sfv'], str(tmp_path))
+
+
+def test_watch_with_addcrc(tmp_path):
+	(tmp_path / 'data').mkdir()
+	(tmp_path / 'data' / 'a.txt').write_bytes(b'a')
+	process = subprocess.Popen([sys.executable, os.path.abspath(hasher.__file__), '--watch', '--addcrc', '--renamelog',
+		str(tmp_path / 'renames.jsonl'), '-c', 'out.sfv', 'data'], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	try:
+		renamed = tmp_path / 'data' / ('b[%08X].txt' % zlib.crc32(b'b'))
+		for attempt in range(100):
+			time.sleep(0.1)
+			if (tmp_path / 'data' / 'a[E8B7BE43].txt').exists():
+				break
+		(tmp_path / 'data' / 'b.txt').write_bytes(b'b')
+		for attempt in range(100):
+			time.sleep(0.1)
+			if renamed.exists():
+				break
+		assert renamed.exists()
+	finally:
+		process.send_signal(signal.SIGINT)
+		output = process.communicate(timeout=30)[0].decode('utf-8')
+	assert 'Traceback' not in output
+	assert 'Renamed: 2.' in output
+	with open(str(tmp_path / 'out.sfv')) as fd:
+		assert 'data%sb[%08X].txt' % (os.sep, zlib.crc32(b'b')) in fd.read()
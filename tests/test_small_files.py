@@ -0,0 +1,41 @@
+import hashlib
+import os
+import zlib
+
+import python_crc32_hasher as hasher
+
+
+def test_hashSmallFile(tmp_path):
+	for size in (0, 1, 4096, hasher.smallFileSize):
+		data = os.urandom(size)
+		path = tmp_path / ('%d.bin' % size)
+		path.write_bytes(data)
+		assert hasher.Hasher(['crc32', 'sha1']).hashSmallFile(str(path)) == {'crc32': '%08X' % zlib.crc32(data),
+			'sha1': hashlib.sha1(data).hexdigest().upper()}
+
+
+def test_hashSmallFile_grown(tmp_path):
+	path = tmp_path / 'big.bin'
+	path.write_bytes(b'x' * (hasher.smallFileSize + 1))
+	assert hasher.Hasher().hashSmallFile(str(path)) is None
+
+
+def test_batchSmallItems(tmp_path, monkeypatch):
+	monkeypatch.setattr(hasher, 'smallBatchSize', 3)
+	sizes = [1, 1, 1, 1, hasher.smallFileSize + 1, 1, 1]
+	for n, size in enumerate(sizes):
+		(tmp_path / ('%d.bin' % n)).write_bytes(b'x' * size)
+	items = list(hasher.walkInputs([str(tmp_path)], False, False))
+	batches = list(hasher.batchSmallItems(items))
+	assert [len(batch) for batch in batches] == [3, 1, 1, 2]
+	assert [item for batch in batches for item in batch] == items
+	assert [len(batch) for batch in hasher.batchSmallItems([(str(tmp_path / '0.bin'), False)])] == [1] # no DirEntry
+
+
+def test_many_small_files_with_jobs(tmp_path):
+	contents = [os.urandom(n % 200) for n in range(300)]
+	for n, data in enumerate(contents):
+		(tmp_path / ('%03d.bin' % n)).write_bytes(data)
+	items = hasher.walkInputs([str(tmp_path)], False, False)
+	results = list(hasher.Hasher(jobs=3).hashItems(items))
+	assert [result[2]['crc32'] for result in results] == ['%08X' % zlib.crc32(data) for data in contents]
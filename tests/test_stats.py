@@ -0,0 +1,42 @@
+import json
+
+import python_crc32_hasher as hasher
+
+
+def test_timings_and_metrics(tmp_path):
+	timingsPath = str(tmp_path / 'timings.jsonl')
+	stats = hasher.HashStats(timingsPath)
+	statsHasher = hasher.Hasher(['crc32', 'md5'], stats=stats, readPath='read')
+	sizes = [0, 1000, 100000]
+	for n, size in enumerate(sizes):
+		path = tmp_path / ('f%d.bin' % n)
+		path.write_bytes(b'x' * size)
+		assert statsHasher.hashFile(str(path)) == hasher.Hasher(['crc32', 'md5']).hashFile(str(path))
+	stats.close()
+
+	with open(timingsPath, 'rb') as fd:
+		entries = [json.loads(line) for line in fd.read().decode('utf-8').splitlines()]
+	assert [entry['bytes'] for entry in entries] == sizes
+	assert all(entry['readPath'] == 'read' and 'crc32' in entry and 'md5' in entry for entry in entries)
+
+	totals = stats.toDict()
+	assert (totals['files'], totals['bytes']) == (3, sum(sizes))
+	assert sum(totals['fileBytes']['counts']) == 3
+	assert totals['fileBytes']['counts'][0] == 2 # 4096 bytes or less
+
+	metricsPath = str(tmp_path / 'metrics.prom')
+	stats.export(metricsPath)
+	with open(metricsPath) as fd:
+		text = fd.read()
+	assert 'crc32_hasher_files_total 3\n' in text
+	assert 'crc32_hasher_file_bytes_bucket{le="+Inf"} 3\n' in text
+	stats.export(str(tmp_path / 'metrics.json'))
+	with open(str(tmp_path / 'metrics.json')) as fd:
+		assert json.load(fd)['bytes'] == sum(sizes)
+
+
+def test_bucketIndex():
+	assert hasher.bucketIndex([1, 10], 0) == 0
+	assert hasher.bucketIndex([1, 10], 1) == 0
+	assert hasher.bucketIndex([1, 10], 5) == 1
+	assert hasher.bucketIndex([1, 10], 11) == 2
@@ -0,0 +1,39 @@
+import array
+import io
+import os
+import subprocess
+import sys
+import zlib
+
+import python_crc32_hasher as hasher
+
+data = os.urandom(300000)
+expected = {'crc32': '%08X' % zlib.crc32(data)}
+
+
+# Only read(), like some HTTP responses
+class ReadOnly(object):
+	def __init__(self, data):
+		self.stream = io.BytesIO(data)
+
+	def read(self, size):
+		return self.stream.read(size)
+
+
+def test_hashStream():
+	streamHasher = hasher.Hasher(blockSize=65536)
+	assert streamHasher.hashStream(io.BytesIO(data)) == expected
+	assert streamHasher.hashStreamCounted(ReadOnly(data)) == (expected, len(data))
+	assert streamHasher.hashStream(io.BytesIO(b'')) == {'crc32': '00000000'}
+
+
+def test_hashBuffer_and_hashIterable():
+	bufferHasher = hasher.Hasher(blockSize=65536)
+	assert bufferHasher.hashBuffer(data) == expected
+	assert bufferHasher.hashBuffer(array.array('I', data[:300000 // 4 * 4])) == {'crc32': '%08X' % zlib.crc32(data[:300000 // 4 * 4])}
+	assert bufferHasher.hashIterable(data[pos:pos + 1000] for pos in range(0, len(data), 1000)) == expected
+
+
+def test_stdin():
+	output = subprocess.check_output([sys.executable, os.path.abspath(hasher.__file__), '-'], input=data)
+	assert expected['crc32'].encode('ascii') in output
@@ -0,0 +1,34 @@
+import hashlib
+import os
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+
+def test_updateThreaded_same_as_sequential():
+	blocks = [os.urandom(n) for n in (1, 65536, 0, 12345, 65536)]
+	threaded = [hashlib.md5(), hashlib.sha1(), hasher.Crc32Hash()]
+	sequential = [hashlib.md5(), hashlib.sha1(), hasher.Crc32Hash()]
+	hasher.updateThreaded(iter(blocks), threaded)
+	hasher.updateSequential(iter(blocks), sequential)
+	assert [h.hexdigest() for h in threaded] == [h.hexdigest() for h in sequential]
+
+
+class FailingHash(object):
+	def update(self, buffer):
+		raise ValueError('broken')
+
+
+def test_updateThreaded_raises_hash_errors():
+	with pytest.raises(ValueError):
+		hasher.updateThreaded(iter([b'a'] * 100), [hashlib.md5(), FailingHash()])
+
+
+def test_hash_threads_same_digests(tmp_path):
+	path = tmp_path / 'data.bin'
+	path.write_bytes(os.urandom(500000))
+	names = ['crc32', 'md5', 'sha1', 'sha256', 'sha512']
+	threaded = hasher.Hasher(names, blockSize=65536, cpuCount=4, readPath='read')
+	assert threaded.useThreads(threaded.newHashObjects(), 500000, 65536)
+	assert threaded.hashFile(str(path)) == hasher.Hasher(names, hashThreads=False).hashFile(str(path))
@@ -0,0 +1,37 @@
+import os
+
+import python_crc32_hasher as hasher
+
+
+def makeTree(tmp_path):
+	for name in ['b.txt', 'a.mkv', os.path.join('sub', 'c.txt'), os.path.join('sub', 'deeper', 'd.mkv')]:
+		path = tmp_path / name
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_bytes(name.encode('ascii'))
+
+
+def walk(paths, recursive = False, searchSubFolder = False):
+	return [(os.path.basename(item[0]), item[1]) for item in hasher.walkInputs(paths, recursive, searchSubFolder)]
+
+
+def test_folder(tmp_path):
+	makeTree(tmp_path)
+	assert walk([str(tmp_path)]) == [('a.mkv', True), ('b.txt', True)]
+	assert sorted(walk([str(tmp_path)], recursive=True)) == [('a.mkv', True), ('b.txt', True), ('c.txt', True), ('d.mkv', True)]
+
+
+def test_files_and_patterns(tmp_path):
+	makeTree(tmp_path)
+	assert walk([str(tmp_path / 'b.txt'), str(tmp_path / 'missing.txt')]) == [('b.txt', False), ('missing.txt', False)]
+	assert walk([str(tmp_path / '*.mkv')]) == [('a.mkv', True)]
+	assert sorted(walk([str(tmp_path / '*.mkv')], searchSubFolder=True)) == [('a.mkv', True), ('d.mkv', True)]
+
+
+# Items from folders carry their DirEntry, so that files are stat'ed once
+def test_entries_are_stat_once(tmp_path):
+	makeTree(tmp_path)
+	for item in hasher.walkInputs([str(tmp_path)], False, False):
+		st = hasher.statItem(item[0], item[2])
+		assert st.st_size == os.path.getsize(item[0])
+	assert hasher.statItem(str(tmp_path / 'missing.txt')) is None
+	assert hasher.statItem(str(tmp_path / 'sub')) is None # not a file
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import python_crc32_hasher as hasher
+
+watchers = [hasher.PollingWatcher]
+if hasher.InotifyWatcher.available():
+	watchers.append(hasher.InotifyWatcher)
+
+
+@pytest.mark.parametrize('watcherClass', watchers)
+def test_watcher_batches(tmp_path, monkeypatch, watcherClass):
+	monkeypatch.setattr(hasher, 'watchInterval', 0.05)
+	monkeypatch.setattr(hasher, 'watchSettle', 0.05)
+	(tmp_path / 'sub').mkdir()
+	(tmp_path / 'old.txt').write_bytes(b'old')
+	roots = hasher.getWatchRoots([str(tmp_path)], True, False)
+	watcher = watcherClass(roots, lambda path: not path.endswith('.part'))
+	try:
+		batches = watcher.batches()
+		(tmp_path / 'sub' / 'new.txt').write_bytes(b'new')
+		(tmp_path / 'skipped.part').write_bytes(b'part')
+		changed, deleted = next(batches)
+		assert changed == set([str(tmp_path / 'sub' / 'new.txt')])
+		assert not deleted
+
+		(tmp_path / 'old.txt').unlink()
+		changed, deleted = next(batches)
+		assert not changed
+		assert deleted == set([str(tmp_path / 'old.txt')])
+	finally:
+		watcher.close()
+
+
+def test_getWatchRoots(tmp_path):
+	(tmp_path / 'a.mkv').write_bytes(b'a')
+	fileRoot, folderRoot, patternRoot = hasher.getWatchRoots([str(tmp_path / 'a.mkv'), str(tmp_path),
+		os.path.join(str(tmp_path), '*.mkv')], True, False)
+	assert fileRoot.folder == folderRoot.folder == patternRoot.folder == str(tmp_path)
+	assert fileRoot.matches('a.mkv') and not fileRoot.matches('b.mkv')
+	assert folderRoot.matches is None and folderRoot.subFolders
+	assert patternRoot.matches('b.mkv') and not patternRoot.subFolders
+
+
+# --watch keeps the checksum file as a table, rewritten in full
+def test_ManifestTable(tmp_path):
+	path = str(tmp_path / 'out.md5')
+	table = hasher.ManifestTable(path)
+	table.add('a', {'md5': 'AA' * 16}, 1)
+	table.add('b', {'md5': 'BB' * 16}, 1)
+	table.add('a', {'md5': 'CC' * 16}, 1) # changed, goes last
+	table.save()
+	with open(path) as fd:
+		assert fd.read() == 'bb' * 16 + '  b\n' + 'cc' * 16 + '  a\n'
+	table.remove('b')
+	table.close()
+	with open(path) as fd:
+		assert fd.read() == 'cc' * 16 + '  a\n'
+	assert os.listdir(str(tmp_path)) == ['out.md5']